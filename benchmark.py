@@ -0,0 +1,259 @@
+"""
+Benchmark suite for the indexing and query hot paths of the Vector Model Application.
+It builds a synthetic corpus of configurable size in a local SQLite file, times
+preprocess_text, process_and_save_documents, save_tfidf_values, search_movies and
+find_similar_movies, and reports the p50/p95/p99 latency and the peak traced
+memory of each. Results are written as JSON so that runs can be compared and
+regressions caught with --compare.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import scipy
+import sklearn
+from database_creation import create_title_index
+from quantized_engine import QUANTIZE_FLOAT16, QUANTIZE_INT8, QuantizedEngine
+from queries import find_similar_movies, search_movies
+from similarity_engine import SimilarityEngine
+from vector_model import (export_snapshot, preprocess_text, process_and_save_documents, save_tfidf_values,
+                          setup_database)
+
+try:
+    import resource
+except ImportError:
+    # Unix only, the peak resident set size is not reported elsewhere
+    resource = None
+
+# Default size of the synthetic corpus and number of timed runs
+BENCHMARK_DOCUMENTS = 2_000
+BENCHMARK_WORDS_PER_DOCUMENT = 150
+BENCHMARK_VOCABULARY_SIZE = 5_000
+BENCHMARK_QUERIES = 200
+BENCHMARK_BUILD_RUNS = 3
+
+# A benchmark counts as a regression when its p50 grows by more than this factor
+REGRESSION_TOLERANCE = 1.2
+
+PERCENTILES = (50, 95, 99)
+
+
+def make_vocabulary(size, rng):
+    """ Generate distinct pseudo-words of 3 to 10 lowercase letters """
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rng.choices('abcdefghijklmnopqrstuvwxyz', k=rng.randint(3, 10))))
+    return sorted(words)
+
+
+def make_corpus(conn, n_documents=BENCHMARK_DOCUMENTS, words_per_document=BENCHMARK_WORDS_PER_DOCUMENT,
+                vocabulary_size=BENCHMARK_VOCABULARY_SIZE, seed=0):
+    """
+    Fill movies and plot_summaries with a synthetic corpus.
+    Word frequencies follow a Zipf distribution like natural text, and every
+    movie gets a title of three words.
+    """
+    rng = random.Random(seed)
+    vocabulary = make_vocabulary(vocabulary_size, rng)
+    weights = [1.0 / rank for rank in range(1, vocabulary_size + 1)]
+    cur = conn.cursor()
+    cur.execute("DROP TABLE IF EXISTS movies")
+    cur.execute("DROP TABLE IF EXISTS plot_summaries")
+    cur.execute("""CREATE TABLE movies (wikipedia_movie_id INTEGER, movie_name TEXT,
+                   movie_genres TEXT, movie_release_date TEXT)""")
+    cur.execute("CREATE TABLE plot_summaries (wikipedia_movie_id INTEGER, plot_summary TEXT)")
+    for movie_id in range(1, n_documents + 1):
+        title = ' '.join(rng.choices(vocabulary, k=3)).title()
+        plot = ' '.join(rng.choices(vocabulary, weights=weights, k=words_per_document)) + '.'
+        cur.execute("INSERT INTO movies VALUES (?, ?, ?, ?)",
+                    (movie_id, title, '{"/m/07s9rl0": "Drama"}', str(1950 + movie_id % 70)))
+        cur.execute("INSERT INTO plot_summaries VALUES (?, ?)", (movie_id, plot))
+    conn.commit()
+    create_title_index(conn)
+    return vocabulary
+
+
+def summarize(timings, peak_memory):
+    """ Summarize run times in seconds as millisecond percentiles """
+    timings_ms = np.asarray(timings) * 1000.0
+    summary = {f'p{q}_ms': float(np.percentile(timings_ms, q)) for q in PERCENTILES}
+    summary.update({'mean_ms': float(timings_ms.mean()), 'runs': len(timings),
+                    'peak_memory_bytes': peak_memory})
+    return summary
+
+
+def measure(function, arguments, setup=None):
+    """
+    Time function(*args) for every args in arguments, then trace its peak memory.
+    Timed runs happen without tracemalloc, which would slow them down; one more
+    run with the first arguments records the peak of traced allocations.
+    setup, if given, runs untimed before every call.
+    """
+    timings = []
+    # Keep the progress output of the measured functions out of the report
+    with contextlib.redirect_stdout(io.StringIO()):
+        for args in arguments:
+            if setup is not None:
+                setup()
+            start = time.perf_counter()
+            function(*args)
+            timings.append(time.perf_counter() - start)
+
+        if setup is not None:
+            setup()
+        tracemalloc.start()
+        try:
+            function(*arguments[0])
+            peak_memory = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return summarize(timings, peak_memory)
+
+
+def run_benchmarks(db_path, n_documents=BENCHMARK_DOCUMENTS, n_queries=BENCHMARK_QUERIES,
+                   build_runs=BENCHMARK_BUILD_RUNS, seed=0):
+    """
+    Build a synthetic corpus in db_path and benchmark the hot paths on it.
+    db_path must not exist yet, the corpus replaces the movies and plot summaries.
+
+    Returns:
+        dict: Configuration, environment and per-benchmark results.
+    """
+    if os.path.exists(db_path):
+        raise FileExistsError(f"Refusing to overwrite the existing database {db_path}")
+    rng = random.Random(seed)
+    conn = sqlite3.connect(db_path)
+    try:
+        vocabulary = make_corpus(conn, n_documents, seed=seed)
+        cur = conn.cursor()
+        cur.execute("SELECT plot_summary FROM plot_summaries")
+        plots = [row[0] for row in cur.fetchall()]
+        movie_ids = [rng.randint(1, n_documents) for _ in range(n_queries)]
+        results = {}
+
+        results['preprocess_text'] = measure(
+            preprocess_text, [(rng.choice(plots),) for _ in range(n_queries)])
+
+        results['process_and_save_documents'] = measure(
+            process_and_save_documents, [(conn,)] * build_runs, setup=lambda: setup_database(conn))
+
+        engine = SimilarityEngine.from_connection(conn)
+        results['save_tfidf_values'] = measure(
+            save_tfidf_values, [(conn, engine.matrix, engine.movie_ids)] * build_runs,
+            setup=lambda: setup_database(conn))
+
+        results['search_movies'] = measure(
+            search_movies, [(conn, rng.choice(vocabulary)[:4]) for _ in range(n_queries)])
+
+        results['find_similar_movies'] = measure(
+            lambda movie_id: find_similar_movies(conn, movie_id, engine=engine),
+            [(movie_id,) for movie_id in movie_ids])
+
+        # Quantized engines re-ranking from a memory-mapped snapshot as load_engine runs them,
+        # with their recall of the exact top 10 and their resident memory
+        with tempfile.TemporaryDirectory() as snapshot_dir:
+            export_snapshot(conn, snapshot_dir)
+            for dtype in (QUANTIZE_FLOAT16, QUANTIZE_INT8):
+                quantized = QuantizedEngine.from_snapshot(snapshot_dir, conn, dtype=dtype)
+                result = measure(lambda movie_id, quantized=quantized: find_similar_movies(conn, movie_id,
+                                                                                           engine=quantized),
+                                 [(movie_id,) for movie_id in movie_ids])
+                result['recall'] = quantized.recall(movie_ids, reference=engine)
+                result['memory_bytes'] = quantized.nbytes
+                results[f'find_similar_movies_{dtype}'] = result
+                # Unmap the snapshot before its directory is removed
+                del quantized
+    finally:
+        conn.close()
+
+    report = {
+        'config': {'documents': n_documents, 'queries': n_queries, 'build_runs': build_runs, 'seed': seed},
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'sqlite': sqlite3.sqlite_version,
+            'numpy': np.__version__,
+            'scipy': scipy.__version__,
+            'sklearn': sklearn.__version__,
+        },
+        'results': results,
+        # Memory of the float64 CSR matrix the quantized engines compare against
+        'matrix_bytes': int(engine.matrix.data.nbytes + engine.matrix.indices.nbytes + engine.matrix.indptr.nbytes),
+    }
+    if resource is not None:
+        # Peak resident set size of the whole run, in kilobytes on Linux
+        report['max_rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return report
+
+
+def compare_results(baseline, current, tolerance=REGRESSION_TOLERANCE):
+    """
+    Compare two benchmark runs.
+
+    Returns:
+        list: (benchmark, baseline p50, current p50) of every benchmark whose p50
+            grew by more than the tolerance factor.
+    """
+    regressions = []
+    for name, result in current['results'].items():
+        previous = baseline['results'].get(name)
+        if previous and result['p50_ms'] > previous['p50_ms'] * tolerance:
+            regressions.append((name, previous['p50_ms'], result['p50_ms']))
+    return regressions
+
+
+def main():
+    """main function to execute the benchmarks"""
+    parser = argparse.ArgumentParser(description="Benchmark indexing and queries on a synthetic corpus.")
+    parser.add_argument('--documents', type=int, default=BENCHMARK_DOCUMENTS,
+                        help=f"number of synthetic plot summaries (default: {BENCHMARK_DOCUMENTS})")
+    parser.add_argument('--queries', type=int, default=BENCHMARK_QUERIES,
+                        help=f"timed runs of every query benchmark (default: {BENCHMARK_QUERIES})")
+    parser.add_argument('--build-runs', type=int, default=BENCHMARK_BUILD_RUNS,
+                        help=f"timed runs of every build benchmark (default: {BENCHMARK_BUILD_RUNS})")
+    parser.add_argument('--seed', type=int, default=0, help="seed of the synthetic corpus (default: 0)")
+    parser.add_argument('--db', help="new SQLite file for the corpus, an existing file is refused "
+                                     "(default: a temporary file)")
+    parser.add_argument('--output', default='benchmark_results.json',
+                        help="JSON file to write the results to (default: benchmark_results.json)")
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help="JSON results of an earlier run to check for regressions")
+    parser.add_argument('--tolerance', type=float, default=REGRESSION_TOLERANCE,
+                        help=f"allowed p50 slowdown factor against the baseline (default: {REGRESSION_TOLERANCE})")
+    args = parser.parse_args()
+    if args.db and os.path.exists(args.db):
+        parser.error(f"--db {args.db} already exists, the benchmark only writes to a new file")
+
+    with tempfile.TemporaryDirectory() as directory:
+        db_path = args.db or os.path.join(directory, 'benchmark.db')
+        results = run_benchmarks(db_path, args.documents, args.queries, args.build_runs, args.seed)
+    with open(args.output, 'w', encoding='utf-8') as output_file:
+        json.dump(results, output_file, indent=2)
+
+    for name, result in results['results'].items():
+        print(f"{name:28} p50 {result['p50_ms']:9.2f} ms  p95 {result['p95_ms']:9.2f} ms  "
+              f"p99 {result['p99_ms']:9.2f} ms  peak {result['peak_memory_bytes'] / 2**20:8.1f} MiB")
+        if 'recall' in result:
+            print(f"{'':28} recall@10 {result['recall']:.3f}  vectors {result['memory_bytes'] / 2**20:.1f} MiB "
+                  f"(float64 matrix {results['matrix_bytes'] / 2**20:.1f} MiB)")
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as baseline_file:
+            regressions = compare_results(json.load(baseline_file), results, args.tolerance)
+        for name, before, after in regressions:
+            print(f"Regression in {name}: p50 {before:.2f} ms -> {after:.2f} ms")
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
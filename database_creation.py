@@ -1,37 +1,215 @@
 """
     Creates a SQLite database and loads data from CSV and TXT files.
 """
+import argparse
 import sqlite3
 import pandas as pd
 
-def create_database(metadata_csv_path, plot_summaries_txt_path, db_path):
+# Number of CSV/TSV rows parsed and inserted at a time
+INGEST_CHUNK_SIZE = 10_000
+
+# Connection settings used while loading, the database is rebuilt from the sources anyway
+INGEST_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'OFF',
+    'cache_size': -262144,  # 256 MiB
+    'temp_store': 'MEMORY',
+}
+
+METADATA_COLUMNS = [
+    "wikipedia_movie_id", "freebase_movie_id", "movie_name",
+    "movie_release_date", "movie_box_office_revenue", "movie_runtime",
+    "movie_languages", "movie_countries", "movie_genres"
+]
+
+# Column types of the metadata CSV, release dates mix full dates and bare years
+METADATA_DTYPES = {
+    "wikipedia_movie_id": "Int64",
+    "freebase_movie_id": "string",
+    "movie_name": "string",
+    "movie_release_date": "string",
+    "movie_box_office_revenue": "float64",
+    "movie_runtime": "float64",
+    "movie_languages": "string",
+    "movie_countries": "string",
+    "movie_genres": "string",
+}
+
+def create_movies_table(cur):
+    """
+        Create the typed movies table keyed by wikipedia_movie_id, replacing an existing one.
+
+        Parameters:
+            cur (Cursor): A cursor of the SQLite database.
+    """
+    cur.execute("DROP TABLE IF EXISTS movies")
+    cur.execute("""
+        CREATE TABLE movies (
+            wikipedia_movie_id INTEGER PRIMARY KEY,
+            freebase_movie_id TEXT,
+            movie_name TEXT,
+            movie_release_date TEXT,
+            movie_box_office_revenue REAL,
+            movie_runtime REAL,
+            movie_languages TEXT,
+            movie_countries TEXT,
+            movie_genres TEXT
+        )
+    """)
+
+def create_tables(cur):
+    """
+        Create the typed movies and plot_summaries tables keyed by wikipedia_movie_id.
+
+        Parameters:
+            cur (Cursor): A cursor of the SQLite database.
+    """
+    create_movies_table(cur)
+    cur.execute("DROP TABLE IF EXISTS plot_summaries")
+    cur.execute("""
+        CREATE TABLE plot_summaries (
+            wikipedia_movie_id INTEGER PRIMARY KEY,
+            plot_summary TEXT
+        )
+    """)
+
+def create_indexes(cur):
+    """
+        Create the secondary indexes, after the bulk load so they are built in one pass.
+
+        Parameters:
+            cur (Cursor): A cursor of the SQLite database.
+    """
+    # NOCASE gives case-insensitive title searches their order without a sort
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_movies_name ON movies(movie_name COLLATE NOCASE)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_movies_freebase ON movies(freebase_movie_id)")
+
+def iter_rows(chunk):
+    """
+        Convert a DataFrame chunk into tuples of Python values with None for missing values.
+
+        Parameters:
+            chunk (DataFrame): Rows parsed from a source file.
+
+        Returns:
+            iterator: One tuple per row.
+    """
+    chunk = chunk.astype(object).where(chunk.notna(), None)
+    return chunk.itertuples(index=False, name=None)
+
+def load_chunks(cur, table, chunks):
+    """
+        Insert DataFrame chunks into a table.
+        Rows without a wikipedia_movie_id are skipped, and a repeated ID keeps its last row.
+
+        Parameters:
+            cur (Cursor): A cursor of the SQLite database.
+            table (str): Name of the table to fill.
+            chunks (iterable): DataFrames whose columns match the table.
+
+        Returns:
+            int: Number of rows read.
+    """
+    n_rows = 0
+    for chunk in chunks:
+        chunk = chunk.dropna(subset=["wikipedia_movie_id"])
+        placeholders = ', '.join(['?'] * len(chunk.columns))
+        cur.executemany(f"INSERT OR REPLACE INTO {table} ({', '.join(chunk.columns)}) VALUES ({placeholders})",
+                        iter_rows(chunk))
+        n_rows += len(chunk)
+    return n_rows
+
+def create_database(metadata_csv_path, plot_summaries_txt_path, db_path, chunk_size=INGEST_CHUNK_SIZE):
     """
         Parameters:
             metadata_csv_path (str): Path to the CSV file containing movie metadata.
             plot_summaries_txt_path (str): Path to the TXT file containing plot summaries of movies.
             db_path (str): Path to save the SQLite database.
+            chunk_size (int): Number of rows parsed and inserted at a time.
 
         Returns:
             str: Path to the created SQLite database.
     """
-    metadata_df = pd.read_csv(metadata_csv_path, header=None, names=[
-        "wikipedia_movie_id", "freebase_movie_id", "movie_name",
-        "movie_release_date", "movie_box_office_revenue", "movie_runtime",
-        "movie_languages", "movie_countries", "movie_genres"
-    ])
+    metadata_chunks = pd.read_csv(metadata_csv_path, header=None, names=METADATA_COLUMNS,
+                                  dtype=METADATA_DTYPES, chunksize=chunk_size)
 
-    summaries_df = pd.read_csv(
+    summaries_chunks = pd.read_csv(
         plot_summaries_txt_path,
         header=None,
         names=["wikipedia_movie_id", "plot_summary"],
-        sep='\t'
+        dtype={"wikipedia_movie_id": "Int64", "plot_summary": "string"},
+        sep='\t',
+        chunksize=chunk_size
     )
 
     conn = sqlite3.connect(db_path)
+    cur = conn.cursor()
+    for name, value in INGEST_PRAGMAS.items():
+        cur.execute(f"PRAGMA {name}={value}")
+
+    # Everything is loaded in a single transaction, committed once at the end
+    create_tables(cur)
+    load_chunks(cur, 'movies', metadata_chunks)
+    load_chunks(cur, 'plot_summaries', summaries_chunks)
+    create_indexes(cur)
+    conn.commit()
 
-    metadata_df.to_sql('movies', conn, if_exists='replace', index=False)
-    summaries_df.to_sql('plot_summaries', conn, if_exists='replace', index=False)
+    create_title_index(conn)
+    cur.execute("PRAGMA synchronous=FULL")
+    # Table and index statistics for the query planner
+    cur.execute("ANALYZE")
+    conn.commit()
 
     conn.close()
 
     return db_path
+
+def has_integer_key(cur, table):
+    """
+        Check whether wikipedia_movie_id is the INTEGER PRIMARY KEY of a table, which makes it the rowid.
+
+        Parameters:
+            cur (Cursor): A cursor of the SQLite database.
+            table (str): Name of the table.
+    """
+    cur.execute(f"PRAGMA table_info({table})")
+    return any(name == 'wikipedia_movie_id' and column_type.upper() == 'INTEGER' and primary_key == 1
+               for _, name, column_type, _, _, primary_key in cur.fetchall())
+
+def create_title_index(conn):
+    """
+        Build the FTS5 trigram index over movie titles used by main.search_titles.
+
+        Parameters:
+            conn (Connection): A connection object to the SQLite database.
+    """
+    cur = conn.cursor()
+    cur.execute("DROP TABLE IF EXISTS movie_titles")
+    # Trigrams give case-insensitive substring and prefix matching through the index
+    cur.execute("CREATE VIRTUAL TABLE movie_titles USING fts5(movie_name, tokenize='trigram')")
+    cur.execute("""
+        INSERT INTO movie_titles (rowid, movie_name)
+        SELECT wikipedia_movie_id, movie_name FROM movies WHERE movie_name IS NOT NULL
+    """)
+    cur.execute("INSERT INTO movie_titles (movie_titles) VALUES ('optimize')")
+    # Search results are joined back to movies by ID, which needs an index
+    # unless the ID is already the rowid of a table from create_database
+    if not has_integer_key(cur, 'movies'):
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_movies_id ON movies(wikipedia_movie_id)")
+    conn.commit()
+
+def main():
+    """main function to create the database from the source files"""
+    parser = argparse.ArgumentParser(description="Create the movies database from the source files.")
+    parser.add_argument('--metadata', default='sources/movie_metadata.csv',
+                        help="movie metadata CSV (default: sources/movie_metadata.csv)")
+    parser.add_argument('--plot-summaries', default='sources/plot_summaries.txt',
+                        help="plot summaries TSV (default: sources/plot_summaries.txt)")
+    parser.add_argument('--db', default='movies.db', help="SQLite database to create (default: movies.db)")
+    parser.add_argument('--chunk-size', type=int, default=INGEST_CHUNK_SIZE,
+                        help=f"rows parsed and inserted at a time (default: {INGEST_CHUNK_SIZE})")
+    args = parser.parse_args()
+    create_database(args.metadata, args.plot_summaries, args.db, args.chunk_size)
+
+if __name__ == "__main__":
+    main()
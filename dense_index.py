@@ -0,0 +1,217 @@
+"""
+Dense embedding mode of the Vector Model Application.
+The TF-IDF matrix is reduced with TruncatedSVD (latent semantic analysis) to a
+few hundred L2-normalised float32 dimensions, which also relates movies whose
+plots use different words for the same things. The embeddings are grouped into
+inverted lists around spherical k-means centroids (IVF), so a query only scores
+the movies of the n_probe lists closest to it, at a fixed cost per query.
+"""
+
+import json
+import sqlite3
+import numpy as np
+from sklearn.decomposition import TruncatedSVD
+from metrics import timed
+from similarity_engine import top_n_indices
+from tfidf_storage import get_build_id
+
+EMBEDDING_DTYPE = np.dtype('<f4')
+
+# Default number of SVD dimensions and inverted lists probed per query
+EMBEDDING_DIMENSIONS = 256
+DENSE_N_PROBE = 8
+
+# Spherical k-means iterations and rows assigned to the centroids at a time
+KMEANS_ITERATIONS = 10
+ASSIGN_BLOCK_SIZE = 65_536
+
+
+def normalize_rows(matrix):
+    """ Scale every row to unit length, leaving zero rows as they are """
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return np.divide(matrix, norms, out=np.zeros_like(matrix), where=norms > 0)
+
+
+def fit_embeddings(tfidf_matrix, dimensions=EMBEDDING_DIMENSIONS, random_state=0):
+    """
+    Reduce a TF-IDF matrix to L2-normalised dense embeddings.
+
+    Parameters:
+        tfidf_matrix (csr_matrix): TF-IDF matrix with one row per movie.
+        dimensions (int): Number of SVD components, capped below the matrix size.
+        random_state (int): Seed of the randomized SVD.
+
+    Returns:
+        ndarray: float32 embeddings with one row per movie.
+    """
+    dimensions = min(dimensions, min(tfidf_matrix.shape) - 1)
+    if dimensions < 1:
+        raise ValueError("The TF-IDF matrix is too small for a dense embedding")
+    svd = TruncatedSVD(n_components=dimensions, random_state=random_state)
+    return normalize_rows(svd.fit_transform(tfidf_matrix).astype(np.float32))
+
+
+def default_list_count(n_rows):
+    """ Number of inverted lists for a corpus, about the square root of its size """
+    return max(1, int(np.sqrt(n_rows)))
+
+
+def assign_lists(embeddings, centroids, block_size=ASSIGN_BLOCK_SIZE):
+    """ Return the index of the closest centroid of every embedding """
+    assignments = np.empty(len(embeddings), dtype=np.int64)
+    for start in range(0, len(embeddings), block_size):
+        block = embeddings[start:start + block_size]
+        assignments[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+    return assignments
+
+
+def train_lists(embeddings, n_lists, iterations=KMEANS_ITERATIONS, random_state=0):
+    """
+    Cluster embeddings with spherical k-means.
+
+    Returns:
+        tuple: (float32 unit-length centroids, list index of every embedding)
+    """
+    n_lists = min(n_lists, len(embeddings))
+    rng = np.random.default_rng(random_state)
+    centroids = embeddings[rng.choice(len(embeddings), n_lists, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = assign_lists(embeddings, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, embeddings)
+        # A list that lost all its members keeps its previous centroid
+        filled = np.bincount(assignments, minlength=n_lists) > 0
+        centroids[filled] = normalize_rows(sums[filled])
+    return centroids, assign_lists(embeddings, centroids)
+
+
+class DenseIndex:
+    """ Approximate cosine similarity search over dense embeddings in inverted lists """
+
+    def __init__(self, embeddings, movie_ids, centroids, assignments, build_id=None, n_probe=DENSE_N_PROBE):
+        self.build_id = build_id
+        self.n_probe = n_probe
+        self.embeddings = np.asarray(embeddings, dtype=np.float32)
+        self.movie_ids = np.asarray(movie_ids, dtype=np.int64)
+        self.rows = {int(movie_id): row for row, movie_id in enumerate(self.movie_ids.tolist())}
+        self.centroids = np.asarray(centroids, dtype=np.float32)
+        self.assignments = np.asarray(assignments, dtype=np.int64)
+        # Rows grouped by list, list i spans list_rows[list_offsets[i]:list_offsets[i + 1]]
+        self.list_rows = np.argsort(self.assignments, kind='stable')
+        self.list_offsets = np.searchsorted(self.assignments[self.list_rows], np.arange(len(self.centroids) + 1))
+
+    @classmethod
+    def build(cls, embeddings, movie_ids, n_lists=None, build_id=None, n_probe=DENSE_N_PROBE):
+        """ Train the inverted lists of a set of embeddings """
+        if n_lists is None:
+            n_lists = default_list_count(len(embeddings))
+        centroids, assignments = train_lists(embeddings, n_lists)
+        return cls(embeddings, movie_ids, centroids, assignments, build_id, n_probe)
+
+    @classmethod
+    def from_connection(cls, conn, n_probe=DENSE_N_PROBE):
+        """
+        Load the dense index saved by save_dense_index.
+
+        Raises:
+            ValueError: If no dense index is stored or it belongs to another build of the vectors.
+        """
+        cur = conn.cursor()
+        build_id = get_build_id(cur)
+        try:
+            cur.execute("SELECT value FROM tfidf_settings WHERE name='dense'")
+            row = cur.fetchone()
+        except sqlite3.OperationalError:
+            row = None
+        if row is None or json.loads(row[0])['build_id'] != build_id:
+            raise ValueError("No dense index for the current build, run vector_model.py --dense first.")
+        settings = json.loads(row[0])
+
+        cur.execute("SELECT centroid FROM dense_centroids ORDER BY list_id")
+        centroids = np.array([np.frombuffer(blob, dtype=EMBEDDING_DTYPE) for blob, in cur.fetchall()])
+        cur.execute("SELECT wikipedia_movie_id, list_id, embedding FROM dense_vectors ORDER BY wikipedia_movie_id")
+        rows = cur.fetchall()
+        embeddings = np.frombuffer(b''.join(row[2] for row in rows), dtype=EMBEDDING_DTYPE)
+        return cls(embeddings.reshape(len(rows), settings['dimensions']),
+                   [row[0] for row in rows], centroids, [row[1] for row in rows],
+                   build_id, n_probe)
+
+    def __len__(self):
+        return len(self.movie_ids)
+
+    def __contains__(self, wikipedia_movie_id):
+        return wikipedia_movie_id in self.rows
+
+    def candidates(self, vector):
+        """ Return the rows of the n_probe lists whose centroids are closest to a query """
+        n_probe = min(self.n_probe, len(self.centroids))
+        closest = np.argpartition(-(self.centroids @ vector), n_probe - 1)[:n_probe]
+        return np.concatenate([self.list_rows[self.list_offsets[i]:self.list_offsets[i + 1]]
+                               for i in closest])
+
+    def similar_to_vector(self, vector, top_n=5, exclude_row=None, mask=None):
+        """
+        Find approximately the top_n movies most similar to a unit-length embedding.
+        mask, a boolean array over the rows, restricts the candidates of the probed lists.
+        """
+        vector = np.asarray(vector, dtype=np.float32)
+        with timed('query.score', mode='dense'):
+            rows = self.candidates(vector)
+            if exclude_row is not None:
+                rows = rows[rows != exclude_row]
+            if mask is not None:
+                rows = rows[mask[rows]]
+            scores = self.embeddings[rows] @ vector
+        with timed('query.sort', mode='dense'):
+            best = top_n_indices(scores, top_n)
+        return [(int(self.movie_ids[rows[i]]), float(scores[i])) for i in best]
+
+    def similar_movies(self, wikipedia_movie_id, top_n=5, mask=None):
+        """
+        Find approximately the top_n movies most similar to the given movie, among the rows of mask if given.
+
+        Returns:
+            list: (wikipedia_movie_id, similarity) pairs sorted by descending similarity.
+        """
+        row = self.rows.get(wikipedia_movie_id)
+        if row is None:
+            return []
+        return self.similar_to_vector(self.embeddings[row], top_n, exclude_row=row, mask=mask)
+
+
+def save_dense_index(conn, index):
+    """
+    Store the embeddings and centroids of a dense index.
+
+    Parameters:
+        conn (Connection): A connection object to the SQLite database.
+        index (DenseIndex): Index built from the vectors of the current build.
+    """
+    cur = conn.cursor()
+    cur.execute("DROP TABLE IF EXISTS dense_vectors")
+    cur.execute("DROP TABLE IF EXISTS dense_centroids")
+    cur.execute("""
+        CREATE TABLE dense_vectors (
+            wikipedia_movie_id INTEGER PRIMARY KEY,
+            list_id INTEGER NOT NULL,
+            embedding BLOB NOT NULL
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE dense_centroids (
+            list_id INTEGER PRIMARY KEY,
+            centroid BLOB NOT NULL
+        )
+    """)
+    cur.executemany("INSERT INTO dense_vectors VALUES (?, ?, ?)",
+                    ((int(movie_id), int(list_id), embedding.astype(EMBEDDING_DTYPE).tobytes())
+                     for movie_id, list_id, embedding
+                     in zip(index.movie_ids, index.assignments, index.embeddings)))
+    cur.executemany("INSERT INTO dense_centroids VALUES (?, ?)",
+                    ((list_id, centroid.astype(EMBEDDING_DTYPE).tobytes())
+                     for list_id, centroid in enumerate(index.centroids)))
+    settings = {'build_id': index.build_id, 'dimensions': index.embeddings.shape[1],
+                'lists': len(index.centroids)}
+    cur.execute("INSERT OR REPLACE INTO tfidf_settings (name, value) VALUES ('dense', ?)",
+                (json.dumps(settings),))
+    conn.commit()
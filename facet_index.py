@@ -0,0 +1,152 @@
+"""
+Metadata facets of the Vector Model Application as bitmaps over engine rows.
+Genres, languages and countries are comma-joined in the movies table and the
+release date is free text, so filtering similar movies by them would mean a
+LIKE scan per candidate. FacetIndex normalizes them once, when the engine is
+loaded, into one packed bitset per facet value, aligned with the rows of the
+similarity engine. A filter is combined into a boolean row mask that the
+engines apply in their scoring step, before the top N are selected.
+"""
+
+import json
+import numpy as np
+
+# Number of movies rows read at a time while building the index
+FACET_FETCH_SIZE = 10_000
+
+# Facets of the index and the movies column each is read from
+FACET_COLUMNS = {
+    'genre': 'movie_genres',
+    'language': 'movie_languages',
+    'country': 'movie_countries',
+    'decade': 'movie_release_date',
+}
+
+
+def split_values(field):
+    """ Split a comma-joined metadata field, or the raw Freebase JSON object, into its values """
+    if not field:
+        return []
+    if field.startswith('{'):
+        try:
+            return list(json.loads(field).values())
+        except json.JSONDecodeError:
+            return []
+    return [value.strip() for value in field.split(',') if value.strip()]
+
+
+def release_decade(release_date):
+    """ Decade of a release date like '1994-05-12' or '1994', or None if it has no year """
+    year = str(release_date or '')[:4]
+    return int(year) // 10 * 10 if len(year) == 4 and year.isdigit() else None
+
+
+def normalize_filters(filters):
+    """
+    Turn a filter into a hashable, canonical form, usable as a cache key.
+    Values of one facet match any of them, and every facet must match.
+
+    Parameters:
+        filters (dict): Facet name to one value or an iterable of values,
+            e.g. {'genre': 'Comedy', 'decade': [1990, 2000]}.
+
+    Returns:
+        tuple: Sorted (facet, sorted values) pairs.
+
+    Raises:
+        ValueError: If a facet is unknown or a decade is not a number.
+    """
+    normalized = []
+    for facet, values in (filters or {}).items():
+        if facet not in FACET_COLUMNS:
+            raise ValueError(f"Unknown facet: {facet}")
+        if isinstance(values, (str, int)):
+            values = [values]
+        if facet == 'decade':
+            values = [int(value) // 10 * 10 for value in values]
+        normalized.append((facet, tuple(sorted(set(values)))))
+    return tuple(sorted(normalized))
+
+
+class FacetIndex:
+    """ Packed bitset of the engine rows of every facet value """
+
+    def __init__(self, movie_ids, bitmaps):
+        self.movie_ids = np.asarray(movie_ids, dtype=np.int64)
+        self.bitmaps = bitmaps
+
+    @classmethod
+    def from_connection(cls, conn, movie_ids):
+        """
+        Build the facets of the movies table for the rows of an engine.
+        Facets whose column is missing from the table are left empty.
+
+        Parameters:
+            conn (Connection): A connection object to the SQLite database.
+            movie_ids (array): wikipedia_movie_id of every engine row.
+        """
+        movie_ids = np.asarray(movie_ids, dtype=np.int64)
+        rows = {movie_id: row for row, movie_id in enumerate(movie_ids.tolist())}
+        cur = conn.cursor()
+        cur.execute("PRAGMA table_info(movies)")
+        present = {row[1] for row in cur.fetchall()}
+        facets = [facet for facet, column in FACET_COLUMNS.items() if column in present]
+
+        value_rows = {facet: {} for facet in FACET_COLUMNS}
+        columns = ', '.join(FACET_COLUMNS[facet] for facet in facets)
+        cur.execute(f"SELECT wikipedia_movie_id{', ' + columns if columns else ''} FROM movies")
+        while batch := cur.fetchmany(FACET_FETCH_SIZE):
+            for movie_id, *fields in batch:
+                row = rows.get(movie_id)
+                if row is None:
+                    continue
+                for facet, field in zip(facets, fields):
+                    values = [release_decade(field)] if facet == 'decade' else split_values(field)
+                    for value in values:
+                        if value is not None:
+                            value_rows[facet].setdefault(value, []).append(row)
+
+        bitmaps = {}
+        for facet, by_value in value_rows.items():
+            bitmaps[facet] = {}
+            for value, value_row_list in by_value.items():
+                mask = np.zeros(len(movie_ids), dtype=bool)
+                mask[value_row_list] = True
+                bitmaps[facet][value] = np.packbits(mask)
+        return cls(movie_ids, bitmaps)
+
+    def __len__(self):
+        return len(self.movie_ids)
+
+    def values(self, facet):
+        """ Sorted values of a facet """
+        return sorted(self.bitmaps[facet])
+
+    def bitmap(self, facet, value):
+        """ Boolean row mask of one facet value, all False for an unknown value """
+        packed = self.bitmaps[facet].get(value)
+        if packed is None:
+            return np.zeros(len(self.movie_ids), dtype=bool)
+        return np.unpackbits(packed, count=len(self.movie_ids)).view(bool)
+
+    def mask(self, filters):
+        """
+        Boolean mask of the engine rows matching a filter.
+
+        Parameters:
+            filters (dict or tuple): Filter as accepted by normalize_filters, or its normalized form.
+
+        Returns:
+            ndarray: True for the rows to keep, or None when the filter is empty.
+        """
+        if isinstance(filters, dict):
+            filters = normalize_filters(filters)
+        if not filters:
+            return None
+        mask = np.ones(len(self.movie_ids), dtype=bool)
+        for facet, values in filters:
+            facet_mask = np.zeros(len(self.movie_ids), dtype=bool)
+            for value in values:
+                facet_mask |= self.bitmap(facet, value)
+            mask &= facet_mask
+        return mask
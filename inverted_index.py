@@ -0,0 +1,147 @@
+"""
+Inverted-index similarity search for the Vector Model Application.
+Keeps a term -> postings view of the TF-IDF matrix so that a query only touches
+the documents sharing a term with it. Max-score pruning limits the candidates to
+the postings of the query's high-impact terms once the remaining terms can no
+longer lift an unseen document into the top N. Scores are only accumulated for
+the rows of the visited postings, so a query costs in the length of its postings
+rather than in the size of the corpus. The service loads it with --inverted.
+"""
+
+import heapq
+import numpy as np
+from metrics import timed
+from similarity_engine import SimilarityEngine, top_n_indices
+
+
+def merge_candidates(rows, scores, other_rows=None, other_scores=None):
+    """
+    Sum the scores of candidate rows, adding a second set of candidates if given.
+
+    Returns:
+        tuple: (rows, scores) arrays, rows sorted and unique.
+    """
+    if other_rows is not None:
+        rows, scores = np.concatenate([rows, other_rows]), np.concatenate([scores, other_scores])
+    unique_rows, positions = np.unique(rows, return_inverse=True)
+    return unique_rows, np.bincount(positions, weights=scores, minlength=len(unique_rows))
+
+
+class InvertedIndex(SimilarityEngine):
+    """ Similarity engine that scores candidates from term postings """
+
+    def __init__(self, matrix, movie_ids, norms=None, build_id=None):
+        super().__init__(matrix, movie_ids, norms, build_id)
+        # Postings hold length-normalised weights, so the dot product is the cosine
+        self.inverse_norms = np.divide(1.0, self.norms, out=np.zeros_like(self.norms), where=self.norms > 0)
+        self.postings = self.matrix.multiply(self.inverse_norms[:, np.newaxis]).tocsc()
+        self.postings.sort_indices()
+        self.max_weights = np.zeros(self.postings.shape[1])
+        non_empty = np.flatnonzero(np.diff(self.postings.indptr))
+        if non_empty.size:
+            self.max_weights[non_empty] = np.maximum.reduceat(self.postings.data,
+                                                              self.postings.indptr[non_empty])
+
+    def get_postings(self, tfidf_index):
+        """ Return the (rows, normalised weights) posting list of a term """
+        if tfidf_index >= len(self.max_weights):
+            return self.postings.indices[:0], self.postings.data[:0]
+        start, end = self.postings.indptr[tfidf_index], self.postings.indptr[tfidf_index + 1]
+        return self.postings.indices[start:end], self.postings.data[start:end]
+
+    def similar_to_terms(self, terms, weights, top_n=5, exclude_row=None, mask=None):
+        """
+        Find the top_n movies most similar to a sparse query.
+
+        Parameters:
+            terms (array): TF-IDF column indices of the query.
+            weights (array): Query weights for those columns.
+            top_n (int): Number of results to return.
+            exclude_row (int): Matrix row to leave out of the results.
+            mask (array): Boolean array over the rows, results are restricted to the rows where it is True.
+
+        Returns:
+            list: (wikipedia_movie_id, similarity) pairs sorted by descending similarity.
+        """
+        terms = np.asarray(terms, dtype=np.int64)
+        weights = np.asarray(weights, dtype=np.float64)
+        in_vocabulary = terms < len(self.max_weights)
+        terms, weights = terms[in_vocabulary], weights[in_vocabulary]
+        query_norm = np.sqrt(np.dot(weights, weights))
+        if top_n <= 0 or query_norm == 0:
+            return []
+        weights = weights / query_norm
+
+        with timed('query.score'):
+            # Visit terms by their best possible contribution, highest first
+            bounds = weights * self.max_weights[terms]
+            order = np.argsort(-bounds, kind='stable')
+            terms, weights = terms[order], weights[order]
+            remaining = np.append(np.cumsum(bounds[order][::-1])[::-1], 0.0)[1:]
+
+            # Accumulate the essential terms in growing blocks until the terms left
+            # over cannot lift a document outside the candidates above the N-th score.
+            # Scores are kept for the posting rows seen so far only, sorted by row
+            rows = np.empty(0, dtype=np.int64)
+            scores = np.empty(0)
+            threshold = 0.0
+            visited = 0
+            block = 1
+            while visited < len(terms):
+                block_rows, block_scores = self.accumulate(terms[visited:visited + block],
+                                                           weights[visited:visited + block],
+                                                           exclude_row, mask)
+                rows, scores = merge_candidates(rows, scores, block_rows, block_scores)
+                visited += block
+                block *= 2
+                if visited < len(terms) and len(rows) >= top_n:
+                    # N-th best candidate score from a size-N heap over the candidates
+                    threshold = heapq.nlargest(top_n, scores.tolist())[-1]
+                    if remaining[visited - 1] < threshold:
+                        break
+            if visited < len(terms):
+                # Finish the surviving candidates from their own rows, never
+                # touching the long postings of the non-essential terms
+                alive = scores + remaining[visited - 1] >= threshold
+                rows, scores = rows[alive], scores[alive]
+                query = np.zeros(len(self.max_weights))
+                query[terms[visited:]] = weights[visited:]
+                scores += self.matrix[rows].dot(query) * self.inverse_norms[rows]
+
+        with timed('query.sort'):
+            best = top_n_indices(scores, top_n)
+        return [(int(self.movie_ids[rows[index]]), float(scores[index])) for index in best]
+
+    def accumulate(self, terms, weights, exclude_row=None, mask=None):
+        """
+        Score the posting rows of a block of query terms.
+
+        Returns:
+            tuple: (rows, scores) arrays, rows sorted and unique.
+        """
+        starts, ends = self.postings.indptr[terms], self.postings.indptr[terms + 1]
+        rows = np.concatenate([self.postings.indices[start:end] for start, end in zip(starts, ends)])
+        contributions = np.concatenate([self.postings.data[start:end] * weight
+                                        for start, end, weight in zip(starts, ends, weights)])
+        # Filtered rows never become candidates nor raise the threshold
+        keep = np.ones(len(rows), dtype=bool)
+        if exclude_row is not None:
+            keep &= rows != exclude_row
+        if mask is not None:
+            keep &= mask[rows]
+        return merge_candidates(rows[keep].astype(np.int64), contributions[keep])
+
+    def similar_movies(self, wikipedia_movie_id, top_n=5, mask=None):
+        """
+        Find the top_n movies most similar to the given movie, among the rows of mask if given.
+
+        Returns:
+            list: (wikipedia_movie_id, similarity) pairs sorted by descending similarity.
+        """
+        row = self.rows.get(wikipedia_movie_id)
+        if row is None:
+            return []
+        start, end = self.matrix.indptr[row], self.matrix.indptr[row + 1]
+        return self.similar_to_terms(self.matrix.indices[start:end],
+                                     self.matrix.data[start:end],
+                                     top_n, exclude_row=row, mask=mask)
@@ -1,13 +1,37 @@
 """
-        Format JSON field to a human-readable string.
+        Convert the movie metadata TSV, whose language, country and genre columns
+        are JSON objects, into human-readable comma-separated values.
+        The input is streamed in chunks, optionally converted in parallel processes,
+        and written either to a CSV file or directly into the movies table.
+        Importing this module has no side effects, run it as a script to convert.
 """
+import argparse
 import csv
 import json
+import sqlite3
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import islice
+from database_creation import INGEST_PRAGMAS, create_indexes, create_movies_table, create_title_index
 
 tsv_file_path = 'sources/movie_metadata.tsv'
 csv_file_path = 'sources/movie_metadata.csv'
 
+# Number of TSV rows converted at a time and handed to a worker process
+CONVERT_CHUNK_SIZE = 10_000
+
+# Chunks submitted ahead per worker process, bounding the rows held in memory
+IN_FLIGHT_PER_WORKER = 2
+
+# Distinct JSON fields whose formatted value is memoized, the columns repeat heavily
+FORMAT_CACHE_SIZE = 65_536
+
+# Number of columns of a metadata row
+METADATA_WIDTH = 9
 
+
+@lru_cache(maxsize=FORMAT_CACHE_SIZE)
 def format_json_field(field):
     """
         Format JSON field to a human-readable string.
@@ -27,19 +51,168 @@ def format_json_field(field):
         return None
 
 
-# Opening the original TSV file and creating a new CSV file
-with open(tsv_file_path, 'r', encoding='utf-8') as tsv_file, open(csv_file_path, 'w', newline='',
-                                                                  encoding='utf-8') as csv_file:
-    tsv_reader = csv.reader(tsv_file, delimiter='\t')
-    csv_writer = csv.writer(csv_file)
+def convert_row(row):
+    """
+        Replace the JSON language, country and genre fields of a metadata row.
+
+        Parameters:
+            row (list): The nine TSV fields of one movie.
+
+        Returns:
+            list: The row with human-readable strings instead of JSON.
+    """
+    return row[:6] + [format_json_field(row[6]), format_json_field(row[7]), format_json_field(row[8])]
+
+
+def convert_chunk(rows):
+    """ Convert a chunk of metadata rows, skipping rows with a wrong number of fields """
+    return [convert_row(row) for row in rows if len(row) == METADATA_WIDTH]
+
+
+def iter_chunks(rows, chunk_size=CONVERT_CHUNK_SIZE):
+    """ Group an iterable of rows into lists of chunk_size rows """
+    rows = iter(rows)
+    while chunk := list(islice(rows, chunk_size)):
+        yield chunk
+
+
+def convert_rows(rows, workers=1, chunk_size=CONVERT_CHUNK_SIZE):
+    """
+        Convert metadata rows chunk by chunk, optionally across processes.
+
+        Parameters:
+            rows (iterable): TSV rows as lists of fields.
+            workers (int): Number of worker processes, 1 converts in this process.
+            chunk_size (int): Number of rows converted at a time.
+
+        Yields:
+            list: Converted chunks in input order.
+    """
+    chunks = iter_chunks(rows, chunk_size)
+    if workers <= 1:
+        yield from map(convert_chunk, chunks)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # Executor.map would submit, and so read, every chunk up front. At most
+        # IN_FLIGHT_PER_WORKER chunks per worker are pending instead, and results
+        # are yielded oldest first, keeping the output in input order
+        pending = deque()
+        for chunk in chunks:
+            if len(pending) >= IN_FLIGHT_PER_WORKER * workers:
+                yield pending.popleft().result()
+            pending.append(executor.submit(convert_chunk, chunk))
+        while pending:
+            yield pending.popleft().result()
+
+
+def to_number(value, convert=float):
+    """ Convert a TSV field to a number, empty fields becoming None """
+    return convert(value) if value else None
+
+
+def parse_movie_id(value):
+    """ Parse a wikipedia_movie_id field, None for a blank or non-numeric ID """
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+
+def to_database_rows(chunk):
+    """
+        Type converted metadata rows for the movies table.
+        Rows without a valid wikipedia_movie_id are skipped, as in database_creation.load_chunks.
+
+        Parameters:
+            chunk (list): Converted metadata rows.
+
+        Returns:
+            list: Tuples matching the movies columns.
+    """
+    rows = []
+    for row in chunk:
+        movie_id = parse_movie_id(row[0])
+        if movie_id is None:
+            continue
+        rows.append((movie_id, row[1] or None, row[2] or None, row[3] or None,
+                     to_number(row[4]), to_number(row[5]), row[6], row[7], row[8]))
+    return rows
+
+
+def convert_to_csv(input_path, output_path, workers=1, chunk_size=CONVERT_CHUNK_SIZE):
+    """
+        Convert the metadata TSV into a CSV file.
+
+        Returns:
+            int: Number of rows written.
+    """
+    n_rows = 0
+    with open(input_path, 'r', encoding='utf-8') as tsv_file, open(output_path, 'w', newline='',
+                                                                   encoding='utf-8') as csv_file:
+        tsv_reader = csv.reader(tsv_file, delimiter='\t')
+        csv_writer = csv.writer(csv_file)
+        for chunk in convert_rows(tsv_reader, workers, chunk_size):
+            csv_writer.writerows(chunk)
+            n_rows += len(chunk)
+    return n_rows
+
+
+def convert_to_database(input_path, db_path, workers=1, chunk_size=CONVERT_CHUNK_SIZE):
+    """
+        Convert the metadata TSV directly into the movies table, replacing it.
+        The table is dropped and reloaded in one explicit transaction with bulk-load PRAGMAs,
+        so a failed conversion leaves the previous table intact. The indexes,
+        title index and planner statistics are rebuilt afterwards.
+
+        Returns:
+            int: Number of rows loaded.
+    """
+    conn = sqlite3.connect(db_path)
+    cur = conn.cursor()
+    for name, value in INGEST_PRAGMAS.items():
+        cur.execute(f"PRAGMA {name}={value}")
+    n_rows = 0
+    try:
+        # DDL does not open a transaction implicitly, without BEGIN the DROP would commit at once
+        cur.execute("BEGIN")
+        with open(input_path, 'r', encoding='utf-8') as tsv_file:
+            tsv_reader = csv.reader(tsv_file, delimiter='\t')
+            create_movies_table(cur)
+            for chunk in convert_rows(tsv_reader, workers, chunk_size):
+                rows = to_database_rows(chunk)
+                cur.executemany("INSERT OR REPLACE INTO movies VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+                n_rows += len(rows)
+        create_indexes(cur)
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        conn.close()
+        raise
+    create_title_index(conn)
+    cur.execute("PRAGMA synchronous=FULL")
+    cur.execute("ANALYZE")
+    conn.commit()
+    conn.close()
+    return n_rows
+
 
-    for row in tsv_reader:
-        # Processing Each JSON Field
-        languages = format_json_field(row[6])
-        countries = format_json_field(row[7])
-        genres = format_json_field(row[8])
+def main():
+    """main function to convert the metadata"""
+    parser = argparse.ArgumentParser(description="Convert the JSON columns of the movie metadata TSV.")
+    parser.add_argument('--input', default=tsv_file_path, help=f"metadata TSV (default: {tsv_file_path})")
+    parser.add_argument('--output', default=csv_file_path, help=f"CSV file to write (default: {csv_file_path})")
+    parser.add_argument('--db', help="write the movies table of this SQLite database instead of a CSV file")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="number of conversion processes (default: 1)")
+    parser.add_argument('--chunk-size', type=int, default=CONVERT_CHUNK_SIZE,
+                        help=f"rows per conversion task (default: {CONVERT_CHUNK_SIZE})")
+    args = parser.parse_args()
 
-        # Preparing a string for writing to CSV, replacing JSON with a human-readable string
-        row_to_write = row[:6] + [languages, countries, genres]
+    if args.db:
+        n_rows = convert_to_database(args.input, args.db, args.workers, args.chunk_size)
+    else:
+        n_rows = convert_to_csv(args.input, args.output, args.workers, args.chunk_size)
+    print(f"Converted {n_rows} movies.")
 
-        csv_writer.writerow(row_to_write)
+if __name__ == "__main__":
+    main()
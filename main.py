@@ -2,127 +2,196 @@
 Main file for the Vector Model Application
 """
 
-import time
+import logging
+import queue
+import threading
 import tkinter as tk
 import sqlite3
 from tkinter import scrolledtext, ttk, font
-from collections import defaultdict
 import customtkinter as ctk
-import numpy as np
 from PIL import Image
-
-def create_connection(db_file):
-    """ Create a connection to a SQLite database """
-    connection = None
-    try:
-        connection = sqlite3.connect(db_file)
-    except sqlite3.Error as e:
-        print(e)
-    return connection
-
-def search_movies(con, query):
-    """ Search movies by title """
-    cur = con.cursor()
-    cur.execute("""SELECT movie_name,
-                        movie_genres,
-                        movie_release_date,
-                        wikipedia_movie_id FROM movies
-                        WHERE movie_name LIKE ?""",
-                        ('%' + query + '%',))
-    return cur.fetchall()
-
-def load_initial_data(connection):
-    """ Loading initial data """
-    cur = connection.cursor()
-    cur.execute("""SELECT movie_name,
-                        movie_genres,
-                        movie_release_date,
-                        wikipedia_movie_id FROM movies
-                        ORDER BY wikipedia_movie_id DESC
-                        LIMIT 20""")
-    return cur.fetchall()
-
-def get_tfidf_vector(cur, wikipedia_movie_id):
-    """ Get the TF-IDF vector for a specific movie """
-    cur.execute("""SELECT tfidf_index, tfidf_value
-                   FROM sparse_tfidf
-                   WHERE wikipedia_movie_id=?""", (wikipedia_movie_id,))
-    return cur.fetchall()
-
-def calculate_norm(vector):
-    """ Calculate the norm of a TF-IDF vector """
-    return np.sqrt(sum(tfidf * tfidf for tfidf in vector.values()))
-
-def calculate_similarities(current_vector, norm_current, all_vectors, current_movie_id):
-    """ Calculate cosine similarities between the current movie and all other movies """
-    similarities = defaultdict(float)
-    norms = defaultdict(float)
-    for movie_id, idx, tfidf in all_vectors:
-        if movie_id != current_movie_id:
-            norms[movie_id] += tfidf * tfidf
-            if idx in current_vector:
-                similarities[movie_id] += tfidf * current_vector[idx]
-    for movie_id in similarities:
-        norms[movie_id] = np.sqrt(norms[movie_id])
-        similarities[movie_id] /= (norm_current * norms[movie_id])
-    return similarities
-
-def get_movie_names(cur, movie_ids):
-    """ Get movie names for the given movie IDs """
-    query_placeholders = ','.join(['?'] * len(movie_ids))
-    cur.execute(f"""SELECT wikipedia_movie_id, movie_name
-                    FROM movies
-                    WHERE wikipedia_movie_id IN ({query_placeholders})""", movie_ids)
-    return dict(cur.fetchall())
-
-def find_similar_movies(connection, wikipedia_movie_id, top_n=5):
-    """ Find similar movies based on TF-IDF """
-    start_time = time.time()
+from metrics import LoggingSink, add_sink
+# The query functions live in queries.py and are re-exported for existing callers
+from queries import (SEARCH_LIMIT, PAGE_SIZE, MODE_SPARSE, MODE_DENSE, create_connection,  # pylint: disable=W0611
+                     search_movies, has_title_index, search_titles, search_titles_page, count_titles, load_initial_data, get_tfidf_vector, calculate_norm,
+                     calculate_similarities, get_movie_names, load_engine, get_precomputed_neighbours,
+                     find_similar_movies, find_similar_movies_batch, search_by_text)
+from result_cache import LRUCache
+from tfidf_storage import get_build_id
+from vector_model import SNAPSHOT_DIR
+
+# How often the Tk main loop picks up finished background queries
+POLL_INTERVAL_MS = 30
+
+class QueryWorker:
+    """
+    Runs database and similarity queries on a background thread with its own
+    SQLite connection. Every job belongs to a channel and a newer job on the same
+    channel supersedes older ones: queued jobs are skipped and late results are
+    dropped. Results are handed back on the Tk thread by deliver().
+    """
+
+    def __init__(self, db_file, snapshot_dir=SNAPSHOT_DIR):
+        self.db_file = db_file
+        self.snapshot_dir = snapshot_dir
+        self.engine = None
+        self.cache = LRUCache()
+        self.jobs = queue.Queue()
+        self.results = queue.Queue()
+        self.latest = {}
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, name='query-worker', daemon=True)
+        self.thread.start()
+
+    def submit(self, channel, function, *args, callback):
+        """ Queue function(connection, *args), superseding earlier jobs of the channel """
+        self.jobs.put((channel, self.cancel(channel), function, args, callback))
+
+    def cancel(self, channel):
+        """ Supersede the queued and running jobs of a channel, returning the next ticket """
+        with self.lock:
+            ticket = self.latest.get(channel, 0) + 1
+            self.latest[channel] = ticket
+        return ticket
+
+    def is_current(self, channel, ticket):
+        """ Check whether a job is still the newest of its channel """
+        with self.lock:
+            return self.latest.get(channel) == ticket
+
+    def get_engine(self, connection):
+        """ Load the similarity engine on first use and again after the vectors were rebuilt """
+        if self.engine is None or self.engine.build_id != get_build_id(connection.cursor()):
+            self.engine = load_engine(connection, self.snapshot_dir)
+        return self.engine
+
+    def run(self):
+        """ Worker thread loop """
+        connection = create_connection(self.db_file)
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            channel, ticket, function, args, callback = job
+            if not self.is_current(channel, ticket):
+                continue
+            result, error = None, None
+            try:
+                result = function(connection, *args)
+            except Exception as query_err:  # pylint: disable=W0718
+                # Any failure goes to the callback, the thread has to outlive every job
+                error = query_err
+            self.results.put((channel, ticket, callback, result, error))
+        connection.close()
+
+    def deliver(self):
+        """ Run the callbacks of finished jobs that were not superseded, call from the Tk thread """
+        while True:
+            try:
+                channel, ticket, callback, result, error = self.results.get_nowait()
+            except queue.Empty:
+                return
+            if self.is_current(channel, ticket):
+                callback(result, error)
+
+    def close(self):
+        """ Stop the worker thread after the queued jobs """
+        self.jobs.put(None)
+
+class ResultPager:
+    """
+    Fills the movie list page by page so that it stays small however many movies
+    match. A search shows only its first page, the next page is fetched on the
+    worker thread with keyset pagination once the list is scrolled to within a
+    page of its end, and the number of matches is counted after the first page.
+    """
+
+    def __init__(self, tree_view, query_worker, scrollbar=None, on_count=None, page_size=PAGE_SIZE):
+        self.tree = tree_view
+        self.worker = query_worker
+        self.scrollbar = scrollbar
+        self.on_count = on_count
+        self.page_size = page_size
+        self.query = ''
+        self.cursor = None
+        self.done = True
+        self.loading = False
+
+    def search(self, query):
+        """ Replace the list with the first page of a new search """
+        self.query = query
+        self.cursor = None
+        self.done = False
+        self.loading = False
+        self.tree.delete(*self.tree.get_children())
+        # A count of the previous search still queued must neither run ahead of the new page nor be shown
+        self.worker.cancel('count')
+        if self.on_count is not None:
+            self.on_count(None)
+        self.request_page()
+
+    def request_page(self):
+        """ Fetch the next page unless one is on its way or the results are exhausted """
+        if self.loading or self.done:
+            return
+        self.loading = True
+        self.worker.submit('page', search_titles_page, self.query, self.cursor, self.page_size,
+                           callback=self.show_page)
+
+    def show_page(self, result, error):
+        """ Append a fetched page to the list """
+        self.loading = False
+        if error:
+            print(f"Error when searching for movies: {error}")
+            self.done = True
+            return
+        rows, cursor = result
+        first_page = self.cursor is None
+        for row in rows:
+            self.tree.insert('', tk.END, iid=row[3], values=row[:3])
+        self.cursor = cursor
+        self.done = cursor is None
+        if first_page and self.on_count is not None:
+            # Counting every match may take longer than a page, so it waits for the first one
+            self.worker.submit('count', count_titles, self.query, callback=self.show_count)
+
+    def show_count(self, count, error):
+        """ Report the number of matches of the current search """
+        if not error:
+            self.on_count(count)
+
+    def on_scroll(self, first, last):
+        """ yscrollcommand of the list, fetching the next page when less than a page is left below the view """
+        if self.scrollbar is not None:
+            self.scrollbar.set(first, last)
+        rows_below = (1.0 - float(last)) * len(self.tree.get_children())
+        if rows_below < self.page_size:
+            self.request_page()
+
+def poll_results(root):
+    """ Hand finished background queries back to the Tk main loop """
+    worker.deliver()
+    root.after(POLL_INTERVAL_MS, poll_results, root)
+
+def load_selection(connection, wikipedia_movie_id):
+    """ Load the plot summary and similar movies of a movie, runs on the worker thread """
     cur = connection.cursor()
-
-    # Assembling the TF-IDF of the current movie into a sparse vector
-    current_data = get_tfidf_vector(cur, wikipedia_movie_id)
-    if not current_data:
-        return []
-
-    # Calculate the norm of the current movie
-    current_vector = dict(current_data)
-    norm_current = calculate_norm(current_vector)
-
-    # Get the vectors of all other films
-    cur.execute("SELECT wikipedia_movie_id, tfidf_index, tfidf_value FROM sparse_tfidf LIMIT 2000000")
-    all_vectors = cur.fetchall()
-
-    # Calculate similarity using scalar product
-    similarities = calculate_similarities(current_vector, norm_current, all_vectors, wikipedia_movie_id)
-
-    # Sort and select top N similar movies
-    sorted_similarities = sorted(similarities.items(), key=lambda item: item[1], reverse=True)[:top_n]
-
-    # Getting movie titles for identifiers
-    movie_ids = [movie_id for movie_id, _ in sorted_similarities]
-    if movie_ids:
-        movie_names = get_movie_names(cur, movie_ids)
-        similar_movies_with_names = [(movie_names[movie_id], score)
-                                     for movie_id, score in sorted_similarities
-                                     if movie_id in movie_names]
-
-        elapsed_time = time.time() - start_time  # End timing
-        print(f"find_similar_movies() took {elapsed_time:.2f} seconds to execute")
-
-        return similar_movies_with_names
-    return []
+    cur.execute("SELECT plot_summary FROM plot_summaries WHERE wikipedia_movie_id=?",
+                (wikipedia_movie_id,))
+    plot_summary = cur.fetchone()
+    if not plot_summary:
+        return None, []
+    engine = worker.get_engine(connection)
+    return plot_summary[0], find_similar_movies(connection, wikipedia_movie_id,
+                                                engine=engine, cache=worker.cache)
 
 def update_treeview(search_query):
     """ Updating Treeview with search results """
-    for i in tree.get_children():
-        tree.delete(i)
-    if search_query:
-        rows = search_movies(conn, search_query)
-    else:  # If the request is empty, load the initial data
-        rows = load_initial_data(conn)
-    for row in rows:
-        tree.insert('', tk.END, iid=row[3], values=row[:3])
+    pager.search(search_query)
+
+def show_match_count(count):
+    """ Show the number of matching movies in the title heading, None while it is being counted """
+    tree.heading('movie_name', text='Title' if count is None else f"Title ({count:,} movies)")
 
 def update_similar_movies_treeview(similar_movies):
     """ Update Treeview with similar movies with titles and similarity ratings """
@@ -137,23 +206,30 @@ def on_select(_event):
     if not selected_item:
         return
 
-    cur = conn.cursor()
-    query = "SELECT plot_summary FROM plot_summaries WHERE wikipedia_movie_id=?"
-    cur.execute(query, (selected_item,))
-    plot_summary = cur.fetchone()
     movie_details_text.delete('1.0', tk.END)
+    movie_details_text.insert(tk.INSERT, "Loading...")
+    worker.submit('select', load_selection, int(selected_item), callback=show_selection)
 
+def show_selection(result, error):
+    """ Show the plot summary and similar movies of the selected movie """
+    movie_details_text.delete('1.0', tk.END)
+    if isinstance(error, sqlite3.DatabaseError):
+        print(f"Database error when searching for similar movies: {error}")
+        movie_details_text.insert(tk.END, "Database error retrieving similar movies.")
+        return
+    if isinstance(error, ValueError):
+        print(f"Value error when searching for similar movies: {error}")
+        movie_details_text.insert(tk.END, "Value error retrieving similar movies.")
+        return
+    if error:
+        print(f"Error when searching for similar movies: {error!r}")
+        movie_details_text.insert(tk.END, "Error retrieving similar movies.")
+        return
+
+    plot_summary, similar_movies_with_names = result
     if plot_summary:
-        movie_details_text.insert(tk.INSERT, plot_summary[0])
-        try:
-            similar_movies_with_names = find_similar_movies(conn, int(selected_item))
-            update_similar_movies_treeview(similar_movies_with_names)
-        except sqlite3.DatabaseError as db_err:
-            print(f"Database error when searching for similar movies: {db_err}")
-            movie_details_text.insert(tk.END, "\nDatabase error retrieving similar movies.")
-        except ValueError as val_err:
-            print(f"Value error when searching for similar movies: {val_err}")
-            movie_details_text.insert(tk.END, "\nValue error retrieving similar movies.")
+        movie_details_text.insert(tk.INSERT, plot_summary)
+        update_similar_movies_treeview(similar_movies_with_names)
     else:
         movie_details_text.insert(tk.INSERT, "No plot summary available for this movie.")
 
@@ -165,7 +241,7 @@ def on_similar_select(_event):
 
 def main():
     """Main function to initialize and run the application"""
-    global tree, conn, movie_details_text, similar_movies_tree
+    global tree, worker, pager, movie_details_text, similar_movies_tree
 
     root = ctk.CTk()
     root.geometry('800x400')
@@ -202,7 +278,6 @@ def main():
     tree.column('movie_release_date', width=100, anchor='center')
 
     scrollbar = ttk.Scrollbar(root, orient="vertical", command=tree.yview)
-    tree.configure(yscroll=scrollbar.set)
     scrollbar.pack(side=tk.RIGHT, fill='y')
 
     movie_details_text = scrolledtext.ScrolledText(root, height=10, font=custom_font)
@@ -219,10 +294,15 @@ def main():
                                   image = img, corner_radius=0)
     search_button.pack(side=ctk.BOTTOM, fill=ctk.X)
 
-    conn = create_connection('movies.db')
-    for x in load_initial_data(conn):
-        tree.insert('', tk.END, values=x)
+    # Report query stage timings on the console
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    add_sink(LoggingSink())
+
+    worker = QueryWorker('movies.db')
+    pager = ResultPager(tree, worker, scrollbar, on_count=show_match_count)
+    tree.configure(yscrollcommand=pager.on_scroll)
     update_treeview('')
+    poll_results(root)
 
     # similar film sheet
     columns_similar = ('similar_movie_name',)
@@ -234,6 +314,7 @@ def main():
     similar_movies_tree.column('similar_movie_name', width=120, anchor='center')
 
     root.mainloop()
+    worker.close()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,109 @@
+"""
+Memory-mappable snapshot of the TF-IDF matrix.
+The CSR arrays, row norms and movie IDs are written as .npy files next to a
+manifest.json that records the build ID of the SQLite database they were
+exported from and a CRC32 of every file. Loading uses np.load(mmap_mode='r'),
+so startup does not depend on the corpus size and processes loading the same
+snapshot share its pages through the OS page cache.
+"""
+
+import json
+import os
+import zlib
+import numpy as np
+from scipy.sparse import csr_matrix
+
+MANIFEST_NAME = 'manifest.json'
+SNAPSHOT_FORMAT = 1
+ARRAY_NAMES = ('data', 'indices', 'indptr', 'norms', 'movie_ids')
+
+
+def file_checksum(path, block_size=1 << 20):
+    """ Calculate the CRC32 of a file """
+    checksum = 0
+    with open(path, 'rb') as snapshot_file:
+        while block := snapshot_file.read(block_size):
+            checksum = zlib.crc32(block, checksum)
+    return checksum
+
+
+def write_snapshot(directory, matrix, movie_ids, build_id):
+    """
+    Write a snapshot of the matrix to a directory.
+
+    Parameters:
+        directory (str): Directory to write the snapshot into, created if missing.
+        matrix (csr_matrix): TF-IDF matrix with one row per movie.
+        movie_ids (array): wikipedia_movie_id of each matrix row.
+        build_id (str): Build ID of the database the matrix was loaded from.
+    """
+    matrix = csr_matrix(matrix)
+    arrays = {
+        'data': matrix.data,
+        'indices': matrix.indices,
+        'indptr': matrix.indptr,
+        'norms': np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel()),
+        'movie_ids': np.asarray(movie_ids, dtype=np.int64),
+    }
+    os.makedirs(directory, exist_ok=True)
+    files = {}
+    for name, array in arrays.items():
+        path = os.path.join(directory, f'{name}.npy')
+        # Write under a temporary name so readers never map a half-written file
+        np.save(path + '.tmp.npy', np.ascontiguousarray(array))
+        os.replace(path + '.tmp.npy', path)
+        files[name] = {'size': os.path.getsize(path), 'crc32': file_checksum(path)}
+
+    manifest = {
+        'format': SNAPSHOT_FORMAT,
+        'build_id': build_id,
+        'shape': list(matrix.shape),
+        'files': files,
+    }
+    manifest_path = os.path.join(directory, MANIFEST_NAME)
+    with open(manifest_path + '.tmp', 'w', encoding='utf-8') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+
+def read_manifest(directory):
+    """ Read the manifest of a snapshot """
+    with open(os.path.join(directory, MANIFEST_NAME), encoding='utf-8') as manifest_file:
+        return json.load(manifest_file)
+
+
+def load_snapshot(directory, build_id=None, verify=False):
+    """
+    Memory-map a snapshot written by write_snapshot.
+
+    Parameters:
+        directory (str): Snapshot directory.
+        build_id (str): Expected build ID, a snapshot of any other build is rejected.
+        verify (bool): Recompute the CRC32 of every file, reading it completely.
+
+    Returns:
+        tuple: (csr_matrix, movie_ids, norms) backed by read-only memory maps.
+
+    Raises:
+        FileNotFoundError: If there is no snapshot in the directory.
+        ValueError: If the snapshot is stale, incomplete or corrupted.
+    """
+    manifest = read_manifest(directory)
+    if manifest.get('format') != SNAPSHOT_FORMAT:
+        raise ValueError(f"Unsupported snapshot format: {manifest.get('format')}")
+    if build_id is not None and manifest['build_id'] != build_id:
+        raise ValueError(f"Snapshot of build {manifest['build_id']} does not match database build {build_id}")
+
+    arrays = {}
+    for name in ARRAY_NAMES:
+        path = os.path.join(directory, f'{name}.npy')
+        expected = manifest['files'][name]
+        if os.path.getsize(path) != expected['size']:
+            raise ValueError(f"Snapshot file {path} is incomplete")
+        if verify and file_checksum(path) != expected['crc32']:
+            raise ValueError(f"Snapshot file {path} is corrupted")
+        arrays[name] = np.load(path, mmap_mode='r')
+
+    matrix = csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']),
+                        shape=tuple(manifest['shape']), copy=False)
+    return matrix, arrays['movie_ids'], arrays['norms']
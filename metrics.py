@@ -0,0 +1,174 @@
+"""
+Lightweight timing and metrics instrumentation for the Vector Model Application.
+Code reports stage timings with `with timed('query.score'):` and counts with
+increment(). Every measurement is handed to the registered sinks: a logging
+sink, a JSON-lines file sink and an in-process registry with counters and
+histograms are provided, and anything with a record(event) method can be added.
+Without sinks the instrumentation costs a single list check. profiled() wraps a
+block in cProfile for a function-level breakdown.
+"""
+
+import cProfile
+import io
+import json
+import logging
+import pstats
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+import numpy as np
+
+# Number of most recent values kept per histogram of the registry
+HISTOGRAM_SIZE = 10_000
+
+# Functions listed by profiled() when it logs instead of writing a file
+PROFILE_LIMIT = 30
+
+_sinks = []
+
+
+def add_sink(sink):
+    """ Start sending measurements to a sink """
+    _sinks.append(sink)
+    return sink
+
+
+def remove_sink(sink):
+    """ Stop sending measurements to a sink """
+    _sinks.remove(sink)
+
+
+def emit(event):
+    """ Hand one measurement to every registered sink """
+    for sink in list(_sinks):
+        sink.record(event)
+
+
+@contextmanager
+def timed(name, **tags):
+    """
+    Time a block and report it as a 'timing' event in seconds.
+    The event is also reported when the block raises, with error set to the exception type.
+    """
+    if not _sinks:
+        yield
+        return
+    error = None
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException as exc:
+        error = type(exc).__name__
+        raise
+    finally:
+        emit({'type': 'timing', 'name': name, 'value': time.perf_counter() - start,
+              'time': time.time(), 'error': error, **tags})
+
+
+def increment(name, value=1, **tags):
+    """ Report a 'counter' event """
+    if _sinks:
+        emit({'type': 'counter', 'name': name, 'value': value, 'time': time.time(), **tags})
+
+
+class LoggingSink:
+    """ Sink that writes every measurement to a logger """
+
+    def __init__(self, logger=None, level=logging.INFO):
+        self.logger = logger or logging.getLogger('metrics')
+        self.level = level
+
+    def record(self, event):
+        """ Log one measurement """
+        if event['type'] == 'timing':
+            status = f" ({event['error']})" if event.get('error') else ''
+            self.logger.log(self.level, "%s took %.2f ms%s", event['name'], event['value'] * 1000.0, status)
+        else:
+            self.logger.log(self.level, "%s +%s", event['name'], event['value'])
+
+
+class JsonLinesSink:
+    """ Sink that appends every measurement to a file as one JSON object per line """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = open(path, 'a', encoding='utf-8')  # pylint: disable=R1732
+
+    def record(self, event):
+        """ Append one measurement as a JSON line """
+        line = json.dumps(event)
+        with self.lock:
+            self.file.write(line + '\n')
+            self.file.flush()
+
+    def close(self):
+        """ Close the file """
+        with self.lock:
+            self.file.close()
+
+
+class MetricsRegistry:
+    """ In-process sink keeping counter totals and histograms of recent timings """
+
+    def __init__(self, histogram_size=HISTOGRAM_SIZE):
+        self.counters = defaultdict(float)
+        self.histograms = defaultdict(lambda: deque(maxlen=histogram_size))
+        self.errors = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def record(self, event):
+        """ Add one measurement to the counters or histograms """
+        with self.lock:
+            if event['type'] == 'timing':
+                self.histograms[event['name']].append(event['value'])
+                if event.get('error'):
+                    self.errors[event['name']] += 1
+            else:
+                self.counters[event['name']] += event['value']
+
+    def summary(self):
+        """ Return the counters and count, mean and percentiles in milliseconds of every timing """
+        with self.lock:
+            timings = {}
+            for name, values in self.histograms.items():
+                values_ms = np.asarray(values) * 1000.0
+                timings[name] = {
+                    'count': len(values_ms),
+                    'errors': self.errors[name],
+                    'mean_ms': float(values_ms.mean()),
+                    'p50_ms': float(np.percentile(values_ms, 50)),
+                    'p95_ms': float(np.percentile(values_ms, 95)),
+                    'p99_ms': float(np.percentile(values_ms, 99)),
+                    'max_ms': float(values_ms.max()),
+                }
+            return {'counters': dict(self.counters), 'timings': timings}
+
+    def clear(self):
+        """ Forget every recorded measurement """
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+            self.errors.clear()
+
+
+@contextmanager
+def profiled(output=None, sort='cumulative', limit=PROFILE_LIMIT):
+    """
+    Run a block under cProfile.
+    The statistics are written to output for pstats or snakeviz, or, without
+    output, the top limit functions are logged to the 'metrics' logger.
+    """
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        if output:
+            profiler.dump_stats(output)
+        else:
+            stream = io.StringIO()
+            pstats.Stats(profiler, stream=stream).sort_stats(sort).print_stats(limit)
+            logging.getLogger('metrics').info("%s", stream.getvalue())
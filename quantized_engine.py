@@ -0,0 +1,240 @@
+"""
+Quantized similarity search for the Vector Model Application.
+The TF-IDF values are held term by term as postings of float16, or of int8
+with one float32 scale per movie, with uint16 row indices while there are at
+most 65,536 movies and int32 ones beyond: 3 bytes per stored value for int8 and
+4 for float16, or 5 and 6 with int32 indices, instead of the 12 of the float64
+CSR matrix. A query first scores the movies sharing a
+term with it from the quantized postings of its terms, then re-scores the best
+RERANK_DEPTH candidates with the full-precision vectors, which stay on disk in
+a memory-mapped snapshot. Only then does quantizing save memory, an engine built
+from the database keeps the float64 matrix resident besides its postings and
+counts it in nbytes. The top N is exact unless a true neighbour falls outside
+the candidates, and recall() measures how often that happens.
+"""
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from matrix_snapshot import load_snapshot
+from metrics import timed
+from similarity_engine import SimilarityEngine, load_sparse_matrix, top_n_indices
+from tfidf_storage import get_build_id
+
+QUANTIZE_FLOAT16 = 'float16'
+QUANTIZE_INT8 = 'int8'
+
+# Candidates of the quantized first pass re-scored with the full-precision vectors
+RERANK_DEPTH = 200
+
+# Largest int8 magnitude, the largest value of a row is quantized to it
+INT8_LEVELS = 127
+
+# Movies whose neighbours are compared by recall() and neighbours compared per movie
+RECALL_SAMPLE_SIZE = 100
+RECALL_TOP_N = 10
+
+
+def is_memory_mapped(array):
+    """ Check whether an array is a view of a memory-mapped file """
+    while array is not None:
+        if isinstance(array, np.memmap):
+            return True
+        array = getattr(array, 'base', None)
+    return False
+
+
+def quantize_matrix(matrix, dtype=QUANTIZE_INT8):
+    """
+    Quantize a CSR matrix into term-major postings with narrow row indices.
+
+    Parameters:
+        matrix (csr_matrix): TF-IDF matrix with one row per movie.
+        dtype (str): QUANTIZE_FLOAT16 or QUANTIZE_INT8.
+
+    Returns:
+        tuple: (data, rows, indptr, scales), the postings of term i spanning
+            indptr[i]:indptr[i + 1], where scales holds the float32 scale of
+            every matrix row for int8 values and is None for float16.
+    """
+    if dtype not in (QUANTIZE_FLOAT16, QUANTIZE_INT8):
+        raise ValueError(f"Unknown quantization: {dtype}")
+    matrix = csr_matrix(matrix)
+    scales = None
+    if dtype == QUANTIZE_INT8:
+        non_empty = np.flatnonzero(np.diff(matrix.indptr))
+        scales = np.zeros(matrix.shape[0], dtype=np.float32)
+        if non_empty.size:
+            scales[non_empty] = np.maximum.reduceat(np.abs(matrix.data), matrix.indptr[non_empty]) / INT8_LEVELS
+    postings = matrix.tocsc()
+    postings.sort_indices()
+    rows = postings.indices.astype(np.uint16 if matrix.shape[0] <= 1 << 16 else np.int32)
+    indptr = postings.indptr.astype(np.int64)
+    if scales is None:
+        return postings.data.astype(np.float16), rows, indptr, None
+    value_scales = scales[postings.indices]
+    data = np.divide(postings.data, value_scales, out=np.zeros(len(postings.data)), where=value_scales > 0)
+    return np.rint(data).astype(np.int8), rows, indptr, scales
+
+
+class QuantizedEngine:
+    """ Cosine similarity search over quantized TF-IDF postings with exact re-ranking """
+
+    def __init__(self, matrix, movie_ids, norms=None, build_id=None, dtype=QUANTIZE_INT8,
+                 rerank_depth=RERANK_DEPTH):
+        """
+        Quantize a matrix. The full-precision matrix is kept for query vectors and
+        re-ranking, pass a memory-mapped one to keep it out of memory, an in-memory
+        one is counted in nbytes. With rerank_depth=0 results are ranked by the
+        quantized scores alone.
+        """
+        self.build_id = build_id
+        self.dtype = dtype
+        self.rerank_depth = rerank_depth
+        self.matrix = csr_matrix(matrix)
+        self.movie_ids = np.asarray(movie_ids, dtype=np.int64)
+        self.rows = {int(movie_id): row for row, movie_id in enumerate(self.movie_ids.tolist())}
+        if norms is None:
+            norms = np.sqrt(np.asarray(self.matrix.multiply(self.matrix).sum(axis=1)).ravel())
+        self.norms = np.asarray(norms)
+        self.data, self.posting_rows, self.posting_indptr, self.scales = quantize_matrix(self.matrix, dtype)
+
+    @classmethod
+    def from_connection(cls, conn, dtype=QUANTIZE_INT8, rerank_depth=RERANK_DEPTH):
+        """
+        Quantize the stored TF-IDF vectors, keeping them in memory for re-ranking.
+        The engine then holds more memory than a SimilarityEngine, prefer from_snapshot.
+        """
+        build_id = get_build_id(conn.cursor())
+        return cls(*load_sparse_matrix(conn), build_id=build_id, dtype=dtype, rerank_depth=rerank_depth)
+
+    @classmethod
+    def from_snapshot(cls, directory, conn=None, dtype=QUANTIZE_INT8, rerank_depth=RERANK_DEPTH):
+        """
+        Quantize a memory-mapped snapshot, which stays on disk for re-ranking.
+        When a connection is given, a snapshot of another database build is rejected.
+        """
+        build_id = get_build_id(conn.cursor()) if conn is not None else None
+        if conn is not None and build_id is None:
+            raise ValueError("The database has no recorded build to check the snapshot against")
+        matrix, movie_ids, norms = load_snapshot(directory, build_id)
+        return cls(matrix, movie_ids, norms, build_id, dtype, rerank_depth)
+
+    def __len__(self):
+        return len(self.movie_ids)
+
+    def __contains__(self, wikipedia_movie_id):
+        return wikipedia_movie_id in self.rows
+
+    @property
+    def memory_mapped(self):
+        """ Whether the full-precision matrix is read from a memory-mapped snapshot """
+        return all(is_memory_mapped(array) for array in (self.matrix.data, self.matrix.indices,
+                                                          self.matrix.indptr))
+
+    @property
+    def nbytes(self):
+        """ Memory held by the quantized postings and by the full-precision matrix unless it is memory-mapped """
+        arrays = [self.data, self.posting_rows, self.posting_indptr]
+        if self.scales is not None:
+            arrays.append(self.scales)
+        if not self.memory_mapped:
+            arrays.extend([self.matrix.data, self.matrix.indices, self.matrix.indptr])
+        return sum(array.nbytes for array in arrays)
+
+    def approximate_scores(self, terms, weights):
+        """ Dot products of every row with a sparse query, from the quantized postings of its terms """
+        with_postings = terms < len(self.posting_indptr) - 1
+        terms, weights = terms[with_postings], weights[with_postings]
+        starts, ends = self.posting_indptr[terms], self.posting_indptr[terms + 1]
+        if not np.any(ends > starts):
+            # np.bincount of no postings would give integer scores, e.g. for an empty query
+            return np.zeros(len(self.movie_ids))
+        rows = np.concatenate([self.posting_rows[start:end] for start, end in zip(starts, ends)])
+        values = np.concatenate([self.data[start:end] for start, end in zip(starts, ends)])
+        contributions = values.astype(np.float64) * np.repeat(weights, ends - starts)
+        dots = np.bincount(rows.astype(np.intp), weights=contributions, minlength=len(self.movie_ids))
+        if self.scales is not None:
+            dots *= self.scales
+        return dots
+
+    def similar_to_terms(self, terms, weights, top_n=5, exclude_row=None, mask=None):
+        """
+        Find the top_n movies most similar to a sparse query of column indices and weights.
+        mask, a boolean array over the rows, restricts the results to the rows where it is True.
+        """
+        terms = np.asarray(terms, dtype=np.int64)
+        weights = np.asarray(weights, dtype=np.float64)
+        query_norm = np.sqrt(np.dot(weights, weights))
+        with timed('query.score', mode='quantized'):
+            dots = self.approximate_scores(terms, weights)
+            denominators = self.norms * query_norm
+            scores = np.divide(dots, denominators, out=np.zeros_like(dots), where=denominators > 0)
+            if exclude_row is not None:
+                scores[exclude_row] = 0.0
+            if mask is not None:
+                np.multiply(scores, mask, out=scores)
+        with timed('query.sort', mode='quantized'):
+            candidates = top_n_indices(scores, max(top_n, self.rerank_depth) if top_n > 0 else 0)
+        if not self.rerank_depth or candidates.size == 0:
+            return [(int(self.movie_ids[row]), float(scores[row])) for row in candidates[:top_n]]
+
+        with timed('query.rerank'):
+            # Rows are read in storage order, sequentially through a memory-mapped matrix
+            candidates = np.sort(candidates)
+            in_vocabulary = terms < self.matrix.shape[1]
+            vector = np.zeros(self.matrix.shape[1])
+            vector[terms[in_vocabulary]] = weights[in_vocabulary]
+            dots = self.matrix[candidates].dot(vector)
+            denominators = self.norms[candidates] * query_norm
+            exact_scores = np.divide(dots, denominators, out=np.zeros_like(dots), where=denominators > 0)
+            best = top_n_indices(exact_scores, top_n)
+        return [(int(self.movie_ids[candidates[i]]), float(exact_scores[i])) for i in best]
+
+    def similar_movies(self, wikipedia_movie_id, top_n=5, mask=None):
+        """
+        Find the top_n movies most similar to the given movie, among the rows of mask if given.
+
+        Returns:
+            list: (wikipedia_movie_id, similarity) pairs sorted by descending similarity.
+        """
+        row = self.rows.get(wikipedia_movie_id)
+        if row is None:
+            return []
+        start, end = self.matrix.indptr[row], self.matrix.indptr[row + 1]
+        return self.similar_to_terms(self.matrix.indices[start:end], self.matrix.data[start:end],
+                                     top_n, exclude_row=row, mask=mask)
+
+    def similar_movies_batch(self, wikipedia_movie_ids, top_n=5):
+        """
+        Find the top_n most similar movies of many movies, one query at a time.
+
+        Yields:
+            tuple: (wikipedia_movie_id, list of (wikipedia_movie_id, similarity) pairs)
+                in the order of wikipedia_movie_ids, empty for unknown movies.
+        """
+        for movie_id in wikipedia_movie_ids:
+            yield movie_id, self.similar_movies(movie_id, top_n)
+
+    def recall(self, sample_ids=None, top_n=RECALL_TOP_N, reference=None):
+        """
+        Fraction of the exact top_n neighbours of the sampled movies that are found.
+
+        Parameters:
+            sample_ids (list): Movies to check, by default RECALL_SAMPLE_SIZE evenly spread ones.
+            top_n (int): Neighbours compared per movie.
+            reference (SimilarityEngine): Exact engine, by default one over the full-precision matrix.
+
+        Returns:
+            float: Recall between 0 and 1, 1.0 when no movie has any neighbour.
+        """
+        if reference is None:
+            reference = SimilarityEngine(self.matrix, self.movie_ids, self.norms)
+        if sample_ids is None:
+            positions = np.linspace(0, len(self.movie_ids) - 1, min(RECALL_SAMPLE_SIZE, len(self.movie_ids)))
+            sample_ids = self.movie_ids[positions.astype(np.int64)].tolist()
+        found = expected = 0
+        for movie_id in sample_ids:
+            exact = {similar_id for similar_id, _ in reference.similar_movies(movie_id, top_n)}
+            found += len(exact & {similar_id for similar_id, _ in self.similar_movies(movie_id, top_n)})
+            expected += len(exact)
+        return found / expected if expected else 1.0
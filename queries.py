@@ -0,0 +1,374 @@
+"""
+Query functions of the Vector Model Application.
+Title search, similar-movie and free-text queries over the SQLite database and
+the loaded similarity engines, free of any GUI state, so that the desktop
+application and the HTTP service share them.
+"""
+
+import json
+import sqlite3
+from collections import defaultdict
+import numpy as np
+from similarity_engine import SimilarityEngine
+from dense_index import DenseIndex
+from inverted_index import InvertedIndex
+from facet_index import FacetIndex, normalize_filters
+from metrics import increment, timed
+from quantized_engine import QuantizedEngine
+from tfidf_storage import get_blob_vector, get_build_id, uses_blob_storage
+from vector_model import SNAPSHOT_DIR, load_vectorizer, preprocess_text
+
+# Maximum number of rows returned by a title search
+SEARCH_LIMIT = 200
+
+# Number of rows fetched at a time by a paginated title search
+PAGE_SIZE = 50
+
+# Similarity modes of find_similar_movies: exact sparse TF-IDF or approximate dense embeddings
+MODE_SPARSE = 'sparse'
+MODE_DENSE = 'dense'
+
+def create_connection(db_file):
+    """ Create a connection to a SQLite database """
+    connection = None
+    try:
+        connection = sqlite3.connect(db_file)
+    except sqlite3.Error as e:
+        print(e)
+    return connection
+
+def search_movies(con, query):
+    """ Search movies by title """
+    cur = con.cursor()
+    cur.execute("""SELECT movie_name,
+                        movie_genres,
+                        movie_release_date,
+                        wikipedia_movie_id FROM movies
+                        WHERE movie_name LIKE ?""",
+                        ('%' + query + '%',))
+    return cur.fetchall()
+
+def has_title_index(cur):
+    """ Check whether the FTS5 title index exists """
+    cur.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='movie_titles'")
+    return cur.fetchone() is not None
+
+def escape_like(query):
+    """ Escape the LIKE wildcards of a query for ESCAPE '\\' """
+    return query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def search_titles(con, query, limit=SEARCH_LIMIT):
+    """ Search movies by title through the FTS5 trigram index, best matches first """
+    cur = con.cursor()
+    if not has_title_index(cur):
+        return search_movies(con, query)[:limit]
+    if len(query) >= 3:
+        # A quoted trigram phrase matches the query anywhere in the title,
+        # titles starting with it are ranked first, then by bm25
+        cur.execute("""SELECT m.movie_name,
+                            m.movie_genres,
+                            m.movie_release_date,
+                            m.wikipedia_movie_id
+                        FROM movie_titles t
+                        JOIN movies m ON m.wikipedia_movie_id = t.rowid
+                        WHERE movie_titles MATCH ?
+                        ORDER BY instr(lower(t.movie_name), lower(?)) = 1 DESC, t.rank
+                        LIMIT ?""",
+                        ('"' + query.replace('"', '""') + '"', query, limit))
+    else:
+        # Trigrams cannot match shorter queries, so scan the titles for the
+        # substring like search_movies, titles starting with it first
+        cur.execute("""SELECT movie_name,
+                            movie_genres,
+                            movie_release_date,
+                            wikipedia_movie_id FROM movies
+                        WHERE movie_name LIKE ? ESCAPE '\\'
+                        ORDER BY instr(lower(movie_name), lower(?)) = 1 DESC, movie_name COLLATE NOCASE
+                        LIMIT ?""",
+                        ('%' + escape_like(query) + '%', query, limit))
+    return cur.fetchall()
+
+def search_titles_page(con, query, after=None, page_size=PAGE_SIZE):
+    """
+    Fetch one page of a title search with keyset pagination.
+    Every page continues from the sort key of the last row of the previous one
+    instead of an OFFSET. Listing all movies and prefix searches read only the
+    rows shown through an index, while ranked searches re-match and re-sort every
+    hit on each page, their key being the computed bm25 rank. An empty query lists
+    all movies, newest first; queries of 3 characters or more are ranked like search_titles. Shorter
+    ones, which trigrams cannot match, and every query without the title index
+    match substrings alphabetically, like search_movies.
+
+    Parameters:
+        con (Connection): A connection object to the SQLite database.
+        query (str): The title search.
+        after (tuple): Cursor returned with the previous page, None for the first page.
+        page_size (int): Maximum number of rows of the page.
+
+    Returns:
+        tuple: (rows, cursor) where rows are (movie_name, movie_genres,
+            movie_release_date, wikipedia_movie_id) and cursor is None after the last page.
+    """
+    cur = con.cursor()
+    indexed = has_title_index(cur)
+    if not query:
+        cur.execute(f"""SELECT movie_name,
+                            movie_genres,
+                            movie_release_date,
+                            wikipedia_movie_id FROM movies
+                        {'WHERE wikipedia_movie_id < ?' if after else ''}
+                        ORDER BY wikipedia_movie_id DESC
+                        LIMIT ?""", (*(after or ()), page_size))
+        rows = cur.fetchall()
+        keys = [(row[3],) for row in rows]
+    elif len(query) >= 3 and indexed:
+        # Prefix matches first, then by bm25, the movie ID breaking ties
+        cur.execute(f"""SELECT * FROM (
+                            SELECT m.movie_name,
+                                m.movie_genres,
+                                m.movie_release_date,
+                                m.wikipedia_movie_id,
+                                instr(lower(t.movie_name), lower(?)) != 1 AS tier,
+                                t.rank AS score
+                            FROM movie_titles t
+                            JOIN movies m ON m.wikipedia_movie_id = t.rowid
+                            WHERE movie_titles MATCH ?)
+                        {'WHERE (tier, score, wikipedia_movie_id) > (?, ?, ?)' if after else ''}
+                        ORDER BY tier, score, wikipedia_movie_id
+                        LIMIT ?""",
+                        (query, '"' + query.replace('"', '""') + '"', *(after or ()), page_size))
+        keys = []
+        rows = []
+        for row in cur.fetchall():
+            rows.append(row[:4])
+            keys.append((row[4], row[5], row[3]))
+    else:
+        # The NOCASE title index gives the order, so a page stops scanning once it is full
+        cur.execute(f"""SELECT movie_name,
+                            movie_genres,
+                            movie_release_date,
+                            wikipedia_movie_id FROM movies
+                        WHERE movie_name LIKE ? ESCAPE '\\'
+                        {'AND (movie_name COLLATE NOCASE, wikipedia_movie_id) > (?, ?)' if after else ''}
+                        ORDER BY movie_name COLLATE NOCASE, wikipedia_movie_id
+                        LIMIT ?""", ('%' + escape_like(query) + '%', *(after or ()), page_size))
+        rows = cur.fetchall()
+        keys = [(row[0], row[3]) for row in rows]
+    cursor = keys[-1] if len(rows) == page_size else None
+    return rows, cursor
+
+def count_titles(con, query):
+    """ Count the movies matched by search_titles_page, for showing after the first page """
+    cur = con.cursor()
+    indexed = has_title_index(cur)
+    if not query:
+        cur.execute("SELECT count(*) FROM movies")
+    elif len(query) >= 3 and indexed:
+        cur.execute("""SELECT count(*)
+                       FROM movie_titles t
+                       JOIN movies m ON m.wikipedia_movie_id = t.rowid
+                       WHERE movie_titles MATCH ?""", ('"' + query.replace('"', '""') + '"',))
+    else:
+        cur.execute("SELECT count(*) FROM movies WHERE movie_name LIKE ? ESCAPE '\\'",
+                    ('%' + escape_like(query) + '%',))
+    return cur.fetchone()[0]
+
+def load_initial_data(connection):
+    """ Loading initial data """
+    cur = connection.cursor()
+    cur.execute("""SELECT movie_name,
+                        movie_genres,
+                        movie_release_date,
+                        wikipedia_movie_id FROM movies
+                        ORDER BY wikipedia_movie_id DESC
+                        LIMIT 20""")
+    return cur.fetchall()
+
+def get_tfidf_vector(cur, wikipedia_movie_id):
+    """ Get the TF-IDF vector for a specific movie """
+    if uses_blob_storage(cur):
+        vector = get_blob_vector(cur, wikipedia_movie_id)
+        return list(zip(*(array.tolist() for array in vector))) if vector else []
+    cur.execute("""SELECT tfidf_index, tfidf_value
+                   FROM sparse_tfidf
+                   WHERE wikipedia_movie_id=?""", (wikipedia_movie_id,))
+    return cur.fetchall()
+
+def calculate_norm(vector):
+    """ Calculate the norm of a TF-IDF vector """
+    return np.sqrt(sum(tfidf * tfidf for tfidf in vector.values()))
+
+def calculate_similarities(current_vector, norm_current, all_vectors, current_movie_id):
+    """ Calculate cosine similarities between the current movie and all other movies """
+    similarities = defaultdict(float)
+    norms = defaultdict(float)
+    for movie_id, idx, tfidf in all_vectors:
+        if movie_id != current_movie_id:
+            norms[movie_id] += tfidf * tfidf
+            if idx in current_vector:
+                similarities[movie_id] += tfidf * current_vector[idx]
+    for movie_id in similarities:
+        norms[movie_id] = np.sqrt(norms[movie_id])
+        similarities[movie_id] /= (norm_current * norms[movie_id])
+    return similarities
+
+def get_movie_names(cur, movie_ids):
+    """ Get movie names for the given movie IDs """
+    query_placeholders = ','.join(['?'] * len(movie_ids))
+    cur.execute(f"""SELECT wikipedia_movie_id, movie_name
+                    FROM movies
+                    WHERE wikipedia_movie_id IN ({query_placeholders})""", movie_ids)
+    return dict(cur.fetchall())
+
+def load_engine(connection, snapshot_dir=SNAPSHOT_DIR, quantize=None, inverted=False):
+    """
+    Load the similarity engine from a current snapshot, or from the database.
+    quantize, QUANTIZE_FLOAT16 or QUANTIZE_INT8, loads a QuantizedEngine instead,
+    re-ranking from the memory-mapped snapshot. Quantizing without a current
+    snapshot would keep the float64 matrix in memory besides the postings, so the
+    exact engine is loaded from the database then. inverted loads an InvertedIndex,
+    which prunes the postings of text queries.
+    """
+    if quantize is not None and inverted:
+        raise ValueError("quantize cannot be combined with inverted")
+    engine_class = InvertedIndex if inverted else SimilarityEngine
+    options = {}
+    if quantize is not None:
+        engine_class, options = QuantizedEngine, {'dtype': quantize}
+    try:
+        return engine_class.from_snapshot(snapshot_dir, connection, **options)
+    except (OSError, ValueError) as snapshot_err:
+        print(f"Loading vectors from the database, snapshot unavailable: {snapshot_err}")
+        if quantize is not None:
+            print("Quantized vectors need a current snapshot for re-ranking, using the exact engine")
+            engine_class = SimilarityEngine
+        return engine_class.from_connection(connection)
+
+def get_precomputed_neighbours(cur, wikipedia_movie_id, top_n):
+    """
+    Get similar movies from the precomputed similar_movies table.
+    Returns None when the table is missing, was built for another build of the
+    vectors or holds fewer than top_n neighbours per movie.
+    """
+    try:
+        cur.execute("SELECT value FROM tfidf_settings WHERE name='neighbours'")
+    except sqlite3.OperationalError:
+        return None
+    row = cur.fetchone()
+    if not row:
+        return None
+    neighbours = json.loads(row[0])
+    if neighbours['top_k'] < top_n or neighbours['build_id'] != get_build_id(cur):
+        return None
+    cur.execute("""SELECT similar_movie_id, similarity
+                   FROM similar_movies
+                   WHERE wikipedia_movie_id=?
+                   ORDER BY rank
+                   LIMIT ?""", (wikipedia_movie_id, top_n))
+    return cur.fetchall()
+
+def find_similar_movies(connection, wikipedia_movie_id, top_n=5, engine=None, cache=None, mode=MODE_SPARSE,
+                        filters=None, facets=None):
+    """
+    Find similar movies based on TF-IDF.
+    mode=MODE_SPARSE ranks by exact cosine similarity of the TF-IDF vectors,
+    mode=MODE_DENSE by approximate search over the SVD embeddings, in which
+    case engine must be a DenseIndex, and otherwise must not be one.
+    filters, e.g. {'genre': 'Comedy', 'decade': [1990, 2000]}, restricts the
+    results to matching movies through the facet bitmaps of the engine rows;
+    facets, a FacetIndex of the engine, is built from the database if not given.
+    The whole call and each of its stages are reported to the metrics sinks.
+    """
+    if mode not in (MODE_SPARSE, MODE_DENSE):
+        raise ValueError(f"Unknown similarity mode: {mode}")
+    # A mismatched engine would answer in the other mode and be cached under this one
+    if engine is not None and (mode == MODE_DENSE) != isinstance(engine, DenseIndex):
+        raise ValueError(f"A {type(engine).__name__} cannot answer {mode} similarity queries")
+    filters = normalize_filters(filters)
+    with timed('query.find_similar_movies', mode=mode):
+        cur = connection.cursor()
+
+        # A single indexed lookup when the neighbours were precomputed for this build,
+        # they are unfiltered so filtered queries are always scored
+        sorted_similarities = None
+        if mode == MODE_SPARSE and not filters:
+            with timed('query.precomputed_lookup'):
+                sorted_similarities = get_precomputed_neighbours(cur, wikipedia_movie_id, top_n)
+        cache_key = None
+        if sorted_similarities is None:
+            # Load the vectors unless a preloaded engine was supplied
+            if engine is None:
+                with timed('query.corpus_load', mode=mode):
+                    if mode == MODE_DENSE:
+                        engine = DenseIndex.from_connection(connection)
+                    else:
+                        engine = SimilarityEngine.from_connection(connection)
+
+            # Cached results are only valid for the build the engine was loaded from
+            if cache is not None:
+                cache_key = (wikipedia_movie_id, top_n, mode, filters)
+                cache.check_version(engine.build_id)
+                cached = cache.get(cache_key)
+                if cached is not None:
+                    increment('query.cache_hits')
+                    return list(cached)
+
+            mask = None
+            if filters:
+                if facets is None:
+                    with timed('query.facet_load'):
+                        facets = FacetIndex.from_connection(connection, engine.movie_ids)
+                if len(facets) != len(engine):
+                    raise ValueError("The facet index was built for other engine rows")
+                mask = facets.mask(filters)
+
+            # Matrix-vector product and partial sort of the top N similar movies,
+            # timed per stage by the engine
+            sorted_similarities = engine.similar_movies(wikipedia_movie_id, top_n, mask=mask)
+        else:
+            increment('query.precomputed_hits')
+
+        # Getting movie titles for identifiers
+        movie_ids = [movie_id for movie_id, _ in sorted_similarities]
+        if movie_ids:
+            with timed('query.name_lookup'):
+                movie_names = get_movie_names(cur, movie_ids)
+            similar_movies_with_names = [(movie_names[movie_id], score)
+                                         for movie_id, score in sorted_similarities
+                                         if movie_id in movie_names]
+        else:
+            similar_movies_with_names = []
+
+        if cache_key is not None:
+            cache.put(cache_key, tuple(similar_movies_with_names))
+        return similar_movies_with_names
+
+def find_similar_movies_batch(connection, wikipedia_movie_ids, top_n=5, engine=None):
+    """
+    Find similar movies for many movies at once, for exports and offline evaluation.
+    Results are streamed as (wikipedia_movie_id, [(similar_movie_id, similarity), ...])
+    pairs in the order of wikipedia_movie_ids, computed block by block.
+    """
+    if engine is None:
+        engine = SimilarityEngine.from_connection(connection)
+    yield from engine.similar_movies_batch(wikipedia_movie_ids, top_n)
+
+def search_by_text(connection, query, top_n=5, engine=None, vectorizer=None):
+    """ Find the movies whose plots best match a free-text query """
+    cur = connection.cursor()
+    if engine is None:
+        engine = SimilarityEngine.from_connection(connection)
+    if vectorizer is None:
+        vectorizer = load_vectorizer(connection)
+
+    # Project the query into the stored TF-IDF space and rank the movies against it
+    query_vector = vectorizer.transform([preprocess_text(query)])
+    ranked_movies = engine.similar_to_terms(query_vector.indices, query_vector.data, top_n)
+
+    movie_ids = [movie_id for movie_id, _ in ranked_movies]
+    if not movie_ids:
+        return []
+    movie_names = get_movie_names(cur, movie_ids)
+    return [(movie_names[movie_id], score)
+            for movie_id, score in ranked_movies
+            if movie_id in movie_names]
@@ -0,0 +1,78 @@
+"""
+Bounded LRU cache for query results of the Vector Model Application.
+Entries belong to one index version (the build ID of the TF-IDF vectors), and
+the whole cache is cleared as soon as a different version is seen, so results
+computed from an older model are never served.
+"""
+
+import sys
+import threading
+from collections import OrderedDict
+
+# Default limits of the similar-movies result cache
+CACHE_MAX_ENTRIES = 1024
+CACHE_MAX_BYTES = 16 * 1024 * 1024
+
+
+def estimate_size(value):
+    """ Roughly estimate the memory held by a cached value in bytes """
+    size = sys.getsizeof(value)
+    if isinstance(value, (list, tuple)):
+        size += sum(estimate_size(item) for item in value)
+    return size
+
+
+class LRUCache:
+    """ Least-recently-used cache limited by entry count and estimated size """
+
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, max_bytes=CACHE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.version = None
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def check_version(self, version):
+        """ Clear the cache if the index version changed since the entries were stored """
+        with self.lock:
+            if version != self.version:
+                self.entries.clear()
+                self.size = 0
+                self.version = version
+
+    def get(self, key, default=None):
+        """ Return a cached value and mark it as recently used """
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+
+    def put(self, key, value):
+        """ Store a value, evicting the least recently used entries over the limits """
+        size = estimate_size(value)
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+            if size > self.max_bytes:
+                return
+            self.entries[key] = (value, size)
+            self.size += size
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                self.size -= self.entries.popitem(last=False)[1][1]
+                self.evictions += 1
+
+    def stats(self):
+        """ Return the hit, miss and eviction counters and the current fill """
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(self.entries), 'bytes': self.size, 'version': self.version}
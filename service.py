@@ -0,0 +1,423 @@
+"""
+Headless HTTP/JSON search service for the Vector Model Application.
+One asyncio process serves many clients from a single read-only similarity
+engine loaded at startup. SQLite metadata queries run on a pool of read-only
+connections in worker threads, and similar-movie requests that arrive close
+together are answered by one batched matrix product.
+
+Endpoints (GET):
+    /health                          build ID and number of indexed movies
+    /search?q=TITLE&limit=N          title search
+    /similar?id=MOVIE_ID&top_n=N     movies with the most similar plots, optionally
+                                     filtered by genre, language, country and decade
+    /search_text?q=TEXT&top_n=N      movies whose plots best match free text
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from urllib.parse import parse_qs, urlsplit
+from urllib.request import pathname2url
+from facet_index import FACET_COLUMNS, FacetIndex, normalize_filters
+from metrics import increment, timed
+from quantized_engine import QUANTIZE_FLOAT16, QUANTIZE_INT8, QuantizedEngine
+from sharded_engine import ShardedEngine
+from queries import SEARCH_LIMIT, get_movie_names, load_engine, search_by_text, search_titles
+from vector_model import SNAPSHOT_DIR, load_vectorizer
+
+SERVICE_HOST = '127.0.0.1'
+SERVICE_PORT = 8080
+
+# Read-only SQLite connections, and worker threads using them
+POOL_SIZE = 4
+
+# Similar-movie requests are collected for up to BATCH_WINDOW seconds or BATCH_MAX_SIZE requests
+BATCH_WINDOW = 0.002
+BATCH_MAX_SIZE = 64
+
+# Largest top_n a client may ask for
+MAX_TOP_N = 100
+
+STATUS_TEXT = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+               500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+
+class RequestError(Exception):
+    """ Error answered with an HTTP status and a JSON error message """
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def open_read_only(db_file):
+    """ Open a read-only SQLite connection that may be used from any one thread at a time """
+    uri = f"file:{pathname2url(os.path.abspath(db_file))}?mode=ro"
+    return sqlite3.connect(uri, uri=True, check_same_thread=False)
+
+
+class ConnectionPool:
+    """ Fixed pool of read-only SQLite connections shared by the request handlers """
+
+    def __init__(self, db_file, size=POOL_SIZE):
+        self.all_connections = [open_read_only(db_file) for _ in range(size)]
+        self.idle = asyncio.Queue()
+        for connection in self.all_connections:
+            self.idle.put_nowait(connection)
+
+    @asynccontextmanager
+    async def connection(self):
+        """ Borrow a connection, waiting while all of them are in use """
+        connection = await self.idle.get()
+        try:
+            yield connection
+        finally:
+            self.idle.put_nowait(connection)
+
+    def close(self):
+        """ Close every connection """
+        for connection in self.all_connections:
+            connection.close()
+
+
+class SimilarBatcher:
+    """
+    Groups concurrent similar-movie requests into engine.similar_movies_batch calls.
+    A batch is run once BATCH_MAX_SIZE requests are waiting or BATCH_WINDOW after
+    its first request, with the largest top_n asked for in it. When a batch
+    fails, its requests are scored one by one so only the failing ones get the error.
+    """
+
+    def __init__(self, engine, executor, window=BATCH_WINDOW, max_size=BATCH_MAX_SIZE):
+        self.engine = engine
+        self.executor = executor
+        self.window = window
+        self.max_size = max_size
+        self.pending = []
+        self.timer = None
+        self.batches = 0
+        # Running batch tasks, the event loop itself only keeps weak references to them
+        self.tasks = set()
+
+    async def similar_movies(self, wikipedia_movie_id, top_n):
+        """ Return the (wikipedia_movie_id, similarity) pairs of one movie """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((wikipedia_movie_id, top_n, future))
+        if len(self.pending) >= self.max_size:
+            self.flush()
+        elif self.timer is None:
+            self.timer = loop.call_later(self.window, self.flush)
+        return await future
+
+    def flush(self):
+        """ Start scoring the waiting requests """
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending, []
+        if batch:
+            task = asyncio.ensure_future(self.run_batch(batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def run_batch(self, batch):
+        """ Score one batch in a worker thread and resolve its requests """
+        self.batches += 1
+        increment('service.similar_batch_size', len(batch))
+        movie_ids = [movie_id for movie_id, _, _ in batch]
+        top_n = max(top_n for _, top_n, _ in batch)
+        loop = asyncio.get_running_loop()
+        try:
+            results = await loop.run_in_executor(
+                self.executor, lambda: list(self.engine.similar_movies_batch(movie_ids, top_n)))
+        except Exception:  # pylint: disable=W0718
+            increment('service.similar_batch_errors')
+            outcomes = await loop.run_in_executor(self.executor, self.similar_movies_each, batch)
+            for (_, _, future), (similar, error) in zip(batch, outcomes):
+                if future.done():
+                    continue
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(similar)
+            return
+        for (_, request_top_n, future), (_, similar) in zip(batch, results):
+            if not future.done():
+                future.set_result(similar[:request_top_n])
+
+    def similar_movies_each(self, batch):
+        """ Score the requests of a failed batch one by one, returning (result, error) pairs """
+        outcomes = []
+        for movie_id, top_n, _ in batch:
+            try:
+                outcomes.append((self.engine.similar_movies(movie_id, top_n), None))
+            except Exception as request_err:  # pylint: disable=W0718
+                outcomes.append((None, request_err))
+        return outcomes
+
+
+def get_parameter(params, name, convert=str, default=None):
+    """ Get a query string parameter, raising a 400 RequestError if it is missing or malformed """
+    values = params.get(name)
+    if not values:
+        if default is None:
+            raise RequestError(400, f"Missing parameter: {name}")
+        return default
+    try:
+        return convert(values[0])
+    except ValueError as convert_err:
+        raise RequestError(400, f"Invalid parameter {name}: {values[0]}") from convert_err
+
+
+def get_count(params, name, default, maximum):
+    """ Get a positive count parameter capped at maximum """
+    count = get_parameter(params, name, int, default)
+    if count < 1:
+        raise RequestError(400, f"Parameter {name} must be positive")
+    return min(count, maximum)
+
+
+class SearchService:
+    """ Request handlers and HTTP transport of the search service """
+
+    def __init__(self, db_file, snapshot_dir=SNAPSHOT_DIR, pool_size=POOL_SIZE, engine=None, quantize=None,
+                 inverted=False):
+        self.executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix='service')
+        self.pool = ConnectionPool(db_file, pool_size)
+        connection = self.pool.all_connections[0]
+        # Loaded once and only read afterwards, shared by every request
+        self.engine = engine if engine is not None else load_engine(connection, snapshot_dir, quantize, inverted)
+        if isinstance(self.engine, QuantizedEngine):
+            print(f"Quantized vectors ({self.engine.dtype}): {self.engine.nbytes / 2**20:.1f} MiB, "
+                  f"recall@10 {self.engine.recall():.3f}")
+        self.facets = FacetIndex.from_connection(connection, self.engine.movie_ids)
+        try:
+            self.vectorizer = load_vectorizer(connection)
+        except ValueError as vectorizer_err:
+            print(f"Plot text search disabled: {vectorizer_err}")
+            self.vectorizer = None
+        self.batcher = SimilarBatcher(self.engine, self.executor)
+        self.routes = {
+            '/health': self.health,
+            '/search': self.search,
+            '/similar': self.similar,
+            '/search_text': self.search_text,
+        }
+
+    async def run_query(self, function, *args):
+        """ Run function(connection, *args) on a pooled connection in a worker thread """
+        async with self.pool.connection() as connection:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, function, connection, *args)
+
+    async def health(self, _params):
+        """ Report the loaded build """
+        return {'status': 'ok', 'build_id': self.engine.build_id, 'movies': len(self.engine)}
+
+    async def search(self, params):
+        """ Search movies by title """
+        query = get_parameter(params, 'q')
+        limit = get_count(params, 'limit', SEARCH_LIMIT, SEARCH_LIMIT)
+        rows = await self.run_query(search_titles, query, limit)
+        return {'results': [{'wikipedia_movie_id': movie_id, 'movie_name': name,
+                             'movie_genres': genres, 'movie_release_date': release_date}
+                            for name, genres, release_date, movie_id in rows]}
+
+    async def similar(self, params):
+        """ Find the movies with the most similar plots, among those matching the facet parameters """
+        movie_id = get_parameter(params, 'id', int)
+        top_n = get_count(params, 'top_n', 5, MAX_TOP_N)
+        try:
+            filters = normalize_filters({facet: params[facet] for facet in FACET_COLUMNS if facet in params})
+        except ValueError as filter_err:
+            raise RequestError(400, f"Invalid filter: {filter_err}") from filter_err
+        if movie_id not in self.engine:
+            raise RequestError(404, f"Unknown movie: {movie_id}")
+        if filters:
+            # Filtered queries each have their own mask, so they are not batched
+            mask = self.facets.mask(filters)
+            similar = await asyncio.get_running_loop().run_in_executor(
+                self.executor, lambda: self.engine.similar_movies(movie_id, top_n, mask=mask))
+        else:
+            similar = await self.batcher.similar_movies(movie_id, top_n)
+        names = await self.run_query(lambda connection: get_movie_names(connection.cursor(),
+                                                                        [m for m, _ in similar]))
+        return {'wikipedia_movie_id': movie_id,
+                'results': [{'wikipedia_movie_id': similar_id, 'movie_name': names[similar_id],
+                             'similarity': score}
+                            for similar_id, score in similar if similar_id in names]}
+
+    async def search_text(self, params):
+        """ Find the movies whose plots best match free text """
+        if self.vectorizer is None:
+            raise RequestError(503, "No fitted vocabulary is stored")
+        query = get_parameter(params, 'q')
+        top_n = get_count(params, 'top_n', 5, MAX_TOP_N)
+        results = await self.run_query(search_by_text, query, top_n, self.engine, self.vectorizer)
+        return {'results': [{'movie_name': name, 'similarity': score} for name, score in results]}
+
+    async def handle_request(self, method, target):
+        """
+        Answer one request.
+
+        Returns:
+            tuple: (HTTP status, JSON-serialisable payload)
+        """
+        url = urlsplit(target)
+        handler = self.routes.get(url.path)
+        if handler is None:
+            return 404, {'error': f"Unknown path: {url.path}"}
+        if method != 'GET':
+            return 405, {'error': f"Method not allowed: {method}"}
+        try:
+            with timed('service.request', path=url.path):
+                return 200, await handler(parse_qs(url.query))
+        except RequestError as request_err:
+            return request_err.status, {'error': str(request_err)}
+        except sqlite3.Error as db_err:
+            return 500, {'error': f"Database error: {db_err}"}
+        except Exception:  # pylint: disable=W0718
+            # Any other failure is still answered, otherwise the client gets a closed connection
+            logging.getLogger('service').exception("Error answering %s %s", method, target)
+            return 500, {'error': "Internal server error"}
+
+    async def handle_connection(self, reader, writer):
+        """ Serve HTTP/1.1 requests on one client connection, keeping it open unless asked not to """
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                headers = {}
+                while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                if int(headers.get('content-length', 0)):
+                    await reader.readexactly(int(headers['content-length']))  # Bodies are ignored
+
+                parts = request_line.decode('latin-1').split()
+                if len(parts) != 3:
+                    status, payload = 400, {'error': "Malformed request line"}
+                else:
+                    status, payload = await self.handle_request(parts[0], parts[1])
+                keep_alive = headers.get('connection', '').lower() != 'close' and len(parts) == 3
+                body = json.dumps(payload).encode('utf-8')
+                writer.write(f"HTTP/1.1 {status} {STATUS_TEXT[status]}\r\n"
+                             f"Content-Type: application/json\r\n"
+                             f"Content-Length: {len(body)}\r\n"
+                             f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode('latin-1')
+                             + body)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host=SERVICE_HOST, port=SERVICE_PORT):
+        """ Accept connections until cancelled """
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        print(f"Serving on http://{host}:{port}")
+        async with server:
+            await server.serve_forever()
+
+    def close(self):
+        """ Release the worker threads and connections """
+        self.executor.shutdown()
+        self.pool.close()
+
+
+class _BufferWriter:
+    """ Stand-in for asyncio.StreamWriter that collects the response in memory """
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def write(self, data):
+        """ Append response bytes to the buffer """
+        self.buffer.extend(data)
+
+    async def drain(self):
+        """ Nothing to flush, the buffer is in memory """
+
+    def close(self):
+        """ Nothing to release, the buffer stays readable """
+
+
+class LocalClient:
+    """ Client that exercises a service through its HTTP handling over in-memory streams, without any network """
+
+    def __init__(self, service):
+        self.service = service
+
+    async def request(self, method, target):
+        """
+        Send one request.
+
+        Returns:
+            tuple: (HTTP status, decoded JSON payload)
+        """
+        reader = asyncio.StreamReader()
+        reader.feed_data(f"{method} {target} HTTP/1.1\r\nHost: local\r\nConnection: close\r\n\r\n".encode('latin-1'))
+        reader.feed_eof()
+        writer = _BufferWriter()
+        await self.service.handle_connection(reader, writer)
+        head, _, body = bytes(writer.buffer).partition(b'\r\n\r\n')
+        status = int(head.split(b' ', 2)[1])
+        return status, json.loads(body)
+
+    async def get(self, target):
+        """ Send a GET request """
+        return await self.request('GET', target)
+
+
+def main():
+    """main function to run the service"""
+    parser = argparse.ArgumentParser(description="Serve the vector model over HTTP/JSON.")
+    parser.add_argument('--db', default='movies.db', help="SQLite database (default: movies.db)")
+    parser.add_argument('--snapshot', default=SNAPSHOT_DIR,
+                        help=f"matrix snapshot directory, used when current (default: {SNAPSHOT_DIR})")
+    parser.add_argument('--host', default=SERVICE_HOST, help=f"address to listen on (default: {SERVICE_HOST})")
+    parser.add_argument('--port', type=int, default=SERVICE_PORT, help=f"port to listen on (default: {SERVICE_PORT})")
+    parser.add_argument('--shards', type=int, default=0,
+                        help="score in this many worker processes, one per movie ID range (default: in process)")
+    parser.add_argument('--quantize', choices=(QUANTIZE_FLOAT16, QUANTIZE_INT8),
+                        help="score on quantized vectors, re-ranking the best candidates exactly")
+    parser.add_argument('--inverted', action='store_true',
+                        help="score on an inverted index that prunes the postings of low-impact terms")
+    parser.add_argument('--pool-size', type=int, default=POOL_SIZE,
+                        help=f"read-only SQLite connections and worker threads (default: {POOL_SIZE})")
+    args = parser.parse_args()
+    if args.shards and args.quantize:
+        parser.error("--quantize cannot be combined with --shards")
+    if args.inverted and (args.shards or args.quantize):
+        parser.error("--inverted cannot be combined with --shards or --quantize")
+
+    engine = None
+    if args.shards:
+        connection = open_read_only(args.db)
+        try:
+            engine = ShardedEngine.from_snapshot(args.snapshot, args.shards, connection)
+        except (OSError, ValueError) as snapshot_err:
+            print(f"Sharding vectors from the database, snapshot unavailable: {snapshot_err}")
+            engine = ShardedEngine.from_connection(connection, args.shards)
+        connection.close()
+    service = SearchService(args.db, args.snapshot, args.pool_size, engine, args.quantize,
+                            args.inverted)
+    try:
+        asyncio.run(service.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
+        if engine is not None:
+            engine.close()
+
+if __name__ == "__main__":
+    main()
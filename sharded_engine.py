@@ -0,0 +1,235 @@
+"""
+Multi-process sharded similarity search for the Vector Model Application.
+The TF-IDF matrix is split by movie ID range into shards, each held by its own
+worker process. A query fans out to every shard, each shard returns its partial
+top N, and the coordinator merges them. Scoring runs on all cores at once, and
+no single process holds the whole corpus: shards loaded from a snapshot are
+slices of the shared memory-mapped files.
+"""
+
+import heapq
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from scipy.sparse import csr_matrix
+from matrix_snapshot import load_snapshot
+from similarity_engine import (BATCH_BLOCK_SIZE, SimilarityEngine, block_dot_products, divide_by_norms,
+                               load_sparse_matrix, top_n_per_row)
+from tfidf_storage import get_build_id
+
+# Engine of the shard held by a worker process
+_shard_engine = None
+
+
+def shard_bounds(n_rows, n_shards):
+    """ Split n_rows matrix rows into n_shards contiguous (start, end) ranges of near-equal size """
+    edges = np.linspace(0, n_rows, max(1, min(n_shards, n_rows)) + 1).astype(np.int64)
+    return list(zip(edges[:-1].tolist(), edges[1:].tolist()))
+
+
+def slice_rows(matrix, start, end):
+    """ Take rows start:end of a CSR matrix, keeping data and indices as views of the original arrays """
+    first, last = matrix.indptr[start], matrix.indptr[end]
+    return csr_matrix((matrix.data[first:last], matrix.indices[first:last],
+                       np.asarray(matrix.indptr[start:end + 1]) - first),
+                      shape=(end - start, matrix.shape[1]), copy=False)
+
+
+def _init_shard(matrix, movie_ids, norms):
+    """ Hold one shard in a worker process """
+    global _shard_engine
+    _shard_engine = SimilarityEngine(matrix, movie_ids, norms)
+
+
+def _init_snapshot_shard(directory, build_id, start, end):
+    """ Map a snapshot in a worker process and hold rows start:end of it """
+    matrix, movie_ids, norms = load_snapshot(directory, build_id)
+    _init_shard(slice_rows(matrix, start, end), movie_ids[start:end], norms[start:end])
+
+
+def _shard_vector(wikipedia_movie_id):
+    """ Return the (indices, values) of a movie of the shard, or None """
+    row = _shard_engine.rows.get(wikipedia_movie_id)
+    if row is None:
+        return None
+    start, end = _shard_engine.matrix.indptr[row], _shard_engine.matrix.indptr[row + 1]
+    return np.array(_shard_engine.matrix.indices[start:end]), np.array(_shard_engine.matrix.data[start:end])
+
+
+def _shard_vectors(wikipedia_movie_ids):
+    """ Return the (indices, values) of several movies of the shard in one call """
+    return [_shard_vector(movie_id) for movie_id in wikipedia_movie_ids]
+
+
+def _shard_similar(terms, weights, top_n, exclude_id, mask=None):
+    """ Return the partial top N of the shard for a sparse query, among the rows of mask if given """
+    return _shard_engine.similar_to_terms(terms, weights, top_n, _shard_engine.rows.get(exclude_id), mask)
+
+
+def _shard_similar_block(queries, exclude_ids, top_n):
+    """ Return the partial top N of the shard for every row of a query matrix """
+    engine = _shard_engine
+    query_norms = np.sqrt(np.asarray(queries.multiply(queries).sum(axis=1)).ravel())
+    scores = divide_by_norms(block_dot_products(engine.matrix, queries), query_norms, engine.norms)
+    for query, exclude_id in enumerate(exclude_ids):
+        row = engine.rows.get(exclude_id)
+        if row is not None:
+            scores[query, row] = 0.0
+    best, best_scores = top_n_per_row(scores, top_n)
+    partials = []
+    for columns, similarities in zip(best, best_scores):
+        positive = similarities > 0
+        partials.append(list(zip(engine.movie_ids[columns[positive]].tolist(), similarities[positive].tolist())))
+    return partials
+
+
+def merge_top_n(partials, top_n):
+    """ Merge per-shard top N lists into the overall top N, lower movie ID first among equal scores """
+    return heapq.nsmallest(top_n, (pair for partial in partials for pair in partial),
+                           key=lambda pair: (-pair[1], pair[0]))
+
+
+class ShardedEngine:
+    """ Similarity engine fanning queries out to one worker process per movie ID range """
+
+    def __init__(self, executors, boundaries, n_columns, movie_ids, build_id=None):
+        self.executors = executors
+        self.boundaries = np.asarray(boundaries, dtype=np.int64)
+        self.n_columns = n_columns
+        self.movie_ids = np.asarray(movie_ids, dtype=np.int64)
+        self.build_id = build_id
+        # Shard i holds rows row_bounds[i]:row_bounds[i + 1] of movie_ids
+        self.row_bounds = np.concatenate([[0], np.searchsorted(self.movie_ids, self.boundaries),
+                                          [len(self.movie_ids)]]).astype(np.int64)
+
+    @classmethod
+    def from_matrix(cls, matrix, movie_ids, n_shards, build_id=None):
+        """ Shard an in-memory matrix, sending every worker a copy of its rows """
+        matrix = csr_matrix(matrix)
+        movie_ids = np.asarray(movie_ids, dtype=np.int64)
+        # Shards cover movie ID ranges, so rows are ordered by movie ID first
+        order = np.argsort(movie_ids, kind='stable')
+        matrix, movie_ids = matrix[order], movie_ids[order]
+        norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+        bounds = shard_bounds(len(movie_ids), n_shards)
+        executors = [ProcessPoolExecutor(max_workers=1, initializer=_init_shard,
+                                         initargs=(matrix[start:end], movie_ids[start:end], norms[start:end]))
+                     for start, end in bounds]
+        return cls(executors, [movie_ids[start] for start, _ in bounds[1:]], matrix.shape[1], movie_ids, build_id)
+
+    @classmethod
+    def from_connection(cls, conn, n_shards):
+        """ Shard the stored TF-IDF vectors """
+        return cls.from_matrix(*load_sparse_matrix(conn), n_shards, build_id=get_build_id(conn.cursor()))
+
+    @classmethod
+    def from_snapshot(cls, directory, n_shards, conn=None):
+        """
+        Shard a memory-mapped snapshot, every worker mapping the files and holding
+        only its rows. When a connection is given, a snapshot of another build is rejected.
+        """
+        build_id = get_build_id(conn.cursor()) if conn is not None else None
+        if conn is not None and build_id is None:
+            raise ValueError("The database has no recorded build to check the snapshot against")
+        matrix, movie_ids, _ = load_snapshot(directory, build_id)
+        if np.any(np.diff(movie_ids) < 0):
+            raise ValueError("Snapshot rows are not ordered by movie ID")
+        bounds = shard_bounds(len(movie_ids), n_shards)
+        executors = [ProcessPoolExecutor(max_workers=1, initializer=_init_snapshot_shard,
+                                         initargs=(directory, build_id, start, end))
+                     for start, end in bounds]
+        return cls(executors, [int(movie_ids[start]) for start, _ in bounds[1:]], matrix.shape[1],
+                   np.array(movie_ids), build_id)
+
+    def __len__(self):
+        return len(self.movie_ids)
+
+    def __contains__(self, wikipedia_movie_id):
+        position = np.searchsorted(self.movie_ids, wikipedia_movie_id)
+        return bool(position < len(self.movie_ids) and self.movie_ids[position] == wikipedia_movie_id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def shard_of(self, wikipedia_movie_id):
+        """ Index of the shard whose movie ID range holds a movie """
+        return int(np.searchsorted(self.boundaries, wikipedia_movie_id, side='right'))
+
+    def get_vector(self, wikipedia_movie_id):
+        """ Fetch the (indices, values) of a movie from its shard, or None if it is unknown """
+        if wikipedia_movie_id not in self:
+            return None
+        return self.executors[self.shard_of(wikipedia_movie_id)].submit(_shard_vector, wikipedia_movie_id).result()
+
+    def get_vectors(self, wikipedia_movie_ids):
+        """
+        Fetch the (indices, values) of known movies with one call per shard holding any of them.
+
+        Returns:
+            list: (indices, values) pairs in the order of wikipedia_movie_ids.
+        """
+        by_shard = {}
+        for movie_id in wikipedia_movie_ids:
+            by_shard.setdefault(self.shard_of(movie_id), []).append(movie_id)
+        futures = {shard: self.executors[shard].submit(_shard_vectors, movie_ids)
+                   for shard, movie_ids in by_shard.items()}
+        vectors = {}
+        for shard, movie_ids in by_shard.items():
+            vectors.update(zip(movie_ids, futures[shard].result()))
+        return [vectors[movie_id] for movie_id in wikipedia_movie_ids]
+
+    def similar_to_terms(self, terms, weights, top_n=5, exclude_id=None, mask=None):
+        """
+        Find the top_n movies most similar to a sparse query across all shards.
+        mask, a boolean array over movie_ids, is split into the rows of every shard.
+        """
+        futures = [executor.submit(_shard_similar, terms, weights, top_n, exclude_id,
+                                   None if mask is None else mask[start:end])
+                   for executor, start, end in zip(self.executors, self.row_bounds[:-1], self.row_bounds[1:])]
+        return merge_top_n([future.result() for future in futures], top_n)
+
+    def similar_movies(self, wikipedia_movie_id, top_n=5, mask=None):
+        """
+        Find the top_n movies most similar to the given movie, among the rows of mask if given.
+
+        Returns:
+            list: (wikipedia_movie_id, similarity) pairs sorted by descending similarity.
+        """
+        vector = self.get_vector(wikipedia_movie_id)
+        if vector is None:
+            return []
+        return self.similar_to_terms(*vector, top_n, exclude_id=wikipedia_movie_id, mask=mask)
+
+    def similar_movies_batch(self, wikipedia_movie_ids, top_n=5, block_size=BATCH_BLOCK_SIZE):
+        """
+        Find the top_n most similar movies of many movies, one fan-out per block.
+
+        Yields:
+            tuple: (wikipedia_movie_id, list of (wikipedia_movie_id, similarity) pairs)
+                in the order of wikipedia_movie_ids, empty for unknown movies.
+        """
+        wikipedia_movie_ids = list(wikipedia_movie_ids)
+        for start in range(0, len(wikipedia_movie_ids), block_size):
+            block_ids = wikipedia_movie_ids[start:start + block_size]
+            known = [movie_id for movie_id in block_ids if movie_id in self]
+            results = {}
+            if known and top_n > 0:
+                vectors = self.get_vectors(known)
+                indptr = np.cumsum([0] + [len(indices) for indices, _ in vectors])
+                queries = csr_matrix((np.concatenate([values for _, values in vectors]),
+                                      np.concatenate([indices for indices, _ in vectors]), indptr),
+                                     shape=(len(known), self.n_columns))
+                futures = [executor.submit(_shard_similar_block, queries, known, top_n)
+                           for executor in self.executors]
+                partials = [future.result() for future in futures]
+                for query, movie_id in enumerate(known):
+                    results[movie_id] = merge_top_n([partial[query] for partial in partials], top_n)
+            for movie_id in block_ids:
+                yield movie_id, results.get(movie_id, [])
+
+    def close(self):
+        """ Stop the shard worker processes """
+        for executor in self.executors:
+            executor.shutdown()
@@ -0,0 +1,202 @@
+"""
+In-memory similarity engine for the Vector Model Application.
+Loads the sparse TF-IDF vectors from the database once into a SciPy CSR matrix
+with precomputed row norms, so that a top-N cosine similarity query is a single
+sparse matrix-vector product followed by a partial sort.
+"""
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from matrix_snapshot import load_snapshot
+from metrics import timed
+from tfidf_storage import get_build_id, load_blob_matrix, uses_blob_storage
+
+# Number of query movies scored per sparse matrix product in batch queries
+BATCH_BLOCK_SIZE = 256
+
+# One sparse_tfidf row as loaded by load_sparse_matrix
+SPARSE_ROW_DTYPE = np.dtype([('wikipedia_movie_id', np.int64), ('tfidf_index', np.int64),
+                             ('tfidf_value', np.float64)])
+
+
+def load_sparse_matrix(conn):
+    """
+    Load the stored TF-IDF vectors into a CSR matrix.
+
+    Parameters:
+        conn (Connection): A connection object to the SQLite database.
+
+    Returns:
+        tuple: (csr_matrix, numpy array of wikipedia_movie_id per matrix row)
+    """
+    cur = conn.cursor()
+    if uses_blob_storage(cur):
+        return load_blob_matrix(conn)
+    cur.execute("SELECT wikipedia_movie_id, tfidf_index, tfidf_value FROM sparse_tfidf")
+    # Rows go straight from the cursor into typed columns, never held as a list of tuples
+    columns = np.fromiter(cur, dtype=SPARSE_ROW_DTYPE)
+    if not columns.size:
+        return csr_matrix((0, 0)), np.empty(0, dtype=np.int64)
+
+    movie_ids, row_indices = np.unique(columns['wikipedia_movie_id'], return_inverse=True)
+    tfidf_indices = columns['tfidf_index']
+    matrix = csr_matrix((columns['tfidf_value'], (row_indices, tfidf_indices)),
+                        shape=(len(movie_ids), int(tfidf_indices.max()) + 1))
+    return matrix, movie_ids
+
+
+def top_n_indices(scores, top_n):
+    """ Return the indices of the top_n highest positive scores, best first """
+    candidates = np.flatnonzero(scores > 0)
+    if top_n <= 0 or candidates.size == 0:
+        return candidates[:0]
+    if candidates.size > top_n:
+        partition = np.argpartition(-scores[candidates], top_n - 1)[:top_n]
+        candidates = candidates[partition]
+    # Stable sort keeps the lower row first among equal scores
+    return candidates[np.argsort(-scores[candidates], kind='stable')]
+
+
+def block_dot_products(matrix, queries):
+    """
+    Dense dot products of every query row with every matrix row.
+    Only the small query block is transposed, so no transposed copy of the
+    whole matrix is built or kept, and a memory-mapped matrix stays on disk.
+    """
+    return (matrix @ queries.T).T.toarray()
+
+
+def divide_by_norms(dots, row_norms, column_norms):
+    """
+    Turn a dense block of dot products into cosine similarities in place,
+    broadcasting the norms instead of building their block x N outer product.
+    Entries of zero-norm rows or columns stay zero, as their dot products are.
+    """
+    np.divide(dots, column_norms, out=dots, where=column_norms > 0)
+    np.divide(dots, row_norms[:, np.newaxis], out=dots, where=row_norms[:, np.newaxis] > 0)
+    return dots
+
+
+def top_n_per_row(scores, top_n):
+    """
+    Select the top_n columns of every row of a dense score matrix at once.
+
+    Returns:
+        tuple: (columns, scores) arrays of shape (rows, top_n), best column of a row first.
+    """
+    top_n = min(top_n, scores.shape[1])
+    best = np.argpartition(-scores, top_n - 1, axis=1)[:, :top_n]
+    best_scores = np.take_along_axis(scores, best, axis=1)
+    order = np.argsort(-best_scores, axis=1, kind='stable')
+    return np.take_along_axis(best, order, axis=1), np.take_along_axis(best_scores, order, axis=1)
+
+
+class SimilarityEngine:
+    """ Cosine similarity search over a CSR matrix of TF-IDF vectors """
+
+    def __init__(self, matrix, movie_ids, norms=None, build_id=None):
+        self.build_id = build_id
+        self.matrix = csr_matrix(matrix)
+        self.movie_ids = np.asarray(movie_ids, dtype=np.int64)
+        self.rows = {int(movie_id): row for row, movie_id in enumerate(self.movie_ids.tolist())}
+        if norms is None:
+            norms = np.sqrt(np.asarray(self.matrix.multiply(self.matrix).sum(axis=1)).ravel())
+        self.norms = norms
+
+    @classmethod
+    def from_connection(cls, conn):
+        """ Build the engine from the stored TF-IDF vectors """
+        build_id = get_build_id(conn.cursor())
+        return cls(*load_sparse_matrix(conn), build_id=build_id)
+
+    @classmethod
+    def from_snapshot(cls, directory, conn=None, verify=False):
+        """
+        Build the engine from a memory-mapped snapshot.
+        When a connection is given, a snapshot of another database build is rejected.
+        """
+        build_id = get_build_id(conn.cursor()) if conn is not None else None
+        if conn is not None and build_id is None:
+            raise ValueError("The database has no recorded build to check the snapshot against")
+        return cls(*load_snapshot(directory, build_id, verify), build_id=build_id)
+
+    def __len__(self):
+        return len(self.movie_ids)
+
+    def __contains__(self, wikipedia_movie_id):
+        return wikipedia_movie_id in self.rows
+
+    def scores_for_vector(self, vector, vector_norm=None):
+        """ Calculate cosine similarities between a dense query vector and every row """
+        if vector_norm is None:
+            vector_norm = np.sqrt(np.dot(vector, vector))
+        dots = self.matrix.dot(vector)
+        denominators = self.norms * vector_norm
+        return np.divide(dots, denominators, out=np.zeros_like(dots), where=denominators > 0)
+
+    def similar_to_vector(self, vector, top_n=5, exclude_row=None, mask=None):
+        """
+        Find the top_n movies most similar to a dense query vector.
+        mask, a boolean array over the rows, restricts the results to the rows where it is True.
+        """
+        with timed('query.score'):
+            scores = self.scores_for_vector(vector)
+            if mask is not None:
+                # Rows outside the filter score zero and are never selected
+                np.multiply(scores, mask, out=scores)
+        if exclude_row is not None:
+            scores[exclude_row] = 0.0
+        with timed('query.sort'):
+            best = top_n_indices(scores, top_n)
+        return [(int(self.movie_ids[row]), float(scores[row])) for row in best]
+
+    def similar_to_terms(self, terms, weights, top_n=5, exclude_row=None, mask=None):
+        """ Find the top_n movies most similar to a sparse query of column indices and weights """
+        terms = np.asarray(terms, dtype=np.int64)
+        in_vocabulary = terms < self.matrix.shape[1]
+        vector = np.zeros(self.matrix.shape[1])
+        vector[terms[in_vocabulary]] = np.asarray(weights, dtype=np.float64)[in_vocabulary]
+        return self.similar_to_vector(vector, top_n, exclude_row, mask)
+
+    def similar_movies(self, wikipedia_movie_id, top_n=5, mask=None):
+        """
+        Find the top_n movies most similar to the given movie, among the rows of mask if given.
+
+        Returns:
+            list: (wikipedia_movie_id, similarity) pairs sorted by descending similarity.
+        """
+        row = self.rows.get(wikipedia_movie_id)
+        if row is None:
+            return []
+        with timed('query.vector_fetch'):
+            vector = self.matrix[row].toarray().ravel()
+        return self.similar_to_vector(vector, top_n, exclude_row=row, mask=mask)
+
+    def similar_movies_batch(self, wikipedia_movie_ids, top_n=5, block_size=BATCH_BLOCK_SIZE):
+        """
+        Find the top_n most similar movies of many movies.
+        Each block of block_size query movies is scored with one sparse
+        matrix-matrix product and its top N are selected for all rows at once.
+
+        Yields:
+            tuple: (wikipedia_movie_id, list of (wikipedia_movie_id, similarity) pairs)
+                in the order of wikipedia_movie_ids, empty for unknown movies.
+        """
+        wikipedia_movie_ids = list(wikipedia_movie_ids)
+        for start in range(0, len(wikipedia_movie_ids), block_size):
+            block_ids = wikipedia_movie_ids[start:start + block_size]
+            rows = np.array([self.rows.get(movie_id, -1) for movie_id in block_ids])
+            known = rows >= 0
+            results = {}
+            if top_n > 0 and known.any():
+                block_rows = rows[known]
+                scores = divide_by_norms(block_dot_products(self.matrix, self.matrix[block_rows]),
+                                         self.norms[block_rows], self.norms)
+                scores[np.arange(len(block_rows)), block_rows] = 0.0  # A movie is not its own neighbour
+                best, best_scores = top_n_per_row(scores, top_n)
+                for row, columns, similarities in zip(block_rows.tolist(), best, best_scores):
+                    positive = similarities > 0
+                    results[row] = list(zip(self.movie_ids[columns[positive]].tolist(),
+                                            similarities[positive].tolist()))
+            for movie_id, row in zip(block_ids, rows.tolist()):
+                yield movie_id, results.get(row, [])
@@ -0,0 +1,59 @@
+""" Tests for benchmark.py """
+import sys
+import os
+import sqlite3
+import pytest
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from benchmark import make_corpus, summarize, measure, run_benchmarks, compare_results
+
+def test_make_corpus():
+    """Test generating a synthetic corpus with titles and plots."""
+    conn = sqlite3.connect(":memory:")
+    vocabulary = make_corpus(conn, n_documents=20, words_per_document=10, vocabulary_size=50)
+    assert len(vocabulary) == 50
+    cur = conn.cursor()
+    cur.execute("SELECT COUNT(*) FROM plot_summaries")
+    assert cur.fetchone()[0] == 20
+    cur.execute("SELECT COUNT(*) FROM movie_titles")
+    assert cur.fetchone()[0] == 20
+    conn.close()
+
+def test_summarize():
+    """Test reporting run times as millisecond percentiles."""
+    summary = summarize([0.001 * i for i in range(1, 101)], 123)
+    assert summary['p50_ms'] == pytest.approx(50.5)
+    assert summary['p99_ms'] == pytest.approx(99.01)
+    assert summary['runs'] == 100
+    assert summary['peak_memory_bytes'] == 123
+
+def test_measure():
+    """Test that measure times every call and traces its allocations."""
+    calls = []
+    result = measure(lambda size: calls.append(bytearray(size)), [(1_000_000,), (10,)])
+    assert len(calls) == 3  # Two timed runs and one traced run
+    assert result['runs'] == 2
+    assert result['peak_memory_bytes'] >= 1_000_000
+
+def test_run_benchmarks(tmp_path):
+    """Test a complete run on a tiny corpus."""
+    results = run_benchmarks(str(tmp_path / "benchmark.db"), n_documents=30, n_queries=5, build_runs=1)
+    assert set(results['results']) == {'preprocess_text', 'process_and_save_documents', 'save_tfidf_values',
+                                       'search_movies', 'find_similar_movies', 'find_similar_movies_float16',
+                                       'find_similar_movies_int8'}
+    assert results['results']['find_similar_movies']['runs'] == 5
+    assert results['results']['find_similar_movies_int8']['recall'] >= 0.9
+    assert results['results']['find_similar_movies_int8']['memory_bytes'] < results['matrix_bytes']
+    assert compare_results(results, results) == []
+
+def test_compare_results():
+    """Test flagging benchmarks that became slower than the tolerance."""
+    baseline = {'results': {'a': {'p50_ms': 10.0}, 'b': {'p50_ms': 10.0}}}
+    current = {'results': {'a': {'p50_ms': 11.0}, 'b': {'p50_ms': 13.0}, 'c': {'p50_ms': 1.0}}}
+    assert compare_results(baseline, current, tolerance=1.2) == [('b', 10.0, 13.0)]
+
+def test_run_benchmarks_refuses_existing_database(tmp_path):
+    """Test that the benchmark never drops the tables of an existing database."""
+    db_path = tmp_path / "movies.db"
+    db_path.touch()
+    with pytest.raises(FileExistsError):
+        run_benchmarks(str(db_path), n_documents=5, n_queries=1, build_runs=1)
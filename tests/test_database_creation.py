@@ -0,0 +1,68 @@
+""" Tests for database_creation.py """
+import sys
+import os
+import sqlite3
+import pytest
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from database_creation import create_database, create_title_index
+
+@pytest.fixture(name="sources")
+def fixture_sources(tmp_path):
+    """Fixture for small metadata CSV and plot summaries TSV files."""
+    metadata_path = tmp_path / "movie_metadata.csv"
+    metadata_path.write_text(
+        '975900,/m/03vyhn,Ghosts of Mars,2001-08-24,14010832,98.0,English Language,United States of America,"Thriller, Space western"\n'
+        '3196793,/m/08yl5d,Getting Away with Murder,2000-02-16,,95.0,English Language,United States of America,Drama\n'
+        '28463795,/m/0crgdbh,Brun bitter,1988,,83.0,Norwegian Language,Norway,"Crime Fiction, Drama"\n'
+        '28463795,/m/0crgdbh,Brun bitter,1988,,83.0,Norwegian Language,Norway,"Crime Fiction, Drama"\n',
+        encoding='utf-8')
+    summaries_path = tmp_path / "plot_summaries.txt"
+    summaries_path.write_text(
+        "975900\tSet in the second half of the 22nd century, the film depicts Mars.\n"
+        "28463795\tA young man returns home.\n",
+        encoding='utf-8')
+    return str(metadata_path), str(summaries_path), str(tmp_path / "movies.db")
+
+def test_create_database(sources):
+    """Test loading the sources into typed, keyed tables in small chunks."""
+    db_path = create_database(*sources, chunk_size=2)
+    conn = sqlite3.connect(db_path)
+    cur = conn.cursor()
+    cur.execute("SELECT * FROM movies ORDER BY wikipedia_movie_id")
+    rows = cur.fetchall()
+    assert len(rows) == 3  # The repeated movie is stored once
+    assert rows[0] == (975900, '/m/03vyhn', 'Ghosts of Mars', '2001-08-24', 14010832.0, 98.0,
+                       'English Language', 'United States of America', 'Thriller, Space western')
+    assert rows[1][4] is None  # Missing revenue
+    assert rows[2][3] == '1988'
+
+    cur.execute("SELECT plot_summary FROM plot_summaries WHERE wikipedia_movie_id=28463795")
+    assert cur.fetchone() == ('A young man returns home.',)
+    cur.execute("SELECT name, pk FROM pragma_table_info('plot_summaries') WHERE pk")
+    assert cur.fetchall() == [('wikipedia_movie_id', 1)]
+    conn.close()
+
+def test_create_database_indexes(sources):
+    """Test that lookups by ID and title prefix use indexes and statistics exist."""
+    conn = sqlite3.connect(create_database(*sources))
+    cur = conn.cursor()
+    cur.execute("EXPLAIN QUERY PLAN SELECT plot_summary FROM plot_summaries WHERE wikipedia_movie_id=?", (1,))
+    assert 'USING INTEGER PRIMARY KEY' in cur.fetchone()[3]
+    cur.execute("EXPLAIN QUERY PLAN SELECT wikipedia_movie_id FROM movies WHERE movie_name LIKE 'ghost%'")
+    assert 'idx_movies_name' in cur.fetchone()[3]
+    cur.execute("SELECT name FROM sqlite_master WHERE name='idx_movies_id'")
+    assert cur.fetchone() is None  # The ID is already the rowid
+    cur.execute("SELECT COUNT(*) FROM sqlite_stat1")
+    assert cur.fetchone()[0] > 0
+    cur.execute("SELECT rowid FROM movie_titles WHERE movie_titles MATCH '\"mars\"'")
+    assert cur.fetchall() == [(975900,)]
+    conn.close()
+
+def test_create_title_index_untyped_table():
+    """Test that an untyped movies table still gets an ID index."""
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE movies (wikipedia_movie_id, movie_name)")
+    create_title_index(conn)
+    cur = conn.execute("SELECT name FROM sqlite_master WHERE name='idx_movies_id'")
+    assert cur.fetchone() is not None
+    conn.close()
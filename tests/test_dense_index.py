@@ -0,0 +1,78 @@
+""" Tests for dense_index.py """
+import sys
+import os
+import sqlite3
+import numpy as np
+import pytest
+from scipy.sparse import random as sparse_random
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from dense_index import fit_embeddings, train_lists, DenseIndex, save_dense_index, normalize_rows
+
+@pytest.fixture(name="embeddings")
+def fixture_embeddings():
+    """Fixture for random unit-length embeddings and their movie IDs."""
+    rng = np.random.default_rng(3)
+    embeddings = normalize_rows(rng.normal(size=(400, 16)).astype(np.float32))
+    return embeddings, np.arange(400) * 10 + 1
+
+def test_fit_embeddings():
+    """Test reducing a TF-IDF matrix to unit-length float32 rows."""
+    matrix = sparse_random(50, 30, density=0.2, format='csr', random_state=1)
+    embeddings = fit_embeddings(matrix, dimensions=8)
+    assert embeddings.shape == (50, 8)
+    assert embeddings.dtype == np.float32
+    norms = np.linalg.norm(embeddings, axis=1)
+    assert norms[norms > 0] == pytest.approx(1.0, abs=1e-5)
+    assert fit_embeddings(matrix, dimensions=500).shape == (50, 29)
+
+def test_train_lists(embeddings):
+    """Test that every embedding is assigned to its closest centroid."""
+    centroids, assignments = train_lists(embeddings[0], 10)
+    assert centroids.shape == (10, 16)
+    assert list(assignments) == list(np.argmax(embeddings[0] @ centroids.T, axis=1))
+
+def test_similar_movies_probing_every_list_is_exact(embeddings):
+    """Test that probing all lists returns the exact top N."""
+    index = DenseIndex.build(*embeddings, n_lists=10, n_probe=10)
+    scores = embeddings[0] @ embeddings[0][0]
+    scores[0] = 0.0
+    expected = [int(embeddings[1][row]) for row in np.argsort(-scores)[:5]]
+    assert [movie_id for movie_id, _ in index.similar_movies(1, 5)] == expected
+    assert index.similar_movies(999_999) == []
+
+def test_similar_movies_recall(embeddings):
+    """Test that probing a few lists still finds most true neighbours."""
+    index = DenseIndex.build(*embeddings, n_lists=20, n_probe=5)
+    exact = DenseIndex.build(*embeddings, n_lists=1)
+    found = 0
+    for movie_id in embeddings[1][:50]:
+        expected = {m for m, _ in exact.similar_movies(int(movie_id), 10)}
+        found += len(expected & {m for m, _ in index.similar_movies(int(movie_id), 10)})
+    assert found / 500 > 0.5
+
+def test_similar_movies_mask(embeddings):
+    """Test that a mask restricts the candidates of the probed lists."""
+    index = DenseIndex.build(*embeddings, n_lists=10, n_probe=10)
+    mask = np.arange(400) % 3 == 0
+    result = index.similar_movies(1, 5, mask=mask)
+    assert len(result) == 5
+    assert all(mask[(movie_id - 1) // 10] for movie_id, _ in result)
+
+def test_save_and_load_dense_index(embeddings):
+    """Test storing an index and rejecting it after a rebuild."""
+    conn = sqlite3.connect(":memory:")
+    cur = conn.cursor()
+    cur.execute("CREATE TABLE tfidf_settings (name TEXT PRIMARY KEY, value TEXT)")
+    cur.execute("""INSERT INTO tfidf_settings VALUES ('build_id', '"b1"')""")
+    index = DenseIndex.build(*embeddings, n_lists=10, build_id='b1')
+    save_dense_index(conn, index)
+
+    loaded = DenseIndex.from_connection(conn)
+    assert loaded.build_id == 'b1'
+    assert np.array_equal(loaded.embeddings, index.embeddings)
+    assert loaded.similar_movies(11, 5) == index.similar_movies(11, 5)
+
+    cur.execute("""UPDATE tfidf_settings SET value='"b2"' WHERE name='build_id'""")
+    with pytest.raises(ValueError):
+        DenseIndex.from_connection(conn)
+    conn.close()
@@ -0,0 +1,70 @@
+""" Tests for facet_index.py """
+import sys
+import os
+import sqlite3
+import numpy as np
+import pytest
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from facet_index import FacetIndex, split_values, release_decade, normalize_filters
+
+@pytest.fixture(name="db_connection")
+def fixture_db_connection():
+    """Fixture for a movies table with comma-joined and JSON metadata."""
+    conn = sqlite3.connect(":memory:")
+    conn.execute("""CREATE TABLE movies (wikipedia_movie_id INTEGER, movie_name TEXT, movie_release_date TEXT,
+                    movie_languages TEXT, movie_countries TEXT, movie_genres TEXT)""")
+    conn.executemany("INSERT INTO movies VALUES (?, ?, ?, ?, ?, ?)", [
+        (10, 'A', '1994-05-12', 'English Language', 'United States of America', 'Comedy, Drama'),
+        (20, 'B', '1987', 'French Language', 'France', 'Drama'),
+        (30, 'C', None, 'English Language, French Language', 'Canada', '{"/m/01z4y": "Comedy"}'),
+        (40, 'D', '2003', None, None, None),
+    ])
+    yield conn
+    conn.close()
+
+def test_split_values():
+    """Test splitting comma-joined and JSON metadata fields."""
+    assert split_values('Comedy, Drama') == ['Comedy', 'Drama']
+    assert split_values('{"/m/01z4y": "Comedy", "/m/07s9rl0": "Drama"}') == ['Comedy', 'Drama']
+    assert split_values(None) == []
+    assert split_values('{broken') == []
+
+def test_release_decade():
+    """Test the decade of full dates and bare years."""
+    assert release_decade('1994-05-12') == 1990
+    assert release_decade('2000') == 2000
+    assert release_decade('') is None
+    assert release_decade(None) is None
+
+def test_normalize_filters():
+    """Test the canonical form of filters."""
+    assert normalize_filters({'genre': 'Comedy', 'decade': ['1994', 1990, 2001]}) == \
+        (('decade', (1990, 2000)), ('genre', ('Comedy',)))
+    assert normalize_filters(None) == ()
+    with pytest.raises(ValueError):
+        normalize_filters({'director': 'Nobody'})
+    with pytest.raises(ValueError):
+        normalize_filters({'decade': 'nineties'})
+
+def test_facet_masks(db_connection):
+    """Test that facet values are OR-ed and facets AND-ed over the engine rows."""
+    # Engine rows in another order than the table, with a movie without metadata row
+    facets = FacetIndex.from_connection(db_connection, [30, 10, 20, 50])
+    assert len(facets) == 4
+    assert facets.values('genre') == ['Comedy', 'Drama']
+    assert facets.values('decade') == [1980, 1990]  # Movie 40 is not an engine row
+    assert list(facets.mask({'genre': 'Comedy'})) == [True, True, False, False]
+    assert list(facets.mask({'language': ['French Language', 'English Language']})) == [True, True, True, False]
+    assert list(facets.mask({'genre': 'Drama', 'decade': 1990})) == [False, True, False, False]
+    assert not facets.mask({'genre': 'Western'}).any()
+    assert facets.mask({}) is None
+
+def test_missing_columns():
+    """Test that facets of missing columns are empty."""
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE movies (wikipedia_movie_id INTEGER, movie_genres TEXT)")
+    conn.execute("INSERT INTO movies VALUES (1, 'Drama')")
+    facets = FacetIndex.from_connection(conn, np.array([1]))
+    assert facets.values('decade') == []
+    assert list(facets.mask({'genre': 'Drama'})) == [True]
+    conn.close()
@@ -0,0 +1,68 @@
+""" Tests for inverted_index.py """
+import sys
+import os
+import numpy as np
+import pytest
+from scipy.sparse import random as sparse_random
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from similarity_engine import SimilarityEngine
+from inverted_index import InvertedIndex
+
+@pytest.fixture(name="matrix")
+def fixture_matrix():
+    """Fixture for a random sparse TF-IDF matrix and its movie IDs."""
+    matrix = sparse_random(300, 80, density=0.05, format='csr', random_state=7)
+    movie_ids = np.arange(300) * 10 + 1
+    return matrix, movie_ids
+
+def test_get_postings(matrix):
+    """Test that postings list the rows containing a term."""
+    index = InvertedIndex(*matrix)
+    rows, weights = index.get_postings(3)
+    assert list(rows) == list(np.flatnonzero(matrix[0][:, 3].toarray().ravel()))
+    assert np.all(weights > 0)
+    assert np.all(weights <= index.max_weights[3])
+    assert len(index.get_postings(10_000)[0]) == 0
+
+def test_similar_movies_matches_full_scan(matrix):
+    """Test that pruned search returns the exact top N of a full scan."""
+    engine = SimilarityEngine(*matrix)
+    index = InvertedIndex(*matrix)
+    for movie_id in matrix[1][::17]:
+        for top_n in (1, 5, 20):
+            expected = engine.similar_movies(int(movie_id), top_n)
+            result = index.similar_movies(int(movie_id), top_n)
+            # Compare scores rather than IDs, equal rows may tie in either order
+            assert [s for _, s in result] == pytest.approx([s for _, s in expected])
+            assert int(movie_id) not in [m for m, _ in result]
+
+def test_similar_movies_mask_matches_full_scan(matrix):
+    """Test that pruned search with a mask returns the masked top N of a full scan."""
+    engine = SimilarityEngine(*matrix)
+    index = InvertedIndex(*matrix)
+    mask = np.random.default_rng(1).random(300) < 0.2
+    for movie_id in matrix[1][::29]:
+        expected = engine.similar_movies(int(movie_id), 5, mask=mask)
+        result = index.similar_movies(int(movie_id), 5, mask=mask)
+        assert [s for _, s in result] == pytest.approx([s for _, s in expected])
+        assert all(mask[(m - 1) // 10] for m, _ in result)
+
+def test_similar_to_terms():
+    """Test searching with an explicit sparse query."""
+    matrix = np.array([[1.0, 0.0, 0.0], [0.0, 1.0, 0.0], [1.0, 1.0, 0.0]])
+    index = InvertedIndex(matrix, [1, 2, 3])
+    result = index.similar_to_terms([0], [2.0], top_n=5)
+    assert [movie_id for movie_id, _ in result] == [1, 3]
+    assert result[0][1] == pytest.approx(1.0)
+    assert index.similar_to_terms([2], [1.0]) == []
+
+def test_accumulate_scores_posting_rows_only(matrix):
+    """Test that a block of terms is scored over the rows of its postings only."""
+    index = InvertedIndex(*matrix)
+    rows, scores = index.accumulate(np.array([3, 5]), np.array([1.0, 2.0]))
+    expected = np.union1d(index.get_postings(3)[0], index.get_postings(5)[0])
+    assert list(rows) == list(expected)
+    dense = matrix[0][:, [3, 5]].toarray().dot([1.0, 2.0]) * index.inverse_norms
+    assert scores == pytest.approx(dense[expected])
+    rows, _ = index.accumulate(np.array([3, 5]), np.array([1.0, 2.0]), exclude_row=int(expected[0]))
+    assert expected[0] not in rows
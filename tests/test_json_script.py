@@ -0,0 +1,97 @@
+""" Tests for json_script.py """
+import sys
+import os
+import csv
+import sqlite3
+import pytest
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from json_script import format_json_field, convert_rows, convert_to_csv, convert_to_database
+
+ROWS = [
+    ['975900', '/m/03vyhn', 'Ghosts of Mars', '2001-08-24', '14010832', '98.0',
+     '{"/m/02h40lc": "English Language"}', '{"/m/09c7w0": "United States of America"}',
+     '{"/m/01jfsb": "Thriller", "/m/06n90": "Science Fiction"}'],
+    ['28463795', '/m/0crgdbh', 'Brun bitter', '1988', '', '83.0',
+     '{"/m/05f_3": "Norwegian Language"}', '{"/m/05b4w": "Norway"}', '{}'],
+    ['1', 'too', 'short'],
+    ['', '/m/0blank', 'No ID', '', '', '', '{}', '{}', '{}'],
+]
+
+@pytest.fixture(name="tsv_path")
+def fixture_tsv_path(tmp_path):
+    """Fixture for a small metadata TSV file."""
+    path = tmp_path / "movie_metadata.tsv"
+    with open(path, 'w', newline='', encoding='utf-8') as tsv_file:
+        csv.writer(tsv_file, delimiter='\t').writerows(ROWS * 3)
+    return str(path)
+
+def test_format_json_field():
+    """Test formatting and memoizing JSON fields."""
+    format_json_field.cache_clear()
+    assert format_json_field('{"/m/01jfsb": "Thriller", "/m/06n90": "Drama"}') == 'Thriller, Drama'
+    assert format_json_field('{"/m/01jfsb": "Thriller", "/m/06n90": "Drama"}') == 'Thriller, Drama'
+    assert format_json_field.cache_info().hits == 1
+    assert format_json_field('{}') == ''
+    assert format_json_field('not json') is None
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_convert_rows(workers):
+    """Test converting chunks in order, in this process or in workers."""
+    chunks = list(convert_rows(ROWS * 3, workers=workers, chunk_size=2))
+    rows = [row for chunk in chunks for row in chunk]
+    assert len(rows) == 9  # Short rows are skipped
+    assert rows[0][6:] == ['English Language', 'United States of America', 'Thriller, Science Fiction']
+    assert rows[1][:2] == ['28463795', '/m/0crgdbh']
+
+def test_convert_rows_bounds_chunks_in_flight():
+    """Test that workers are handed a few chunks at a time, not the whole input."""
+    read = []
+    def rows():
+        for row in ROWS * 10:
+            read.append(row)
+            yield row
+    converted = convert_rows(rows(), workers=2, chunk_size=1)
+    next(converted)
+    assert len(read) <= 5  # Four chunks in flight plus the one waiting to be submitted
+    assert len([row for chunk in converted for row in chunk]) == 29
+
+def test_convert_to_csv(tsv_path, tmp_path):
+    """Test writing the converted metadata as CSV."""
+    csv_path = str(tmp_path / "movie_metadata.csv")
+    assert convert_to_csv(tsv_path, csv_path, chunk_size=4) == 9
+    with open(csv_path, newline='', encoding='utf-8') as csv_file:
+        rows = list(csv.reader(csv_file))
+    assert rows[0][8] == 'Thriller, Science Fiction'
+
+def test_convert_to_database(tsv_path, tmp_path):
+    """Test writing the converted metadata straight into a typed movies table."""
+    db_path = str(tmp_path / "movies.db")
+    assert convert_to_database(tsv_path, db_path, chunk_size=4) == 6
+    conn = sqlite3.connect(db_path)
+    cur = conn.cursor()
+    cur.execute("SELECT * FROM movies ORDER BY wikipedia_movie_id")
+    assert cur.fetchall() == [
+        (975900, '/m/03vyhn', 'Ghosts of Mars', '2001-08-24', 14010832.0, 98.0,
+         'English Language', 'United States of America', 'Thriller, Science Fiction'),
+        (28463795, '/m/0crgdbh', 'Brun bitter', '1988', None, 83.0, 'Norwegian Language', 'Norway', ''),
+    ]
+    cur.execute("SELECT COUNT(*) FROM movie_titles")
+    assert cur.fetchone()[0] == 2
+    conn.close()
+
+def test_convert_to_database_keeps_table_on_failure(tmp_path):
+    """Test that a failed conversion rolls back to the previous movies table."""
+    db_path = str(tmp_path / "movies.db")
+    conn = sqlite3.connect(db_path)
+    conn.execute("CREATE TABLE movies (wikipedia_movie_id INTEGER PRIMARY KEY, movie_name TEXT)")
+    conn.execute("INSERT INTO movies VALUES (1, 'Old Movie')")
+    conn.commit()
+    conn.close()
+    bad_path = tmp_path / "bad.tsv"
+    with open(bad_path, 'w', newline='', encoding='utf-8') as tsv_file:
+        csv.writer(tsv_file, delimiter='\t').writerows([ROWS[0], ROWS[0][:4] + ['not a number'] + ROWS[0][5:]])
+    with pytest.raises(ValueError):
+        convert_to_database(str(bad_path), db_path)
+    conn = sqlite3.connect(db_path)
+    assert conn.execute("SELECT * FROM movies").fetchall() == [(1, 'Old Movie')]
+    conn.close()
@@ -2,9 +2,19 @@
 import sys
 import os
 import sqlite3
+import threading
+import time
 import pytest
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-from main import create_connection, search_movies, load_initial_data, get_tfidf_vector, calculate_norm, calculate_similarities, get_movie_names, find_similar_movies
+from main import create_connection, search_movies, load_initial_data, get_tfidf_vector, calculate_norm, calculate_similarities, get_movie_names, find_similar_movies, search_by_text, load_engine, search_titles, search_titles_page, count_titles, ResultPager, QueryWorker, get_precomputed_neighbours, MODE_DENSE, find_similar_movies_batch
+from result_cache import LRUCache
+from similarity_engine import SimilarityEngine
+from inverted_index import InvertedIndex
+from dense_index import DenseIndex
+from database_creation import create_title_index
+from vector_model import save_vectorizer
+from tfidf_storage import create_blob_table, encode_tfidf_vector
+from sklearn.feature_extraction.text import TfidfVectorizer
 
 @pytest.fixture(name="db_connection")
 def fixture_db_connection():
@@ -47,6 +57,69 @@ def test_search_movies(db_connection):
     assert len(results) == 1
     assert results[0][0] == 'Another Test Movie'
 
+def test_search_titles(db_connection):
+    """Test searching titles through the FTS5 trigram index."""
+    cur = db_connection.cursor()
+    cur.execute("INSERT INTO movies VALUES (3, 'Testament', 'Drama', '1983')")
+    cur.execute("INSERT INTO movies VALUES (4, '100% Test', 'Comedy', '2001')")
+    create_title_index(db_connection)
+
+    results = search_titles(db_connection, 'test')
+    assert {row[0] for row in results[:2]} == {'Test Movie', 'Testament'}  # Prefix matches come first
+    assert {row[0] for row in results} == {'Test Movie', 'Another Test Movie', 'Testament', '100% Test'}
+    assert [row[3] for row in search_titles(db_connection, 'OTHER')] == [2]
+    assert len(search_titles(db_connection, 'test', limit=2)) == 2
+    # Shorter queries still match substrings, titles starting with them first
+    assert [row[0] for row in search_titles(db_connection, 'te')] == ['Test Movie', 'Testament', '100% Test',
+                                                                      'Another Test Movie']
+    assert [row[0] for row in search_titles(db_connection, 'te', limit=1)] == ['Test Movie']
+    assert [row[0] for row in search_titles(db_connection, '10')] == ['100% Test']
+    assert search_titles(db_connection, '"x') == []
+
+def test_search_titles_without_index(db_connection):
+    """Test falling back to LIKE search without the title index."""
+    assert search_titles(db_connection, 'Test') == search_movies(db_connection, 'Test')
+
+def collect_pages(connection, query, page_size):
+    """Fetch every page of a paginated title search."""
+    rows, cursor = search_titles_page(connection, query, page_size=page_size)
+    while cursor is not None:
+        page, cursor = search_titles_page(connection, query, cursor, page_size)
+        rows += page
+    return rows
+
+def test_search_titles_page(db_connection):
+    """Test that paginated title searches return every match exactly once."""
+    cur = db_connection.cursor()
+    for movie_id in range(3, 30):
+        cur.execute("INSERT INTO movies VALUES (?, ?, 'Drama', '1990')", (movie_id, f"Test {movie_id % 4}"))
+    cur.execute("INSERT INTO movies VALUES (30, 'Zorro', 'Action', '1998')")
+
+    # Without the title index every query matches substrings alphabetically
+    rows = collect_pages(db_connection, 'test', 4)
+    assert sorted(rows) == sorted(search_movies(db_connection, 'test'))
+    assert [row[0].lower() for row in rows] == sorted(row[0].lower() for row in rows)
+
+    create_title_index(db_connection)
+    rows = collect_pages(db_connection, 'test', 4)
+    assert sorted(rows) == sorted(search_titles(db_connection, 'test'))
+    assert rows[-1][0] == 'Another Test Movie'  # Prefix matches come first
+    assert [row[3] for row in collect_pages(db_connection, '', 4)] == list(range(30, 0, -1))
+    assert [row[3] for row in collect_pages(db_connection, 'z', 4)] == [30]
+    short_rows = collect_pages(db_connection, 'T', 5)
+    assert [row[0].lower() for row in short_rows] == sorted(row[0].lower() for row in short_rows)
+    assert len(short_rows) == 29  # Every title containing a t, not only those starting with one
+
+def test_count_titles(db_connection):
+    """Test counting the matches of a paginated title search."""
+    assert count_titles(db_connection, '') == 2
+    assert count_titles(db_connection, 'other') == 1
+    create_title_index(db_connection)
+    assert count_titles(db_connection, 'test') == 2
+    assert count_titles(db_connection, 'an') == 1
+    assert count_titles(db_connection, 'ov') == 2
+    assert count_titles(db_connection, '%') == 0
+
 def test_load_initial_data(db_connection):
     """Test loading initial data."""
     results = load_initial_data(db_connection)
@@ -65,6 +138,16 @@ def test_get_tfidf_vector(db_connection):
     assert len(tfidf_vector) == 1
     assert tfidf_vector[0] == (0, 0.7)
 
+def test_get_tfidf_vector_blob_storage():
+    """Test getting the TF-IDF vector from the packed storage layout."""
+    conn = sqlite3.connect(":memory:")
+    cur = conn.cursor()
+    create_blob_table(cur)
+    cur.execute("INSERT INTO tfidf_vectors VALUES (?, ?, ?)", (1, *encode_tfidf_vector([0, 3], [0.5, 0.25])))
+    assert get_tfidf_vector(cur, 1) == [(0, 0.5), (3, 0.25)]
+    assert get_tfidf_vector(cur, 2) == []
+    conn.close()
+
 def test_calculate_norm():
     """Test calculating the norm of a TF-IDF vector."""
     vector = {0: 0.5, 1: 0.5}
@@ -102,6 +185,69 @@ def test_find_similar_movies(db_connection):
     assert similar_movies[0][0] == 'Another Test Movie'
     assert similar_movies[0][1] == pytest.approx(1.0, 0.0001)  # identical vectors
 
+def test_find_similar_movies_filters(db_connection):
+    """Test restricting similar movies to a genre and decade."""
+    cur = db_connection.cursor()
+    cur.execute("INSERT INTO movies VALUES (3, 'Third Movie', 'Comedy, Action', '1994')")
+    cur.execute("INSERT INTO sparse_tfidf VALUES (3, 0, 0.2)")
+    assert [name for name, _ in find_similar_movies(db_connection, 1, filters={'genre': 'Action'})] == ['Third Movie']
+    assert [name for name, _ in find_similar_movies(db_connection, 1, filters={'decade': [2020]})] == \
+        ['Another Test Movie']
+    assert find_similar_movies(db_connection, 1, filters={'genre': 'Drama', 'decade': 1990}) == []
+    with pytest.raises(ValueError):
+        find_similar_movies(db_connection, 1, filters={'director': 'Nobody'})
+
+def test_find_similar_movies_cache(db_connection):
+    """Test caching similar movies per build of the vectors."""
+    cache = LRUCache()
+    engine = SimilarityEngine.from_connection(db_connection)
+    first = find_similar_movies(db_connection, 1, engine=engine, cache=cache)
+    assert find_similar_movies(db_connection, 1, engine=engine, cache=cache) == first
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # An engine of another build must not reuse the cached results
+    engine.build_id = 'rebuilt'
+    find_similar_movies(db_connection, 1, engine=engine, cache=cache)
+    assert (cache.hits, cache.misses) == (1, 2)
+
+def test_find_similar_movies_precomputed(db_connection):
+    """Test answering from the precomputed neighbours of the current build."""
+    cur = db_connection.cursor()
+    cur.execute("CREATE TABLE tfidf_settings (name TEXT PRIMARY KEY, value TEXT)")
+    cur.execute("""INSERT INTO tfidf_settings VALUES ('build_id', '"b1"')""")
+    cur.execute("""INSERT INTO tfidf_settings VALUES ('neighbours', '{"build_id": "b1", "top_k": 5}')""")
+    cur.execute("CREATE TABLE similar_movies (wikipedia_movie_id, rank, similar_movie_id, similarity)")
+    cur.execute("INSERT INTO similar_movies VALUES (1, 1, 2, 0.25)")
+    cur.execute("DELETE FROM sparse_tfidf")  # The live computation would find nothing
+
+    assert get_precomputed_neighbours(cur, 1, 5) == [(2, 0.25)]
+    assert find_similar_movies(db_connection, 1) == [('Another Test Movie', 0.25)]
+    assert get_precomputed_neighbours(cur, 1, 6) is None  # More than were precomputed
+    cur.execute("""UPDATE tfidf_settings SET value='"b2"' WHERE name='build_id'""")
+    assert get_precomputed_neighbours(cur, 1, 5) is None  # Stale after a rebuild
+    assert find_similar_movies(db_connection, 1) == []
+
+def test_find_similar_movies_dense(db_connection):
+    """Test finding similar movies through the dense index."""
+    index = DenseIndex([[1.0, 0.0], [0.8, 0.6]], [1, 2], centroids=[[1.0, 0.0]], assignments=[0, 0])
+    similar_movies = find_similar_movies(db_connection, 1, engine=index, mode=MODE_DENSE)
+    assert similar_movies == [('Another Test Movie', pytest.approx(0.8))]
+    with pytest.raises(ValueError):
+        find_similar_movies(db_connection, 1, mode='hashed')
+    # The engine has to match the mode
+    with pytest.raises(ValueError):
+        find_similar_movies(db_connection, 1, engine=index)
+    with pytest.raises(ValueError):
+        find_similar_movies(db_connection, 1, engine=SimilarityEngine.from_connection(db_connection),
+                            mode=MODE_DENSE)
+
+def test_find_similar_movies_batch(db_connection):
+    """Test streaming the similar movies of several movies."""
+    results = list(find_similar_movies_batch(db_connection, [2, 1, 3]))
+    assert [movie_id for movie_id, _ in results] == [2, 1, 3]
+    assert results[0][1] == [(1, pytest.approx(1.0))]
+    assert results[2][1] == []
+
 def test_find_similar_movies_no_results(db_connection):
     """Test finding similar movies when there are no results."""
     cur = db_connection.cursor()
@@ -110,3 +256,171 @@ def test_find_similar_movies_no_results(db_connection):
 
     similar_movies = find_similar_movies(db_connection, 1)
     assert len(similar_movies) == 0
+
+def test_search_by_text(db_connection):
+    """Test ranking movies against a free-text plot query."""
+    cur = db_connection.cursor()
+    cur.execute("DELETE FROM sparse_tfidf")
+    vectorizer = TfidfVectorizer()
+    tfidf_matrix = vectorizer.fit_transform(["test plot summari", "sequel test plot summari"])
+    for movie_id, row in zip([1, 2], tfidf_matrix):
+        cur.executemany("INSERT INTO sparse_tfidf VALUES (?, ?, ?)",
+                        [(movie_id, int(idx), float(value)) for idx, value in zip(row.indices, row.data)])
+    save_vectorizer(db_connection, vectorizer)
+
+    results = search_by_text(db_connection, "The sequel plot")
+    assert [name for name, _ in results] == ['Another Test Movie', 'Test Movie']
+    assert results[0][1] > results[1][1]
+
+def test_load_engine_without_snapshot(db_connection, tmp_path):
+    """Test falling back to the database when there is no snapshot."""
+    engine = load_engine(db_connection, str(tmp_path))
+    assert len(engine) == 2
+    assert find_similar_movies(db_connection, 1, engine=engine)[0][0] == 'Another Test Movie'
+    # Quantizing needs the snapshot to re-rank from, the exact engine is loaded instead
+    assert type(load_engine(db_connection, str(tmp_path), quantize='int8')) is SimilarityEngine
+    inverted = load_engine(db_connection, str(tmp_path), inverted=True)
+    assert isinstance(inverted, InvertedIndex)
+    assert find_similar_movies(db_connection, 1, engine=inverted)[0][0] == 'Another Test Movie'
+    with pytest.raises(ValueError):
+        load_engine(db_connection, str(tmp_path), quantize='int8', inverted=True)
+
+def deliver_until(worker, results, expected, timeout=5.0):
+    """Deliver worker results on this thread until the expected number arrived."""
+    deadline = time.monotonic() + timeout
+    while len(results) < expected and time.monotonic() < deadline:
+        worker.deliver()
+        time.sleep(0.01)
+
+def test_query_worker(tmp_path):
+    """Test running queries on the worker thread with its own connection."""
+    db_file = str(tmp_path / "movies.db")
+    conn = sqlite3.connect(db_file)
+    setup_test_database(conn)
+    conn.close()
+
+    results = []
+    worker = QueryWorker(db_file, snapshot_dir=str(tmp_path))
+    worker.submit('search', search_movies, 'Another',
+                  callback=lambda rows, error: results.append((rows, error)))
+    worker.submit('fail', lambda connection: connection.execute("SELECT * FROM missing"),
+                  callback=lambda rows, error: results.append((rows, error)))
+    worker.submit('crash', lambda connection: {}['missing'],
+                  callback=lambda rows, error: results.append((rows, error)))
+    # The thread survives the failed jobs and keeps answering
+    worker.submit('again', search_movies, 'Test',
+                  callback=lambda rows, error: results.append((rows, error)))
+    deliver_until(worker, results, 4)
+    worker.close()
+
+    assert results[0] == ([('Another Test Movie', 'Drama', '2021', 2)], None)
+    assert results[1][0] is None
+    assert isinstance(results[1][1], sqlite3.OperationalError)
+    assert results[2][0] is None
+    assert isinstance(results[2][1], KeyError)
+    assert len(results[3][0]) == 2 and results[3][1] is None
+
+class FakeTree:
+    """Stand-in for the rows of a ttk.Treeview."""
+
+    def __init__(self):
+        self.rows = {}
+
+    def get_children(self):
+        return tuple(self.rows)
+
+    def insert(self, _parent, _index, iid, values):
+        self.rows[iid] = values
+
+    def delete(self, *items):
+        for item in items:
+            del self.rows[item]
+
+def test_result_pager(tmp_path):
+    """Test loading the movie list page by page as it is scrolled."""
+    db_file = str(tmp_path / "movies.db")
+    conn = sqlite3.connect(db_file)
+    setup_test_database(conn)
+    for movie_id in range(3, 11):
+        conn.execute("INSERT INTO movies VALUES (?, 'Sequel', 'Drama', '2022')", (movie_id,))
+    conn.commit()
+    conn.close()
+
+    tree, counts = FakeTree(), []
+    worker = QueryWorker(db_file, snapshot_dir=str(tmp_path))
+    pager = ResultPager(tree, worker, on_count=counts.append, page_size=3)
+    pager.search('')
+    deliver_until(worker, counts, 2)
+    assert tree.get_children() == (10, 9, 8)
+    assert counts == [None, 10]
+
+    # Scrolled to the end, one more page is fetched
+    pager.on_scroll(0.0, 1.0)
+    assert pager.loading
+    deadline = time.monotonic() + 5
+    while pager.loading and time.monotonic() < deadline:
+        worker.deliver()
+        time.sleep(0.01)
+    assert len(tree.get_children()) == 6
+    # Far from the end nothing is fetched
+    pager.on_scroll(0.0, 0.1)
+    assert not pager.loading
+
+    pager.search('Test')
+    deliver_until(worker, counts, 4)
+    worker.close()
+    assert set(tree.get_children()) == {1, 2}
+    assert counts[2:] == [None, 2]
+    assert pager.done
+
+def test_result_pager_cancels_stale_count(tmp_path):
+    """Test that a new search drops the queued count of the previous one."""
+    db_file = str(tmp_path / "movies.db")
+    conn = sqlite3.connect(db_file)
+    setup_test_database(conn)
+    conn.close()
+    started, release = threading.Event(), threading.Event()
+
+    def slow_job(_connection):
+        started.set()
+        release.wait(5)
+
+    tree, counts = FakeTree(), []
+    worker = QueryWorker(db_file, snapshot_dir=str(tmp_path))
+    pager = ResultPager(tree, worker, on_count=counts.append, page_size=3)
+    worker.submit('select', slow_job, callback=lambda result, error: None)
+    started.wait(5)
+    pager.search('Test')
+    # The first page of 'Test' arrives and queues its count behind the busy worker
+    pager.show_page(([], None), None)
+    pager.search('Another')
+    release.set()
+    deliver_until(worker, counts, 3)
+    worker.close()
+    assert counts == [None, None, 1]
+
+def test_query_worker_supersedes(tmp_path):
+    """Test that a newer job on a channel drops the older results."""
+    db_file = str(tmp_path / "movies.db")
+    sqlite3.connect(db_file).close()
+    started, release = threading.Event(), threading.Event()
+
+    def slow_job(_connection, value):
+        started.set()
+        release.wait(5)
+        return value
+
+    results = []
+    worker = QueryWorker(db_file, snapshot_dir=str(tmp_path))
+    worker.submit('select', slow_job, 1, callback=lambda result, error: results.append(result))
+    started.wait(5)
+    worker.submit('select', slow_job, 2, callback=lambda result, error: results.append(result))
+    worker.submit('select', slow_job, 3, callback=lambda result, error: results.append(result))
+    release.set()
+    deliver_until(worker, results, 1)
+    worker.close()
+    worker.thread.join(5)
+    worker.deliver()
+
+    # Job 1 was running and its result is dropped, job 2 never ran
+    assert results == [3]
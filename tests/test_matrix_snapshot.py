@@ -0,0 +1,54 @@
+""" Tests for matrix_snapshot.py """
+import sys
+import os
+import numpy as np
+import pytest
+from scipy.sparse import csr_matrix
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from matrix_snapshot import write_snapshot, read_manifest, load_snapshot
+
+@pytest.fixture(name="snapshot_dir")
+def fixture_snapshot_dir(tmp_path):
+    """Fixture for a directory holding a small snapshot."""
+    matrix = csr_matrix(np.array([[3.0, 4.0, 0.0], [0.0, 0.0, 2.0]]))
+    write_snapshot(str(tmp_path), matrix, [20, 10], 'build-1')
+    return str(tmp_path)
+
+def test_write_snapshot(snapshot_dir):
+    """Test writing the arrays and manifest of a snapshot."""
+    manifest = read_manifest(snapshot_dir)
+    assert manifest['build_id'] == 'build-1'
+    assert manifest['shape'] == [2, 3]
+    assert set(manifest['files']) == {'data', 'indices', 'indptr', 'norms', 'movie_ids'}
+
+def test_load_snapshot(snapshot_dir):
+    """Test memory-mapping a snapshot."""
+    matrix, movie_ids, norms = load_snapshot(snapshot_dir, 'build-1', verify=True)
+    assert not matrix.data.flags.writeable  # A view of the read-only memory map
+    assert matrix.toarray().tolist() == [[3.0, 4.0, 0.0], [0.0, 0.0, 2.0]]
+    assert list(movie_ids) == [20, 10]
+    assert list(norms) == pytest.approx([5.0, 2.0])
+
+def test_load_snapshot_stale(snapshot_dir):
+    """Test rejecting a snapshot of another database build."""
+    with pytest.raises(ValueError):
+        load_snapshot(snapshot_dir, 'build-2')
+
+def test_load_snapshot_corrupted(snapshot_dir):
+    """Test detecting truncated and corrupted snapshot files."""
+    path = os.path.join(snapshot_dir, 'data.npy')
+    with open(path, 'r+b') as snapshot_file:
+        snapshot_file.seek(-1, os.SEEK_END)
+        snapshot_file.write(b'\x01')
+    load_snapshot(snapshot_dir)  # Same size, only a full check notices
+    with pytest.raises(ValueError):
+        load_snapshot(snapshot_dir, verify=True)
+    with open(path, 'ab') as snapshot_file:
+        snapshot_file.write(b'\x00')
+    with pytest.raises(ValueError):
+        load_snapshot(snapshot_dir)
+
+def test_load_snapshot_missing(tmp_path):
+    """Test loading from a directory without a snapshot."""
+    with pytest.raises(FileNotFoundError):
+        load_snapshot(str(tmp_path))
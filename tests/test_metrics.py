@@ -0,0 +1,81 @@
+""" Tests for metrics.py """
+import sys
+import os
+import json
+import logging
+import pytest
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import metrics
+from metrics import timed, increment, add_sink, remove_sink, MetricsRegistry, JsonLinesSink, LoggingSink, profiled
+from similarity_engine import SimilarityEngine
+
+@pytest.fixture(name="registry")
+def fixture_registry():
+    """Fixture for an in-process registry registered as a sink."""
+    registry = add_sink(MetricsRegistry())
+    yield registry
+    remove_sink(registry)
+
+def test_timed(registry):
+    """Test recording timings, also when the block raises."""
+    with timed('stage'):
+        pass
+    with pytest.raises(KeyError):
+        with timed('stage'):
+            raise KeyError('missing')
+    summary = registry.summary()['timings']['stage']
+    assert summary['count'] == 2
+    assert summary['errors'] == 1
+    assert summary['p99_ms'] >= summary['p50_ms'] >= 0
+
+def test_increment(registry):
+    """Test summing counters."""
+    increment('hits')
+    increment('hits', 2)
+    assert registry.summary()['counters'] == {'hits': 3}
+    registry.clear()
+    assert registry.summary() == {'counters': {}, 'timings': {}}
+
+def test_no_sinks():
+    """Test that instrumentation does nothing without sinks."""
+    assert not metrics._sinks  # pylint: disable=W0212
+    with timed('stage'):
+        increment('hits')
+
+def test_json_lines_sink(tmp_path):
+    """Test writing one JSON object per measurement."""
+    path = tmp_path / "metrics.jsonl"
+    sink = add_sink(JsonLinesSink(str(path)))
+    try:
+        with timed('stage', mode='dense'):
+            increment('hits')
+    finally:
+        remove_sink(sink)
+        sink.close()
+    events = [json.loads(line) for line in path.read_text(encoding='utf-8').splitlines()]
+    assert [(event['type'], event['name']) for event in events] == [('counter', 'hits'), ('timing', 'stage')]
+    assert events[1]['mode'] == 'dense'
+
+def test_logging_sink(caplog):
+    """Test logging measurements."""
+    sink = add_sink(LoggingSink())
+    try:
+        with caplog.at_level(logging.INFO, logger='metrics'):
+            with timed('stage'):
+                pass
+    finally:
+        remove_sink(sink)
+    assert 'stage took' in caplog.text
+
+def test_profiled(tmp_path):
+    """Test writing cProfile statistics."""
+    path = tmp_path / "profile.out"
+    with profiled(str(path)):
+        sum(range(1000))
+    assert path.stat().st_size > 0
+
+def test_query_stages(registry):
+    """Test that a similarity query reports its stages."""
+    engine = SimilarityEngine([[1.0, 0.0], [1.0, 1.0]], [1, 2])
+    engine.similar_movies(1)
+    assert {'query.vector_fetch', 'query.score', 'query.sort'} <= set(registry.summary()['timings'])
@@ -0,0 +1,97 @@
+""" Tests for quantized_engine.py """
+import sys
+import os
+import sqlite3
+import numpy as np
+import pytest
+from scipy.sparse import random as sparse_random
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from similarity_engine import SimilarityEngine
+from quantized_engine import quantize_matrix, QuantizedEngine, QUANTIZE_FLOAT16, QUANTIZE_INT8
+from matrix_snapshot import write_snapshot
+from vector_model import setup_database, save_tfidf_values, record_build
+
+@pytest.fixture(name="matrix")
+def fixture_matrix():
+    """Fixture for a random sparse TF-IDF matrix and its movie IDs."""
+    matrix = sparse_random(400, 120, density=0.05, format='csr', random_state=np.random.default_rng(11))
+    movie_ids = np.arange(400) * 10 + 1
+    return matrix, movie_ids
+
+@pytest.mark.parametrize("dtype, value_dtype, tolerance", [
+    (QUANTIZE_FLOAT16, np.float16, 1e-3),
+    (QUANTIZE_INT8, np.int8, 1e-2),
+])
+def test_quantize_matrix(matrix, dtype, value_dtype, tolerance):
+    """Test that quantized postings reproduce the matrix within the quantization error."""
+    data, rows, indptr, scales = quantize_matrix(matrix[0], dtype)
+    assert data.dtype == value_dtype
+    assert rows.dtype == np.uint16
+    assert len(indptr) == matrix[0].shape[1] + 1
+    dense = np.zeros(matrix[0].shape)
+    for column in range(matrix[0].shape[1]):
+        column_rows = rows[indptr[column]:indptr[column + 1]]
+        values = data[indptr[column]:indptr[column + 1]].astype(np.float64)
+        dense[column_rows, column] = values * (scales[column_rows] if scales is not None else 1.0)
+    assert dense == pytest.approx(matrix[0].toarray(), abs=tolerance)
+
+def test_quantize_matrix_unknown_dtype(matrix):
+    """Test rejecting an unknown quantization."""
+    with pytest.raises(ValueError):
+        quantize_matrix(matrix[0], 'int4')
+
+@pytest.mark.parametrize("dtype", [QUANTIZE_FLOAT16, QUANTIZE_INT8])
+def test_similar_movies_reranked_exactly(matrix, dtype):
+    """Test that re-ranked results carry the exact scores of the full-precision vectors."""
+    engine = SimilarityEngine(*matrix)
+    quantized = QuantizedEngine(*matrix, dtype=dtype)
+    # The in-memory full-precision matrix is counted besides the postings
+    assert not quantized.memory_mapped
+    assert quantized.nbytes > matrix[0].data.nbytes + matrix[0].indices.nbytes
+    for movie_id in matrix[1][::37]:
+        expected = engine.similar_movies(int(movie_id), 5)
+        result = quantized.similar_movies(int(movie_id), 5)
+        assert [s for _, s in result] == pytest.approx([s for _, s in expected])
+    assert quantized.recall() == 1.0
+    assert quantized.similar_movies(999_999) == []
+
+def test_similar_movies_without_reranking(matrix):
+    """Test ranking by the quantized scores alone."""
+    quantized = QuantizedEngine(*matrix, dtype=QUANTIZE_INT8, rerank_depth=0)
+    result = quantized.similar_movies(1, 5)
+    exact = SimilarityEngine(*matrix).similar_movies(1, 5)
+    assert [s for _, s in result] == pytest.approx([s for _, s in exact], abs=0.02)
+    assert quantized.recall(top_n=5) >= 0.9
+
+@pytest.mark.parametrize("dtype", [QUANTIZE_FLOAT16, QUANTIZE_INT8])
+def test_similar_to_terms_empty_query(matrix, dtype):
+    """Test that an empty or out-of-vocabulary query finds nothing instead of failing."""
+    quantized = QuantizedEngine(*matrix, dtype=dtype)
+    assert quantized.approximate_scores(np.empty(0, dtype=np.int64), np.empty(0)).dtype == np.float64
+    assert quantized.similar_to_terms([], []) == []
+    assert quantized.similar_to_terms([10_000], [1.0]) == []
+
+def test_similar_movies_mask(matrix):
+    """Test restricting the results to the rows of a mask."""
+    quantized = QuantizedEngine(*matrix)
+    mask = np.arange(400) % 2 == 0
+    result = quantized.similar_movies(11, 10, mask=mask)
+    assert result
+    assert all(mask[(movie_id - 1) // 10] for movie_id, _ in result)
+
+def test_from_snapshot(matrix, tmp_path):
+    """Test re-ranking from a memory-mapped snapshot of the current build."""
+    conn = sqlite3.connect(":memory:")
+    setup_database(conn)
+    save_tfidf_values(conn, *matrix)
+    build_id = record_build(conn)
+    write_snapshot(str(tmp_path), matrix[0], matrix[1], build_id)
+
+    quantized = QuantizedEngine.from_snapshot(str(tmp_path), conn, dtype=QUANTIZE_FLOAT16)
+    assert quantized.build_id == build_id
+    assert not quantized.matrix.data.flags.writeable  # Still the read-only memory map
+    assert quantized.memory_mapped
+    assert quantized.nbytes < matrix[0].data.nbytes + matrix[0].indices.nbytes
+    expected = QuantizedEngine.from_connection(conn, dtype=QUANTIZE_FLOAT16).similar_movies(1, 5)
+    assert [s for _, s in quantized.similar_movies(1, 5)] == pytest.approx([s for _, s in expected], rel=1e-5)
+    conn.close()
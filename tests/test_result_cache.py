@@ -0,0 +1,47 @@
+""" Tests for result_cache.py """
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from result_cache import LRUCache, estimate_size
+
+def test_get_and_put():
+    """Test storing values and counting hits and misses."""
+    cache = LRUCache()
+    assert cache.get('a') is None
+    cache.put('a', [('Movie', 0.5)])
+    assert cache.get('a') == [('Movie', 0.5)]
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['entries']) == (1, 1, 1)
+
+def test_evicts_least_recently_used():
+    """Test evicting the oldest entry over the entry limit."""
+    cache = LRUCache(max_entries=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    cache.get('a')
+    cache.put('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1 and cache.get('c') == 3
+    assert cache.evictions == 1
+
+def test_evicts_over_byte_limit():
+    """Test evicting entries once the estimated size exceeds the limit."""
+    value = ('x' * 100,)
+    cache = LRUCache(max_bytes=2 * estimate_size(value) + 1)
+    for key in range(3):
+        cache.put(key, value)
+    assert len(cache) == 2
+    assert cache.get(0) is None
+    cache.put('huge', ('x' * 10_000,))
+    assert cache.get('huge') is None
+
+def test_check_version():
+    """Test clearing the cache when the index version changes."""
+    cache = LRUCache()
+    cache.check_version('build-1')
+    cache.put('a', 1)
+    cache.check_version('build-1')
+    assert cache.get('a') == 1
+    cache.check_version('build-2')
+    assert cache.get('a') is None
+    assert cache.stats()['version'] == 'build-2'
@@ -0,0 +1,149 @@
+""" Tests for service.py """
+import sys
+import os
+import asyncio
+import sqlite3
+import pytest
+from sklearn.feature_extraction.text import TfidfVectorizer
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from service import SearchService, LocalClient
+from database_creation import create_title_index
+from vector_model import setup_database, save_tfidf_values, save_vectorizer, record_build
+from matrix_snapshot import write_snapshot
+from quantized_engine import QuantizedEngine
+from tfidf_storage import get_build_id
+
+@pytest.fixture(name="service")
+def fixture_service(tmp_path):
+    """Fixture for a service over a small database file."""
+    db_file = str(tmp_path / "movies.db")
+    conn = sqlite3.connect(db_file)
+    cur = conn.cursor()
+    cur.execute("CREATE TABLE movies (wikipedia_movie_id INTEGER, movie_name TEXT, movie_genres TEXT, movie_release_date TEXT)")
+    cur.executemany("INSERT INTO movies VALUES (?, ?, 'Drama', '2020')",
+                    [(1, 'Red Planet'), (2, 'Green Planet'), (3, 'Blue Moon'), (4, 'Yellow Sun')])
+    create_title_index(conn)
+    setup_database(conn)
+    vectorizer = TfidfVectorizer()
+    tfidf_matrix = vectorizer.fit_transform(["red green planet", "green planet", "blue moon", "yellow sun"])
+    save_tfidf_values(conn, tfidf_matrix, [1, 2, 3, 4])
+    save_vectorizer(conn, vectorizer)
+    record_build(conn)
+    conn.close()
+
+    service = SearchService(db_file, snapshot_dir=str(tmp_path / "no_snapshot"), pool_size=2)
+    yield service
+    service.close()
+
+def test_health(service):
+    """Test reporting the loaded build."""
+    status, payload = asyncio.run(LocalClient(service).get('/health'))
+    assert status == 200
+    assert payload['movies'] == 4
+
+def test_search(service):
+    """Test searching titles."""
+    status, payload = asyncio.run(LocalClient(service).get('/search?q=planet&limit=1'))
+    assert status == 200
+    assert len(payload['results']) == 1
+    assert payload['results'][0]['movie_name'] in ('Red Planet', 'Green Planet')
+
+def test_similar(service):
+    """Test finding similar movies."""
+    status, payload = asyncio.run(LocalClient(service).get('/similar?id=2&top_n=3'))
+    assert status == 200
+    assert [result['movie_name'] for result in payload['results']] == ['Red Planet']
+
+def test_similar_requests_are_batched(service):
+    """Test that concurrent similar-movie requests share one batch."""
+    async def scenario():
+        client = LocalClient(service)
+        return await asyncio.gather(*(client.get(f'/similar?id={movie_id}&top_n={top_n}')
+                                      for movie_id, top_n in [(1, 1), (2, 5), (3, 2), (1, 5)]))
+    responses = asyncio.run(scenario())
+    assert service.batcher.batches == 1
+    assert [status for status, _ in responses] == [200] * 4
+    assert [r['movie_name'] for r in responses[0][1]['results']] == ['Green Planet']
+    assert responses[2][1]['results'] == []
+
+def test_failed_batch_falls_back_per_request(service):
+    """Test that a failing batch only fails the requests that fail on their own."""
+    engine = service.batcher.engine
+
+    class FlakyEngine:
+        """Engine whose batches fail and that cannot score movie 3."""
+        def similar_movies_batch(self, movie_ids, top_n):
+            raise MemoryError("batch too large")
+        def similar_movies(self, movie_id, top_n):
+            if movie_id == 3:
+                raise KeyError(movie_id)
+            return engine.similar_movies(movie_id, top_n)
+
+    service.batcher.engine = FlakyEngine()
+    async def scenario():
+        client = LocalClient(service)
+        return await asyncio.gather(*(client.get(f'/similar?id={movie_id}&top_n=1') for movie_id in (1, 3)))
+    responses = asyncio.run(scenario())
+    assert service.batcher.batches == 1
+    assert [status for status, _ in responses] == [200, 500]
+    assert [r['movie_name'] for r in responses[0][1]['results']] == ['Green Planet']
+    assert not service.batcher.tasks
+
+def test_similar_filtered(service):
+    """Test finding similar movies among those of a genre."""
+    status, payload = asyncio.run(LocalClient(service).get('/similar?id=2&genre=Comedy'))
+    assert status == 200
+    assert payload['results'] == []
+    status, payload = asyncio.run(LocalClient(service).get('/similar?id=2&genre=Drama&decade=2020'))
+    assert [result['movie_name'] for result in payload['results']] == ['Red Planet']
+    assert service.batcher.batches == 0
+
+def test_similar_quantized(service, tmp_path):
+    """Test serving from a quantized engine re-ranking from a snapshot."""
+    conn = sqlite3.connect(str(tmp_path / "movies.db"))
+    write_snapshot(str(tmp_path / "snapshot"), service.engine.matrix, service.engine.movie_ids,
+                   get_build_id(conn.cursor()))
+    conn.close()
+    quantized = SearchService(str(tmp_path / "movies.db"), snapshot_dir=str(tmp_path / "snapshot"),
+                              pool_size=1, quantize='int8')
+    try:
+        assert isinstance(quantized.engine, QuantizedEngine)
+        status, payload = asyncio.run(LocalClient(quantized).get('/similar?id=2&top_n=3'))
+    finally:
+        quantized.close()
+    assert status == 200
+    assert payload == asyncio.run(LocalClient(service).get('/similar?id=2&top_n=3'))[1]
+
+def test_search_text(service):
+    """Test searching plots with free text."""
+    status, payload = asyncio.run(LocalClient(service).get('/search_text?q=moon&top_n=2'))
+    assert status == 200
+    assert payload['results'][0]['movie_name'] == 'Blue Moon'
+
+@pytest.mark.parametrize("target, expected_status", [
+    ('/similar?id=99', 404),
+    ('/similar?id=abc', 400),
+    ('/similar', 400),
+    ('/similar?id=1&decade=old', 400),
+    ('/search?q=x&limit=0', 400),
+    ('/unknown', 404),
+])
+def test_errors(service, target, expected_status):
+    """Test the status of invalid requests."""
+    status, payload = asyncio.run(LocalClient(service).get(target))
+    assert status == expected_status
+    assert 'error' in payload
+
+def test_method_not_allowed(service):
+    """Test rejecting other methods than GET."""
+    status, _ = asyncio.run(LocalClient(service).request('POST', '/health'))
+    assert status == 405
+
+def test_unexpected_error_is_answered(service):
+    """Test that any handler error is answered with a 500 instead of a closed connection."""
+    async def failing(_params):
+        raise KeyError('boom')
+    service.routes['/health'] = failing
+    status, payload = asyncio.run(LocalClient(service).get('/health'))
+    assert status == 500
+    assert payload == {'error': "Internal server error"}
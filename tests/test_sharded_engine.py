@@ -0,0 +1,79 @@
+""" Tests for sharded_engine.py """
+import sys
+import os
+import numpy as np
+import pytest
+from scipy.sparse import random as sparse_random
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from similarity_engine import SimilarityEngine
+from sharded_engine import ShardedEngine, shard_bounds, merge_top_n
+from matrix_snapshot import write_snapshot
+
+@pytest.fixture(name="matrix")
+def fixture_matrix():
+    """Fixture for a random sparse TF-IDF matrix with shuffled movie IDs."""
+    matrix = sparse_random(120, 40, density=0.1, format='csr', random_state=5)
+    movie_ids = np.random.default_rng(5).permutation(120) * 7 + 3
+    return matrix, movie_ids
+
+def test_shard_bounds():
+    """Test splitting rows into contiguous near-equal ranges."""
+    assert shard_bounds(10, 3) == [(0, 3), (3, 6), (6, 10)]
+    assert shard_bounds(2, 4) == [(0, 1), (1, 2)]
+
+def test_merge_top_n():
+    """Test merging partial top N lists by score, then movie ID."""
+    partials = [[(5, 0.9), (1, 0.4)], [(7, 0.8), (2, 0.4)], []]
+    assert merge_top_n(partials, 3) == [(5, 0.9), (7, 0.8), (1, 0.4)]
+
+def test_similar_movies_matches_single_process(matrix):
+    """Test that fanning out to shards gives the single-process top N."""
+    engine = SimilarityEngine(*matrix)
+    with ShardedEngine.from_matrix(*matrix, n_shards=3) as sharded:
+        assert len(sharded) == 120
+        assert 3 in sharded and 4 not in sharded
+        for movie_id in matrix[1][:10]:
+            expected = engine.similar_movies(int(movie_id), 5)
+            result = sharded.similar_movies(int(movie_id), 5)
+            assert [s for _, s in result] == pytest.approx([s for _, s in expected])
+        assert sharded.similar_movies(4) == []
+
+        movie_ids = [int(movie_id) for movie_id in matrix[1][:7]] + [4]
+        batch = list(sharded.similar_movies_batch(movie_ids, top_n=4, block_size=3))
+        assert [movie_id for movie_id, _ in batch] == movie_ids
+        for movie_id, similar in batch:
+            expected = engine.similar_movies(movie_id, 4)
+            assert [s for _, s in similar] == pytest.approx([s for _, s in expected])
+
+def test_get_vectors(matrix):
+    """Test fetching the vectors of many movies with one call per shard."""
+    with ShardedEngine.from_matrix(*matrix, n_shards=3) as sharded:
+        movie_ids = [int(movie_id) for movie_id in matrix[1][:12]]
+        vectors = sharded.get_vectors(movie_ids)
+        assert len(vectors) == 12
+        for movie_id, (indices, values) in zip(movie_ids, vectors):
+            expected_indices, expected_values = sharded.get_vector(movie_id)
+            assert list(indices) == list(expected_indices)
+            assert list(values) == pytest.approx(list(expected_values))
+
+def test_similar_movies_mask(matrix):
+    """Test that a mask over the sorted movie IDs is split across the shards."""
+    with ShardedEngine.from_matrix(*matrix, n_shards=3) as sharded:
+        mask = sharded.movie_ids % 2 == 1
+        engine = SimilarityEngine(*matrix)
+        engine_mask = engine.movie_ids % 2 == 1
+        for movie_id in matrix[1][:5]:
+            expected = engine.similar_movies(int(movie_id), 5, mask=engine_mask)
+            result = sharded.similar_movies(int(movie_id), 5, mask=mask)
+            assert [s for _, s in result] == pytest.approx([s for _, s in expected])
+            assert all(m % 2 == 1 for m, _ in result)
+
+def test_from_snapshot(matrix, tmp_path):
+    """Test shards mapped from a snapshot."""
+    order = np.argsort(matrix[1])
+    write_snapshot(str(tmp_path), matrix[0][order], matrix[1][order], 'b1')
+    engine = SimilarityEngine(*matrix)
+    with ShardedEngine.from_snapshot(str(tmp_path), n_shards=2) as sharded:
+        movie_id = int(matrix[1][0])
+        expected = engine.similar_movies(movie_id, 5)
+        assert [s for _, s in sharded.similar_movies(movie_id, 5)] == pytest.approx([s for _, s in expected])
@@ -0,0 +1,118 @@
+""" Tests for similarity_engine.py """
+import sys
+import os
+import sqlite3
+import numpy as np
+from scipy.sparse import csr_matrix
+import pytest
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from similarity_engine import load_sparse_matrix, top_n_indices, top_n_per_row, divide_by_norms, block_dot_products, SimilarityEngine
+from matrix_snapshot import write_snapshot
+
+@pytest.fixture(name="db_connection")
+def fixture_db_connection():
+    """Fixture for creating a temporary SQLite database connection."""
+    conn = sqlite3.connect(":memory:")  # Using an in-memory database for testing
+    cur = conn.cursor()
+    cur.execute("CREATE TABLE sparse_tfidf (wikipedia_movie_id INTEGER, tfidf_index INTEGER, tfidf_value REAL)")
+    cur.executemany("INSERT INTO sparse_tfidf VALUES (?, ?, ?)", [
+        (10, 0, 0.6), (10, 1, 0.8),
+        (20, 0, 0.6), (20, 1, 0.8),
+        (30, 1, 1.0),
+        (40, 2, 1.0),
+    ])
+    conn.commit()
+    yield conn
+    conn.close()
+
+def test_load_sparse_matrix(db_connection):
+    """Test loading sparse_tfidf into a CSR matrix."""
+    matrix, movie_ids = load_sparse_matrix(db_connection)
+    assert list(movie_ids) == [10, 20, 30, 40]
+    assert matrix.shape == (4, 3)
+    assert matrix[0, 1] == pytest.approx(0.8)
+    assert matrix[3, 2] == pytest.approx(1.0)
+
+def test_load_sparse_matrix_empty():
+    """Test loading an empty sparse_tfidf table."""
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE sparse_tfidf (wikipedia_movie_id INTEGER, tfidf_index INTEGER, tfidf_value REAL)")
+    matrix, movie_ids = load_sparse_matrix(conn)
+    assert matrix.shape[0] == 0
+    assert len(movie_ids) == 0
+    assert SimilarityEngine(matrix, movie_ids).similar_movies(1) == []
+    conn.close()
+
+def test_top_n_indices():
+    """Test selecting the best positive scores in descending order."""
+    scores = np.array([0.1, 0.0, 0.9, 0.5, 0.7])
+    assert list(top_n_indices(scores, 2)) == [2, 4]
+    assert list(top_n_indices(scores, 10)) == [2, 4, 3, 0]
+    assert len(top_n_indices(scores, 0)) == 0
+
+def test_top_n_per_row():
+    """Test selecting the best columns of every row at once."""
+    scores = np.array([[0.1, 0.0, 0.9, 0.5], [0.3, 0.8, 0.2, 0.0]])
+    best, best_scores = top_n_per_row(scores, 2)
+    assert best.tolist() == [[2, 3], [1, 0]]
+    assert best_scores.tolist() == [[0.9, 0.5], [0.8, 0.3]]
+    assert top_n_per_row(scores, 10)[0].shape == (2, 4)
+
+def test_divide_by_norms():
+    """Test turning dot products into cosine similarities in place, zero norms giving zero."""
+    dots = np.array([[2.0, 0.0, 6.0], [0.0, 0.0, 0.0]])
+    scores = divide_by_norms(dots, np.array([2.0, 0.0]), np.array([1.0, 0.0, 3.0]))
+    assert scores is dots
+    assert scores.tolist() == [[1.0, 0.0, 1.0], [0.0, 0.0, 0.0]]
+
+def test_block_dot_products():
+    """Test scoring a block of query rows against the matrix without transposing it."""
+    matrix = csr_matrix(np.array([[1.0, 0.0, 2.0], [0.0, 3.0, 0.0], [1.0, 1.0, 1.0]]))
+    assert block_dot_products(matrix, matrix[[2, 0]]).tolist() == [[3.0, 3.0, 3.0], [5.0, 0.0, 3.0]]
+
+def test_similar_movies(db_connection):
+    """Test cosine similarity ranking against the loaded matrix."""
+    engine = SimilarityEngine.from_connection(db_connection)
+    assert len(engine) == 4
+    assert 10 in engine
+    similar = engine.similar_movies(10, top_n=5)
+    assert [movie_id for movie_id, _ in similar] == [20, 30]  # 40 shares no terms
+    assert similar[0][1] == pytest.approx(1.0)
+    assert similar[1][1] == pytest.approx(0.8)
+
+def test_similar_movies_mask(db_connection):
+    """Test restricting the results to the rows of a mask."""
+    engine = SimilarityEngine.from_connection(db_connection)
+    mask = np.array([True, False, True, True])
+    assert [movie_id for movie_id, _ in engine.similar_movies(10, top_n=5, mask=mask)] == [30]
+    assert engine.similar_movies(10, top_n=5, mask=np.zeros(4, dtype=bool)) == []
+
+def test_similar_movies_unknown_movie(db_connection):
+    """Test that an unknown movie has no similar movies."""
+    engine = SimilarityEngine.from_connection(db_connection)
+    assert engine.similar_movies(99) == []
+
+def test_similar_movies_batch(db_connection):
+    """Test that batch queries match one query per movie in input order."""
+    engine = SimilarityEngine.from_connection(db_connection)
+    movie_ids = [40, 10, 99, 30, 20]
+    results = list(engine.similar_movies_batch(movie_ids, top_n=2, block_size=2))
+    assert [movie_id for movie_id, _ in results] == movie_ids
+    for movie_id, similar in results:
+        expected = engine.similar_movies(movie_id, top_n=2)
+        assert [m for m, _ in similar] == [m for m, _ in expected]
+        assert [s for _, s in similar] == pytest.approx([s for _, s in expected])
+
+def test_from_snapshot(db_connection, tmp_path):
+    """Test building the engine from a snapshot of the current build."""
+    db_connection.execute("CREATE TABLE tfidf_settings (name TEXT PRIMARY KEY, value TEXT)")
+    db_connection.execute("""INSERT INTO tfidf_settings VALUES ('build_id', '"build-1"')""")
+    write_snapshot(str(tmp_path), *load_sparse_matrix(db_connection), 'build-1')
+
+    engine = SimilarityEngine.from_snapshot(str(tmp_path), db_connection)
+    expected = SimilarityEngine.from_connection(db_connection).similar_movies(10)
+    assert engine.similar_movies(10) == pytest.approx(expected)
+
+    db_connection.execute("""UPDATE tfidf_settings SET value='"build-2"' WHERE name='build_id'""")
+    with pytest.raises(ValueError):
+        SimilarityEngine.from_snapshot(str(tmp_path), db_connection)
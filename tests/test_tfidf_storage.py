@@ -0,0 +1,51 @@
+""" Tests for tfidf_storage.py """
+import sys
+import os
+import sqlite3
+import numpy as np
+import pytest
+from scipy.sparse import csr_matrix
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from tfidf_storage import (create_blob_table, uses_blob_storage, encode_tfidf_vector,
+                           decode_tfidf_vector, get_blob_vector, load_blob_matrix)
+
+@pytest.fixture(name="db_connection")
+def fixture_db_connection():
+    """Fixture for a temporary database with packed TF-IDF vectors."""
+    conn = sqlite3.connect(":memory:")  # Using an in-memory database for testing
+    cur = conn.cursor()
+    create_blob_table(cur)
+    cur.executemany("INSERT INTO tfidf_vectors VALUES (?, ?, ?)", [
+        (20, *encode_tfidf_vector([1, 4], [0.25, 0.5])),
+        (10, *encode_tfidf_vector([0], [1.0])),
+    ])
+    conn.commit()
+    yield conn
+    conn.close()
+
+def test_encode_decode_tfidf_vector():
+    """Test packing a vector into BLOBs and back."""
+    indices_blob, values_blob = encode_tfidf_vector(np.array([3, 7]), np.array([0.5, 0.125]))
+    assert len(indices_blob) == 8 and len(values_blob) == 8
+    indices, values = decode_tfidf_vector(indices_blob, values_blob)
+    assert list(indices) == [3, 7]
+    assert list(values) == [0.5, 0.125]
+
+def test_uses_blob_storage(db_connection):
+    """Test detecting the packed storage layout."""
+    assert uses_blob_storage(db_connection.cursor())
+    assert not uses_blob_storage(sqlite3.connect(":memory:").cursor())
+
+def test_get_blob_vector(db_connection):
+    """Test reading the vector of one movie."""
+    indices, values = get_blob_vector(db_connection.cursor(), 20)
+    assert list(indices) == [1, 4]
+    assert list(values) == [0.25, 0.5]
+    assert get_blob_vector(db_connection.cursor(), 99) is None
+
+def test_load_blob_matrix(db_connection):
+    """Test loading every packed vector into a CSR matrix."""
+    matrix, movie_ids = load_blob_matrix(db_connection)
+    assert list(movie_ids) == [10, 20]
+    expected = csr_matrix(([1.0, 0.25, 0.5], ([0, 1, 1], [0, 1, 4])), shape=(2, 5))
+    assert (matrix != expected).nnz == 0
@@ -1,12 +1,19 @@
 """ Tests for vector_model.py """
 import sys
 import os
+import io
+import json
 import sqlite3
+from concurrent.futures import ProcessPoolExecutor
 import nltk
 from sklearn.feature_extraction.text import TfidfVectorizer
 import pytest
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-from vector_model import create_connection, setup_database, preprocess_text, save_tfidf_values, process_and_save_documents
+from vector_model import create_connection, setup_database, preprocess_text, save_tfidf_values, process_and_save_documents, save_vectorizer, load_vectorizer, TextPreprocessor, preprocess_documents, save_tfidf_blobs, record_build, export_snapshot, save_neighbours, update_documents, save_dense_vectors, save_tfidf_chunks, iter_spilled_chunks, iter_spilled_hashes
+from matrix_snapshot import read_manifest
+from tfidf_storage import get_build_id
+from similarity_engine import load_sparse_matrix, SimilarityEngine
+from dense_index import DenseIndex
 
 nltk.download('punkt')
 nltk.download('stopwords')
@@ -38,6 +45,29 @@ def test_preprocess_text():
     expected_text = "sampl text stopword differ form"  # Expected result after stemming and stopword removal
     assert processed_text == expected_text
 
+def test_text_preprocessor():
+    """Test the reusable preprocessor and its stem cache."""
+    preprocessor = TextPreprocessor(stem_cache_size=10)
+    texts = ["This is a sample text with stopwords and different forms.", "Sample forms!"]
+    processed = list(preprocessor.preprocess_many(iter(texts)))
+    assert processed == [preprocess_text(text) for text in texts]
+    assert processed[1] == "sampl form"
+    cache_info = preprocessor.stem.cache_info()
+    assert cache_info.hits == 2  # "sample" and "forms" were stemmed before
+    assert cache_info.maxsize == 10
+
+def test_preprocess_documents_parallel():
+    """Test that parallel preprocessing keeps the serial output and order."""
+    texts = [f"Document number {i} talks about running dogs and cats." for i in range(25)]
+    texts[7] = "A completely different story."
+    serial = preprocess_documents(texts)
+    assert preprocess_documents(texts, workers=2, chunk_size=4) == serial
+    # One pool can serve several batches
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        assert preprocess_documents(texts, workers=2, chunk_size=4, executor=executor) == serial
+        assert preprocess_documents(texts[:10], workers=2, chunk_size=4, executor=executor) == serial[:10]
+    assert serial[7] == "complet differ stori"
+
 def test_save_tfidf_values(db_connection):
     """Test saving TF-IDF values to the database."""
     documents = ["This is a test document.", "This document is a test."]
@@ -51,6 +81,99 @@ def test_save_tfidf_values(db_connection):
     rows = cur.fetchall()
     assert len(rows) > 0  # Ensure that some rows were inserted
 
+def test_save_tfidf_values_batches(db_connection):
+    """Test that batched saving stores every value and restores the indexes."""
+    documents = ["red green blue", "green blue", "blue yellow purple", "red"]
+    tfidf_matrix = TfidfVectorizer().fit_transform(documents)
+    save_tfidf_values(db_connection, tfidf_matrix, [10, 20, 30, 40], batch_size=3)
+
+    cur = db_connection.cursor()
+    cur.execute("SELECT wikipedia_movie_id, tfidf_index, tfidf_value FROM sparse_tfidf")
+    stored = {(movie_id, idx): value for movie_id, idx, value in cur.fetchall()}
+    assert len(stored) == tfidf_matrix.nnz
+    for row, movie_id in enumerate([10, 20, 30, 40]):
+        for idx in tfidf_matrix[row].indices:
+            assert stored[(movie_id, int(idx))] == pytest.approx(tfidf_matrix[row, idx])
+    cur.execute("SELECT name FROM sqlite_master WHERE type='index' AND name LIKE 'idx_sparse_%'")
+    assert sorted(name for (name,) in cur.fetchall()) == ['idx_sparse_index', 'idx_sparse_movie']
+    assert cur.execute("PRAGMA synchronous").fetchone()[0] == 2  # FULL again after the load
+
+def test_save_tfidf_values_failure_rolls_back(db_connection):
+    """Test that a failed load keeps the previous values and indexes."""
+    tfidf_matrix = TfidfVectorizer().fit_transform(["red green blue", "green blue"])
+    save_tfidf_values(db_connection, tfidf_matrix, [10, 20])
+    with pytest.raises(sqlite3.IntegrityError):
+        save_tfidf_values(db_connection, tfidf_matrix, [10, 30])  # Movie 10 is already stored
+
+    assert not db_connection.in_transaction
+    cur = db_connection.cursor()
+    cur.execute("SELECT DISTINCT wikipedia_movie_id FROM sparse_tfidf ORDER BY 1")
+    assert cur.fetchall() == [(10,), (20,)]
+    cur.execute("SELECT name FROM sqlite_master WHERE type='index' AND name LIKE 'idx_sparse_%'")
+    assert sorted(name for (name,) in cur.fetchall()) == ['idx_sparse_index', 'idx_sparse_movie']
+
+def test_save_tfidf_chunks_failure_rolls_back(db_connection):
+    """Test that a failed streamed load raises its own error and keeps the indexes."""
+    tfidf_matrix = TfidfVectorizer().fit_transform(["red green blue", "green blue"])
+    save_tfidf_values(db_connection, tfidf_matrix, [10, 20])
+    with pytest.raises(sqlite3.IntegrityError):
+        save_tfidf_chunks(db_connection, [(tfidf_matrix, [30, 40]), (tfidf_matrix, [10, 50])])
+
+    assert not db_connection.in_transaction
+    cur = db_connection.cursor()
+    cur.execute("SELECT DISTINCT wikipedia_movie_id FROM sparse_tfidf ORDER BY 1")
+    assert cur.fetchall() == [(10,), (20,)]
+    cur.execute("SELECT name FROM sqlite_master WHERE type='index' AND name LIKE 'idx_sparse_%'")
+    assert sorted(name for (name,) in cur.fetchall()) == ['idx_sparse_index', 'idx_sparse_movie']
+
+def test_save_tfidf_chunks_plot_hashes(db_connection):
+    """Test that plot hashes are only replaced together with the vectors."""
+    tfidf_matrix = TfidfVectorizer().fit_transform(["red green blue", "green blue"])
+    save_tfidf_chunks(db_connection, [(tfidf_matrix, [10, 20])], plot_hashes=[(10, 'a'), (20, 'b')])
+    cur = db_connection.cursor()
+    assert cur.execute("SELECT * FROM plot_hashes ORDER BY 1").fetchall() == [(10, 'a'), (20, 'b')]
+
+    setup_database(db_connection)
+    save_tfidf_values(db_connection, tfidf_matrix, [10, 20])
+    save_tfidf_chunks(db_connection, [], plot_hashes=[(10, 'a'), (20, 'b')])
+    with pytest.raises(sqlite3.IntegrityError):
+        save_tfidf_chunks(db_connection, [(tfidf_matrix, [10, 30])], plot_hashes=[(10, 'new'), (30, 'c')])
+    assert cur.execute("SELECT * FROM plot_hashes ORDER BY 1").fetchall() == [(10, 'a'), (20, 'b')]
+
+def test_iter_spilled_hashes():
+    """Test reading the documents and plot hashes back from the spill file."""
+    spill_file = io.StringIO("10\tabc\tred green\n20\tdef\tgreen\n")
+    vectorizer = TfidfVectorizer().fit(["red green", "green"])
+    chunks = list(iter_spilled_chunks(spill_file, vectorizer, batch_size=1))
+    assert [movie_ids for _, movie_ids in chunks] == [[10], [20]]
+    assert list(iter_spilled_hashes(spill_file)) == [(10, 'abc'), (20, 'def')]
+
+def test_save_tfidf_blobs():
+    """Test saving packed vectors into the BLOB storage layout."""
+    conn = sqlite3.connect(":memory:")
+    setup_database(conn, storage='blob')
+    cur = conn.cursor()
+    cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name LIKE '%tfidf%'")
+    assert {name for (name,) in cur.fetchall()} == {'tfidf_vectors', 'tfidf_vocabulary', 'tfidf_settings'}
+
+    tfidf_matrix = TfidfVectorizer().fit_transform(["red green blue", "green blue", "yellow"])
+    save_tfidf_blobs(conn, tfidf_matrix, [10, 20, 30], batch_size=2)
+    matrix, movie_ids = load_sparse_matrix(conn)
+    assert list(movie_ids) == [10, 20, 30]
+    assert matrix.toarray() == pytest.approx(tfidf_matrix.toarray(), abs=1e-6)
+
+    # A failed load raises its own error and keeps the stored vectors
+    with pytest.raises(sqlite3.IntegrityError):
+        save_tfidf_blobs(conn, tfidf_matrix, [40, 50, 10], batch_size=2)
+    assert not conn.in_transaction
+    assert list(load_sparse_matrix(conn)[1]) == [10, 20, 30]
+    conn.close()
+
+def test_setup_database_unknown_storage(db_connection):
+    """Test rejecting an unknown storage layout."""
+    with pytest.raises(ValueError):
+        setup_database(db_connection, storage='columns')
+
 def test_process_and_save_documents(db_connection):
     """Test processing and saving documents to the database."""
     cur = db_connection.cursor()
@@ -65,3 +188,140 @@ def test_process_and_save_documents(db_connection):
     cur.execute("SELECT * FROM sparse_tfidf")
     rows = cur.fetchall()
     assert len(rows) > 0  # Ensure that some rows were inserted
+
+def test_save_and_load_vectorizer(db_connection):
+    """Test that a stored vectorizer projects text like the fitted one."""
+    documents = ["sampl text stopword", "differ form text", "anoth sampl"]
+    vectorizer = TfidfVectorizer()
+    vectorizer.fit(documents)
+    save_vectorizer(db_connection, vectorizer)
+
+    loaded = load_vectorizer(db_connection)
+    assert loaded.vocabulary == vectorizer.vocabulary_
+    expected = vectorizer.transform(["sampl text unknown"]).toarray()
+    assert loaded.transform(["sampl text unknown"]).toarray() == pytest.approx(expected)
+
+def test_load_vectorizer_missing(db_connection):
+    """Test loading a vectorizer before one was saved."""
+    with pytest.raises(ValueError):
+        load_vectorizer(db_connection)
+
+def test_record_build(db_connection):
+    """Test that every build gets a new build ID."""
+    assert get_build_id(db_connection.cursor()) is None
+    first_build = record_build(db_connection)
+    assert get_build_id(db_connection.cursor()) == first_build
+    assert record_build(db_connection) != first_build
+
+def test_export_snapshot(db_connection, tmp_path):
+    """Test exporting a snapshot tied to the current build."""
+    tfidf_matrix = TfidfVectorizer().fit_transform(["red green", "green blue"])
+    save_tfidf_values(db_connection, tfidf_matrix, [1, 2])
+    build_id = record_build(db_connection)
+    export_snapshot(db_connection, str(tmp_path))
+    manifest = read_manifest(str(tmp_path))
+    assert manifest['build_id'] == build_id
+    assert manifest['shape'] == [2, 3]
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_save_neighbours(db_connection, workers):
+    """Test precomputing the neighbours of every movie in blocks."""
+    documents = ["red green blue", "green blue", "blue yellow purple", "red", "orange"]
+    tfidf_matrix = TfidfVectorizer().fit_transform(documents)
+    save_tfidf_values(db_connection, tfidf_matrix, [10, 20, 30, 40, 50])
+    build_id = record_build(db_connection)
+    save_neighbours(db_connection, top_k=2, block_size=2, workers=workers)
+
+    engine = SimilarityEngine.from_connection(db_connection)
+    cur = db_connection.cursor()
+    for movie_id in [10, 20, 30, 40, 50]:
+        cur.execute("""SELECT similar_movie_id, similarity FROM similar_movies
+                       WHERE wikipedia_movie_id=? ORDER BY rank""", (movie_id,))
+        stored = cur.fetchall()
+        expected = engine.similar_movies(movie_id, 2)
+        assert [m for m, _ in stored] == [m for m, _ in expected]
+        assert [s for _, s in stored] == pytest.approx([s for _, s in expected], abs=1e-6)
+    cur.execute("SELECT value FROM tfidf_settings WHERE name='neighbours'")
+    assert cur.fetchone()[0] == f'{{"build_id": "{build_id}", "top_k": 2}}'
+
+@pytest.mark.parametrize("storage", ["rows", "blob"])
+def test_update_documents(storage):
+    """Test that an incremental update matches the stored vocabulary's vectors."""
+    conn = sqlite3.connect(":memory:")
+    setup_database(conn, storage)
+    cur = conn.cursor()
+    cur.execute("CREATE TABLE plot_summaries (wikipedia_movie_id INTEGER, plot_summary TEXT)")
+    documents = {i: f"story number {i} about a dragon and a knight" for i in range(1, 21)}
+    cur.executemany("INSERT INTO plot_summaries VALUES (?, ?)", documents.items())
+    conn.commit()
+    assert update_documents(conn)['refit']
+    first_build = get_build_id(cur)
+
+    cur.execute("UPDATE plot_summaries SET plot_summary='a knight' WHERE wikipedia_movie_id=3")
+    cur.execute("DELETE FROM plot_summaries WHERE wikipedia_movie_id=4")
+    conn.commit()
+    assert update_documents(conn) == {'changed': 1, 'deleted': 1, 'refit': False}
+    assert get_build_id(cur) != first_build
+    assert update_documents(conn) == {'changed': 0, 'deleted': 0, 'refit': False}
+    cur.execute("SELECT value FROM tfidf_settings WHERE name='drift'")
+    assert json.loads(cur.fetchone()[0]) == {'documents': 19, 'changed': 2}
+
+    cur.executemany("INSERT INTO plot_summaries VALUES (?, ?)", [(21, "a dragon"), (22, "a story")])
+    conn.commit()
+    assert update_documents(conn, refit_threshold=1) == {'changed': 2, 'deleted': 0, 'refit': False}
+    cur.execute("SELECT value FROM tfidf_settings WHERE name='drift'")
+    assert json.loads(cur.fetchone()[0]) == {'documents': 21, 'changed': 4}
+
+    matrix, movie_ids = load_sparse_matrix(conn)
+    assert 4 not in movie_ids
+    vectorizer = load_vectorizer(conn)
+    expected = vectorizer.transform([preprocess_text("a knight")]).toarray()
+    row = list(movie_ids).index(3)
+    assert matrix[row].toarray()[0, :expected.shape[1]] == pytest.approx(expected[0], abs=1e-6)
+    conn.close()
+
+def test_update_documents_refit(db_connection):
+    """Test that too many changes since the last fit trigger a full refit."""
+    cur = db_connection.cursor()
+    cur.execute("CREATE TABLE plot_summaries (wikipedia_movie_id INTEGER, plot_summary TEXT)")
+    cur.executemany("INSERT INTO plot_summaries VALUES (?, ?)", [(1, "red green"), (2, "green blue")])
+    db_connection.commit()
+    process_and_save_documents(db_connection)
+
+    cur.execute("INSERT INTO plot_summaries VALUES (3, 'yellow purple')")
+    db_connection.commit()
+    assert update_documents(db_connection, refit_threshold=0.4)['refit']
+    assert "yellow" in load_vectorizer(db_connection).vocabulary
+    cur.execute("SELECT COUNT(*) FROM plot_hashes")
+    assert cur.fetchone()[0] == 3
+
+@pytest.mark.parametrize("storage", ["rows", "blob"])
+def test_process_and_save_documents_streaming(storage):
+    """Test that the streaming build equals fitting the whole corpus at once."""
+    conn = sqlite3.connect(":memory:")
+    setup_database(conn, storage)
+    cur = conn.cursor()
+    cur.execute("CREATE TABLE plot_summaries (wikipedia_movie_id INTEGER, plot_summary TEXT)")
+    texts = ["red green blue", "green blue", "blue yellow purple", "red", "orange red green", "purple"]
+    cur.executemany("INSERT INTO plot_summaries VALUES (?, ?)", enumerate(texts, start=1))
+    conn.commit()
+    process_and_save_documents(conn, batch_size=4)
+
+    vectorizer = TfidfVectorizer()
+    expected = vectorizer.fit_transform([preprocess_text(text) for text in texts])
+    matrix, movie_ids = load_sparse_matrix(conn)
+    assert list(movie_ids) == [1, 2, 3, 4, 5, 6]
+    assert matrix.toarray() == pytest.approx(expected.toarray(), abs=1e-6)
+    assert load_vectorizer(conn).vocabulary == vectorizer.vocabulary_
+    cur.execute("SELECT COUNT(*) FROM plot_hashes")
+    assert cur.fetchone()[0] == 6
+    conn.close()
+
+def test_save_dense_vectors(db_connection):
+    """Test building the dense index of the current build."""
+    documents = ["red green blue", "green blue", "blue yellow purple", "red", "orange"]
+    save_tfidf_values(db_connection, TfidfVectorizer().fit_transform(documents), [10, 20, 30, 40, 50])
+    record_build(db_connection)
+    index = save_dense_vectors(db_connection, dimensions=3, n_lists=2)
+    assert index.embeddings.shape == (5, 3)
+    assert DenseIndex.from_connection(db_connection).similar_movies(20, 2) == index.similar_movies(20, 2)
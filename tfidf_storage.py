@@ -0,0 +1,93 @@
+"""
+Compact storage layout for the TF-IDF vectors.
+Instead of one sparse_tfidf row per (movie, term) pair, the tfidf_vectors table
+holds one row per movie with its term indices packed as little-endian int32 and
+its TF-IDF values as little-endian float32 BLOBs, decoded with np.frombuffer.
+"""
+
+import json
+import sqlite3
+import numpy as np
+from scipy.sparse import csr_matrix
+
+INDEX_DTYPE = np.dtype('<i4')
+VALUE_DTYPE = np.dtype('<f4')
+
+# Names accepted by vector_model.setup_database(storage=...)
+STORAGE_ROWS = 'rows'
+STORAGE_BLOB = 'blob'
+
+
+def create_blob_table(cur):
+    """ Create the BLOB-per-document table of TF-IDF vectors """
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS tfidf_vectors (
+            wikipedia_movie_id INTEGER PRIMARY KEY,
+            tfidf_indices BLOB NOT NULL,
+            tfidf_values BLOB NOT NULL
+        )
+    """)
+
+
+def uses_blob_storage(cur):
+    """ Check whether the database stores its vectors in tfidf_vectors """
+    cur.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='tfidf_vectors'")
+    return cur.fetchone() is not None
+
+
+def get_build_id(cur):
+    """ Get the ID of the last completed vector build, or None if there is none """
+    try:
+        cur.execute("SELECT value FROM tfidf_settings WHERE name='build_id'")
+    except sqlite3.OperationalError:
+        return None
+    row = cur.fetchone()
+    return json.loads(row[0]) if row else None
+
+
+def encode_tfidf_vector(indices, values):
+    """ Pack the indices and values of one vector into a pair of BLOBs """
+    return (np.asarray(indices).astype(INDEX_DTYPE, copy=False).tobytes(),
+            np.asarray(values).astype(VALUE_DTYPE, copy=False).tobytes())
+
+
+def decode_tfidf_vector(indices_blob, values_blob):
+    """ Unpack a pair of BLOBs into read-only index and value arrays without copying """
+    return (np.frombuffer(indices_blob, dtype=INDEX_DTYPE),
+            np.frombuffer(values_blob, dtype=VALUE_DTYPE))
+
+
+def get_blob_vector(cur, wikipedia_movie_id):
+    """ Get the (indices, values) arrays of one movie, or None if it is not stored """
+    cur.execute("""SELECT tfidf_indices, tfidf_values
+                   FROM tfidf_vectors
+                   WHERE wikipedia_movie_id=?""", (wikipedia_movie_id,))
+    row = cur.fetchone()
+    return decode_tfidf_vector(*row) if row else None
+
+
+def load_blob_matrix(conn):
+    """
+    Load every stored vector into a CSR matrix.
+
+    Parameters:
+        conn (Connection): A connection object to the SQLite database.
+
+    Returns:
+        tuple: (csr_matrix, numpy array of wikipedia_movie_id per matrix row)
+    """
+    cur = conn.cursor()
+    cur.execute("""SELECT wikipedia_movie_id, tfidf_indices, tfidf_values
+                   FROM tfidf_vectors
+                   ORDER BY wikipedia_movie_id""")
+    rows = cur.fetchall()
+    if not rows:
+        return csr_matrix((0, 0)), np.empty(0, dtype=np.int64)
+
+    movie_ids = np.array([row[0] for row in rows], dtype=np.int64)
+    indices = np.concatenate([np.frombuffer(row[1], dtype=INDEX_DTYPE) for row in rows])
+    values = np.concatenate([np.frombuffer(row[2], dtype=VALUE_DTYPE) for row in rows])
+    indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum([len(row[1]) // INDEX_DTYPE.itemsize for row in rows], out=indptr[1:])
+    n_columns = int(indices.max()) + 1 if indices.size else 0
+    return csr_matrix((values, indices, indptr), shape=(len(rows), n_columns)), movie_ids
@@ -6,37 +6,154 @@ It performs the following tasks:
 3. Processes the text data from movie plot summaries by tokenizing, removing stopwords, and applying stemming.
 4. Converts the preprocessed text data into TF-IDF vectors using the sklearn TfidfVectorizer.
 5. Saves these sparse TF-IDF vectors into the database for later retrieval and analysis.
+6. Saves the fitted vocabulary, IDF weights and preprocessing configuration so that
+   free-text queries can be projected into the same vector space.
+7. Optionally updates the vectors incrementally, re-vectorizing only the plot summaries
+   added or changed since the last build.
 This script is designed to facilitate quick access to precomputed TF-IDF vectors for movie recommendation or search functionalities.
 """
 
+import argparse
+import contextlib
+import hashlib
+import json
+import logging
 import sqlite3
+import tempfile
 import time
+import uuid
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import islice
+import numpy as np
+from scipy.sparse import csr_matrix
 from nltk.corpus import stopwords
 from nltk.stem import PorterStemmer
 from nltk.tokenize import word_tokenize
 from sklearn.feature_extraction.text import TfidfVectorizer
+from dense_index import EMBEDDING_DIMENSIONS, DenseIndex, fit_embeddings, save_dense_index
+from matrix_snapshot import write_snapshot
+from metrics import JsonLinesSink, LoggingSink, add_sink, increment, profiled, remove_sink, timed
+from similarity_engine import load_sparse_matrix, top_n_per_row
+from tfidf_storage import (STORAGE_ROWS, STORAGE_BLOB, create_blob_table,
+                           encode_tfidf_vector, get_build_id, uses_blob_storage)
 
 # Ensure necessary NLTK resources are downloaded
 #nltk.download('punkt')
 #nltk.download('stopwords')
 
+# Description of preprocess_text, stored with the vocabulary to detect mismatches
+PREPROCESSING_CONFIG = {
+    'tokenizer': 'nltk.word_tokenize',
+    'stopwords': 'english',
+    'stemmer': 'porter',
+    'alphabetic_only': True,
+}
 
-def setup_database(conn):
-    """ Setup the database """
+# Maximum number of distinct words whose stems are memoized
+STEM_CACHE_SIZE = 100_000
+
+# Number of documents handed to a preprocessing worker at a time
+PREPROCESS_CHUNK_SIZE = 500
+
+# Number of documents read, preprocessed and vectorized at a time by the streaming build
+STREAM_BATCH_SIZE = 10_000
+
+# Number of TF-IDF values inserted per executemany batch
+SAVE_BATCH_SIZE = 100_000
+
+# Number of movies inserted per executemany batch into tfidf_vectors
+SAVE_BLOB_BATCH_SIZE = 5_000
+
+# Connection settings used while bulk loading the TF-IDF vectors
+BULK_LOAD_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'OFF',
+    'cache_size': -262144,  # 256 MiB
+    'temp_store': 'MEMORY',
+}
+
+# Default directory of the memory-mapped matrix snapshot
+SNAPSHOT_DIR = 'tfidf_snapshot'
+
+# Number of neighbours precomputed per movie and movies scored per block
+NEIGHBOUR_COUNT = 20
+NEIGHBOUR_BLOCK_SIZE = 256
+
+# Share of documents changed since the last fit that triggers a full refit
+REFIT_THRESHOLD = 0.1
+
+# TfidfVectorizer parameters needed to vectorize queries like the corpus
+VECTORIZER_PARAMS = ('lowercase', 'token_pattern', 'ngram_range', 'binary',
+                     'norm', 'use_idf', 'smooth_idf', 'sublinear_tf')
+
+
+def setup_database(conn, storage=STORAGE_ROWS):
+    """
+    Setup the database.
+
+    Parameters:
+        conn (Connection): A connection object to the SQLite database.
+        storage (str): STORAGE_ROWS for one sparse_tfidf row per (movie, term) pair,
+            STORAGE_BLOB for one packed tfidf_vectors row per movie.
+    """
+    if storage not in (STORAGE_ROWS, STORAGE_BLOB):
+        raise ValueError(f"Unknown storage layout: {storage}")
     cur = conn.cursor()
     cur.execute("DROP TABLE IF EXISTS sparse_tfidf;")
+    cur.execute("DROP TABLE IF EXISTS tfidf_vectors;")
+    if storage == STORAGE_BLOB:
+        create_blob_table(cur)
+    else:
+        cur.execute("""
+            CREATE TABLE sparse_tfidf (
+                wikipedia_movie_id INTEGER,
+                tfidf_index INTEGER,
+                tfidf_value REAL,
+                PRIMARY KEY (wikipedia_movie_id, tfidf_index)
+            )
+        """)
+        create_sparse_indexes(cur)
+    cur.execute("DROP TABLE IF EXISTS tfidf_vocabulary;")
+    cur.execute("DROP TABLE IF EXISTS tfidf_settings;")
+    cur.execute("DROP TABLE IF EXISTS plot_hashes;")
+    create_vocabulary_tables(cur)
+    conn.commit()
+
+def create_sparse_indexes(cur):
+    """ Indexes to speed up queries """
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_sparse_movie ON sparse_tfidf(wikipedia_movie_id);")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_sparse_index ON sparse_tfidf(tfidf_index);")
+
+def drop_sparse_indexes(cur):
+    """ Drop the secondary indexes of sparse_tfidf before a bulk load """
+    cur.execute("DROP INDEX IF EXISTS idx_sparse_movie;")
+    cur.execute("DROP INDEX IF EXISTS idx_sparse_index;")
+
+def apply_pragmas(cur, pragmas):
+    """ Apply PRAGMA settings and return their previous values """
+    previous = {}
+    for name, value in pragmas.items():
+        previous[name] = cur.execute(f"PRAGMA {name}").fetchone()[0]
+        cur.execute(f"PRAGMA {name}={value}")
+    return previous
+
+def create_vocabulary_tables(cur):
+    """ Create the tables holding the fitted vocabulary and vectorizer settings """
     cur.execute("""
-        CREATE TABLE sparse_tfidf (
-            wikipedia_movie_id INTEGER,
-            tfidf_index INTEGER,
-            tfidf_value REAL,
-            PRIMARY KEY (wikipedia_movie_id, tfidf_index)
+        CREATE TABLE IF NOT EXISTS tfidf_vocabulary (
+            tfidf_index INTEGER PRIMARY KEY,
+            term TEXT NOT NULL UNIQUE,
+            idf REAL
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS tfidf_settings (
+            name TEXT PRIMARY KEY,
+            value TEXT
         )
     """)
-    # Indexes to speed up queries
-    cur.execute("CREATE INDEX IF NOT EXISTS idx_sparse_movie ON sparse_tfidf(wikipedia_movie_id);")
-    cur.execute("CREATE INDEX IF NOT EXISTS idx_sparse_index ON sparse_tfidf(tfidf_index);")
-    conn.commit()
 
 def create_connection(db_file):
     """ Create a connection to a SQLite database """
@@ -48,61 +165,701 @@ def create_connection(db_file):
     return conn
 
 
+class TextPreprocessor:
+    """
+    Tokenize, remove stop words, and apply stemming to text.
+    The stemmer and stop word set are initialised once and stems are memoized,
+    so a single instance should be reused for a whole corpus.
+    """
+
+    def __init__(self, stem_cache_size=STEM_CACHE_SIZE):
+        self.stemmer = PorterStemmer()
+        self.stop_words = frozenset(stopwords.words('english'))
+        self.stem = lru_cache(maxsize=stem_cache_size)(self.stemmer.stem)
+
+    def preprocess(self, text):
+        """ Preprocess a single document into a string of stems """
+        processed_tokens = []
+        for token in word_tokenize(text):
+            if token.isalpha():
+                word = token.lower()
+                if word not in self.stop_words:
+                    processed_tokens.append(self.stem(word))
+        return ' '.join(processed_tokens)
+
+    def preprocess_many(self, texts):
+        """ Lazily preprocess an iterable of documents, preserving order """
+        for text in texts:
+            yield self.preprocess(text)
+
+
+_preprocessor = None
+
+
+def get_preprocessor():
+    """ Return the shared TextPreprocessor, creating it on first use """
+    global _preprocessor
+    if _preprocessor is None:
+        _preprocessor = TextPreprocessor()
+    return _preprocessor
+
+
 def preprocess_text(text):
     """
     Tokenize, remove stop words, and apply stemming to the text.
     """
-    # Initialize NLTK tools
-    ps = PorterStemmer()
-    stop_words = set(stopwords.words('english'))
-    tokens = word_tokenize(text)
-    processed_tokens = [ps.stem(w.lower())
-                        for w in tokens
-                        if w.lower()
-                        not in stop_words and w.isalpha()]
-    return ' '.join(processed_tokens)
+    return get_preprocessor().preprocess(text)
+
+
+def _preprocess_chunk(texts):
+    """ Preprocess one chunk of documents inside a worker process """
+    return list(get_preprocessor().preprocess_many(texts))
 
 
-def save_tfidf_values(conn, tfidf_matrix, wikipedia_movie_ids):
-    """Save the TF-IDF values to the database"""
+def preprocess_documents(texts, workers=1, chunk_size=PREPROCESS_CHUNK_SIZE, executor=None):
+    """
+    Preprocess documents, optionally fanning chunks out across processes.
+
+    Parameters:
+        texts (list): Raw documents.
+        workers (int): Number of worker processes, 1 preprocesses in this process.
+        chunk_size (int): Number of documents sent to a worker at a time.
+        executor (ProcessPoolExecutor): Pool to reuse across calls, by default one
+            is started for this call when workers > 1.
+
+    Returns:
+        list: Preprocessed documents in the same order as texts.
+    """
+    if (executor is None and workers <= 1) or len(texts) <= chunk_size:
+        return _preprocess_chunk(texts)
+    if executor is None:
+        with ProcessPoolExecutor(max_workers=workers) as own_executor:
+            return preprocess_documents(texts, workers, chunk_size, own_executor)
+    chunks = [texts[start:start + chunk_size] for start in range(0, len(texts), chunk_size)]
+    documents = []
+    # map yields results in submission order, keeping the output deterministic
+    for processed_chunk in executor.map(_preprocess_chunk, chunks):
+        documents.extend(processed_chunk)
+    return documents
+
+
+def insert_tfidf_values(cur, tfidf_matrix, wikipedia_movie_ids, batch_size=SAVE_BATCH_SIZE):
+    """ Insert the CSR arrays of a matrix into sparse_tfidf in fixed-size batches """
+    tfidf_matrix = csr_matrix(tfidf_matrix)
+    if not tfidf_matrix.has_sorted_indices:
+        tfidf_matrix = tfidf_matrix.sorted_indices()
+    # One movie ID per stored value, following the CSR row layout
+    movie_ids = np.repeat(np.asarray(wikipedia_movie_ids, dtype=np.int64),
+                          np.diff(tfidf_matrix.indptr))
+    for start in range(0, tfidf_matrix.nnz, batch_size):
+        end = start + batch_size
+        cur.executemany("""INSERT INTO sparse_tfidf
+                            (wikipedia_movie_id,
+                            tfidf_index,
+                            tfidf_value)
+                            VALUES (?, ?, ?)""",
+                            zip(movie_ids[start:end].tolist(),
+                                tfidf_matrix.indices[start:end].tolist(),
+                                tfidf_matrix.data[start:end].tolist()))
+
+
+def iter_blob_rows(tfidf_matrix, wikipedia_movie_ids, rows):
+    """ Yield (wikipedia_movie_id, indices BLOB, values BLOB) for the given matrix rows """
+    indptr = tfidf_matrix.indptr
+    for row in rows:
+        yield (int(wikipedia_movie_ids[row]),
+               *encode_tfidf_vector(tfidf_matrix.indices[indptr[row]:indptr[row + 1]],
+                                    tfidf_matrix.data[indptr[row]:indptr[row + 1]]))
+
+
+def insert_tfidf_blobs(cur, tfidf_matrix, wikipedia_movie_ids, batch_size=SAVE_BLOB_BATCH_SIZE):
+    """ Insert the rows of a matrix into tfidf_vectors in fixed-size batches """
+    tfidf_matrix = csr_matrix(tfidf_matrix)
+    if not tfidf_matrix.has_sorted_indices:
+        tfidf_matrix = tfidf_matrix.sorted_indices()
+    for start in range(0, len(wikipedia_movie_ids), batch_size):
+        rows = range(start, min(start + batch_size, len(wikipedia_movie_ids)))
+        cur.executemany("""INSERT INTO tfidf_vectors
+                            (wikipedia_movie_id,
+                            tfidf_indices,
+                            tfidf_values)
+                            VALUES (?, ?, ?)""",
+                            iter_blob_rows(tfidf_matrix, wikipedia_movie_ids, rows))
+
+
+def save_tfidf_chunks(conn, chunks, plot_hashes=None):
+    """
+    Save a stream of TF-IDF matrix chunks in the layout of the database.
+    The bulk-load PRAGMAs are applied and the sparse_tfidf indexes dropped once
+    for the whole stream, and the indexes are rebuilt after the last chunk.
+    The whole stream is one transaction, a failed load rolls back the index drop too.
+
+    Parameters:
+        conn (Connection): A connection object to the SQLite database.
+        chunks (iterable): (tfidf_matrix, wikipedia_movie_ids) pairs.
+        plot_hashes (iterable): (wikipedia_movie_id, content_hash) pairs replacing
+            plot_hashes once the vectors are in, in the same transaction.
+    """
+    conn.commit()  # The journal mode cannot change inside a transaction
     cur = conn.cursor()
-    data_to_insert = []
-    for i, movie_id in enumerate(wikipedia_movie_ids):
-        indices = tfidf_matrix[i].nonzero()[1]
-        for idx in indices:
-            value = tfidf_matrix[i, idx]
-            data_to_insert.append((movie_id, idx, value))
-
-    cur.executemany("""INSERT INTO sparse_tfidf
-                        (wikipedia_movie_id,
-                        tfidf_index,
-                        tfidf_value)
-                        VALUES (?, ?, ?)""",
-                        data_to_insert)
+    blob_storage = uses_blob_storage(cur)
+    previous_pragmas = apply_pragmas(cur, BULK_LOAD_PRAGMAS)
+    try:
+        # DDL does not open a transaction implicitly, without BEGIN the indexes would be dropped at once
+        cur.execute("BEGIN")
+        if not blob_storage:
+            drop_sparse_indexes(cur)
+        for tfidf_matrix, wikipedia_movie_ids in chunks:
+            with timed('index.save'):
+                if blob_storage:
+                    insert_tfidf_blobs(cur, tfidf_matrix, wikipedia_movie_ids)
+                else:
+                    insert_tfidf_values(cur, tfidf_matrix, wikipedia_movie_ids)
+        if not blob_storage:
+            with timed('index.create_indexes'):
+                create_sparse_indexes(cur)
+        if plot_hashes is not None:
+            create_plot_hashes_table(cur)
+            cur.execute("DELETE FROM plot_hashes")
+            cur.executemany("INSERT OR REPLACE INTO plot_hashes (wikipedia_movie_id, content_hash) VALUES (?, ?)",
+                            plot_hashes)
+        conn.commit()
+    except BaseException:
+        # The PRAGMAs below cannot change while the transaction is open
+        conn.rollback()
+        raise
+    finally:
+        previous_pragmas.pop('journal_mode')  # WAL is kept for concurrent readers
+        apply_pragmas(cur, previous_pragmas)
+
+
+def save_tfidf_values(conn, tfidf_matrix, wikipedia_movie_ids, batch_size=SAVE_BATCH_SIZE):
+    """
+    Save the TF-IDF values to the database.
+    The CSR arrays are streamed into SQLite in fixed-size batches with bulk-load
+    PRAGMAs, and the secondary indexes are rebuilt once after the load. Dropping
+    the indexes and the load share one transaction, a failed load rolls back both.
+    """
+    conn.commit()  # The journal mode cannot change inside a transaction
+    cur = conn.cursor()
+    previous_pragmas = apply_pragmas(cur, BULK_LOAD_PRAGMAS)
+    try:
+        # DDL does not open a transaction implicitly, without BEGIN the indexes would be dropped at once
+        cur.execute("BEGIN")
+        drop_sparse_indexes(cur)
+        insert_tfidf_values(cur, tfidf_matrix, wikipedia_movie_ids, batch_size)
+        create_sparse_indexes(cur)
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        previous_pragmas.pop('journal_mode')  # WAL is kept for concurrent readers
+        apply_pragmas(cur, previous_pragmas)
+
+
+def save_tfidf_blobs(conn, tfidf_matrix, wikipedia_movie_ids, batch_size=SAVE_BLOB_BATCH_SIZE):
+    """Save the TF-IDF vectors to tfidf_vectors, one packed row per movie, rolling back a failed load"""
+    conn.commit()  # The journal mode cannot change inside a transaction
+    cur = conn.cursor()
+    previous_pragmas = apply_pragmas(cur, BULK_LOAD_PRAGMAS)
+    try:
+        cur.execute("BEGIN")
+        insert_tfidf_blobs(cur, tfidf_matrix, wikipedia_movie_ids, batch_size)
+        conn.commit()
+    except BaseException:
+        # The PRAGMAs below cannot change while the transaction is open
+        conn.rollback()
+        raise
+    finally:
+        previous_pragmas.pop('journal_mode')  # WAL is kept for concurrent readers
+        apply_pragmas(cur, previous_pragmas)
+
+
+def save_vectorizer(conn, vectorizer):
+    """
+    Save the vocabulary, IDF weights and settings of a fitted TfidfVectorizer.
+
+    Parameters:
+        conn (Connection): A connection object to the SQLite database.
+        vectorizer (TfidfVectorizer): The vectorizer fitted on the corpus.
+    """
+    cur = conn.cursor()
+    create_vocabulary_tables(cur)
+    idf = vectorizer.idf_ if vectorizer.use_idf else None
+    cur.execute("DELETE FROM tfidf_vocabulary")
+    cur.executemany("INSERT INTO tfidf_vocabulary (tfidf_index, term, idf) VALUES (?, ?, ?)",
+                    ((int(index), term, None if idf is None else float(idf[index]))
+                     for term, index in vectorizer.vocabulary_.items()))
+    params = {name: vectorizer.get_params()[name] for name in VECTORIZER_PARAMS}
+    cur.executemany("INSERT OR REPLACE INTO tfidf_settings (name, value) VALUES (?, ?)",
+                    [('vectorizer', json.dumps(params)),
+                     ('preprocessing', json.dumps(PREPROCESSING_CONFIG))])
     conn.commit()
 
 
-def process_and_save_documents(conn):
-    """Process and save the documents to the database"""
+def load_vectorizer(conn):
+    """
+    Rebuild the fitted TfidfVectorizer saved by save_vectorizer.
+
+    Parameters:
+        conn (Connection): A connection object to the SQLite database.
+
+    Returns:
+        TfidfVectorizer: A vectorizer that projects preprocessed text into the stored space.
+
+    Raises:
+        ValueError: If no vocabulary is stored or it was built with different preprocessing.
+    """
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT name, value FROM tfidf_settings")
+        settings = {name: json.loads(value) for name, value in cur.fetchall()}
+    except sqlite3.OperationalError:
+        settings = {}
+    if 'vectorizer' not in settings:
+        raise ValueError("No fitted vocabulary is stored, run process_and_save_documents first.")
+    if settings.get('preprocessing') != PREPROCESSING_CONFIG:
+        raise ValueError("The stored vocabulary was built with a different preprocessing configuration.")
+
+    params = settings['vectorizer']
+    params['ngram_range'] = tuple(params['ngram_range'])
+    cur.execute("SELECT tfidf_index, term, idf FROM tfidf_vocabulary ORDER BY tfidf_index")
+    rows = cur.fetchall()
+    vectorizer = TfidfVectorizer(vocabulary={term: index for index, term, _ in rows}, **params)
+    if params['use_idf']:
+        vectorizer.idf_ = np.array([idf for _, _, idf in rows])
+    return vectorizer
+
+
+def record_build(conn):
+    """ Store a new build ID, marking every derived index of older builds as stale """
+    cur = conn.cursor()
+    create_vocabulary_tables(cur)
+    build_id = uuid.uuid4().hex
+    cur.execute("INSERT OR REPLACE INTO tfidf_settings (name, value) VALUES ('build_id', ?)",
+                (json.dumps(build_id),))
+    conn.commit()
+    return build_id
+
+
+def export_snapshot(conn, directory=SNAPSHOT_DIR):
+    """Export the stored TF-IDF matrix as a memory-mappable snapshot of the current build"""
+    build_id = get_build_id(conn.cursor())
+    if build_id is None:
+        build_id = record_build(conn)
+    with timed('index.snapshot'):
+        write_snapshot(directory, *load_sparse_matrix(conn), build_id)
+
+
+# Row-normalised matrix shared with the neighbour workers
+_neighbour_matrix = None
+_neighbour_matrix_t = None
+
+
+def _init_neighbour_worker(normalized):
+    """ Keep the row-normalised matrix and its transpose in a worker process """
+    global _neighbour_matrix, _neighbour_matrix_t
+    _neighbour_matrix = normalized
+    _neighbour_matrix_t = normalized.T.tocsr()
+
+
+def _neighbour_block(start, end, top_k):
+    """
+    Compute the top_k neighbours of the rows start:end of the shared matrix.
+
+    Returns:
+        tuple: (rows, neighbour rows, similarities) arrays, best neighbour of a row first.
+    """
+    scores = (_neighbour_matrix[start:end] @ _neighbour_matrix_t).toarray()
+    scores[np.arange(end - start), np.arange(start, end)] = 0.0  # A movie is not its own neighbour
+    best, best_scores = top_n_per_row(scores, top_k)
+    rows = np.repeat(np.arange(start, end), best.shape[1]).reshape(-1, best.shape[1])
+    positive = best_scores > 0
+    return rows[positive], best[positive], best_scores[positive]
+
+
+def save_neighbours(conn, top_k=NEIGHBOUR_COUNT, block_size=NEIGHBOUR_BLOCK_SIZE, workers=1):
+    """
+    Precompute the top_k most similar movies of every movie into similar_movies.
+    Similarities are computed as sparse matrix products over blocks of rows, so
+    peak memory is bounded by block_size, and blocks can run in parallel processes.
+
+    Parameters:
+        conn (Connection): A connection object to the SQLite database.
+        top_k (int): Number of neighbours stored per movie.
+        block_size (int): Number of movies scored per matrix product.
+        workers (int): Number of worker processes, 1 computes in this process.
+    """
+    matrix, movie_ids = load_sparse_matrix(conn)
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    inverse_norms = np.divide(1.0, norms, out=np.zeros_like(norms), where=norms > 0)
+    normalized = csr_matrix(matrix.multiply(inverse_norms[:, np.newaxis]), dtype=np.float32)
+    starts = range(0, normalized.shape[0], block_size)
+    ends = [min(start + block_size, normalized.shape[0]) for start in starts]
+
+    cur = conn.cursor()
+    build_id = get_build_id(cur)
+    cur.execute("DROP TABLE IF EXISTS similar_movies")
+    cur.execute("""
+        CREATE TABLE similar_movies (
+            wikipedia_movie_id INTEGER,
+            rank INTEGER,
+            similar_movie_id INTEGER,
+            similarity REAL,
+            PRIMARY KEY (wikipedia_movie_id, rank)
+        ) WITHOUT ROWID
+    """)
+
+    def insert_block(block):
+        rows, neighbours, similarities = block
+        # Rank of every neighbour within its movie, rows come grouped and best first
+        firsts = np.flatnonzero(np.r_[True, rows[1:] != rows[:-1]])
+        ranks = np.arange(len(rows)) - np.repeat(firsts, np.diff(np.r_[firsts, len(rows)]))
+        cur.executemany("INSERT INTO similar_movies VALUES (?, ?, ?, ?)",
+                        zip(movie_ids[rows].tolist(), (ranks + 1).tolist(),
+                            movie_ids[neighbours].tolist(), similarities.tolist()))
+
+    with timed('index.neighbours'):
+        if workers <= 1:
+            _init_neighbour_worker(normalized)
+            for start, end in zip(starts, ends):
+                insert_block(_neighbour_block(start, end, top_k))
+        else:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_neighbour_worker,
+                                     initargs=(normalized,)) as executor:
+                for block in executor.map(_neighbour_block, starts, ends, [top_k] * len(ends)):
+                    insert_block(block)
+
+    create_vocabulary_tables(cur)
+    cur.execute("INSERT OR REPLACE INTO tfidf_settings (name, value) VALUES ('neighbours', ?)",
+                (json.dumps({'build_id': build_id, 'top_k': top_k}),))
+    conn.commit()
+
+
+def save_dense_vectors(conn, dimensions=EMBEDDING_DIMENSIONS, n_lists=None):
+    """
+    Reduce the stored TF-IDF vectors to dense embeddings and store their ANN index.
+
+    Parameters:
+        conn (Connection): A connection object to the SQLite database.
+        dimensions (int): Number of SVD dimensions of the embeddings.
+        n_lists (int): Number of inverted lists, about the square root of the corpus size by default.
+
+    Returns:
+        DenseIndex: The stored index.
+    """
+    build_id = get_build_id(conn.cursor())
+    tfidf_matrix, movie_ids = load_sparse_matrix(conn)
+    with timed('index.svd'):
+        embeddings = fit_embeddings(tfidf_matrix, dimensions)
+    with timed('index.ann_lists'):
+        index = DenseIndex.build(embeddings, movie_ids, n_lists, build_id)
+    save_dense_index(conn, index)
+    return index
+
+
+def iter_plot_summaries(conn, batch_size=STREAM_BATCH_SIZE):
+    """ Yield the (wikipedia_movie_id, plot_summary) rows of plot_summaries in batches """
     cur = conn.cursor()
     cur.execute("SELECT wikipedia_movie_id, plot_summary FROM plot_summaries")
-    wikipedia_movie_ids, documents = zip(*[(row[0],
-                                        preprocess_text(row[1]))
-                                        for row in cur.fetchall()])
-    vectorizer = TfidfVectorizer()
-    tfidf_matrix = vectorizer.fit_transform(documents)
-    save_tfidf_values(conn, tfidf_matrix, wikipedia_movie_ids)
+    while rows := cur.fetchmany(batch_size):
+        yield rows
 
 
-def main():
-    """main function to execute the script"""
-    start_time = time.time()
+def count_document_frequencies(conn, spill_file, workers=1, chunk_size=PREPROCESS_CHUNK_SIZE,
+                               batch_size=STREAM_BATCH_SIZE):
+    """
+    First pass of the streaming build.
+    Preprocesses the plot summaries batch by batch, spills every preprocessed
+    document to spill_file as a "wikipedia_movie_id<TAB>plot hash<TAB>document"
+    line and counts in how many documents each term occurs. The hashes are only
+    stored with the vectors, by save_tfidf_chunks. With several workers a single
+    process pool serves every batch, so the workers start once per build.
+
+    Returns:
+        tuple: (Counter of document frequencies, number of documents)
+    """
+    analyzer = TfidfVectorizer().build_analyzer()
+    document_frequencies = Counter()
+    n_documents = 0
+    with ProcessPoolExecutor(max_workers=workers) if workers > 1 else contextlib.nullcontext() as executor:
+        for rows in iter_plot_summaries(conn, batch_size):
+            with timed('index.preprocess'):
+                documents = preprocess_documents([row[1] for row in rows], workers, chunk_size, executor)
+            with timed('index.document_frequencies'):
+                for (wikipedia_movie_id, plot_summary), document in zip(rows, documents):
+                    spill_file.write(f"{wikipedia_movie_id}\t{content_hash(plot_summary)}\t{document}\n")
+                    document_frequencies.update(set(analyzer(document)))
+            n_documents += len(rows)
+            increment('index.documents', len(rows))
+    return document_frequencies, n_documents
+
+
+def build_vectorizer(document_frequencies, n_documents):
+    """ Build a TfidfVectorizer equal to one fitted on a corpus with these document frequencies """
+    terms = sorted(document_frequencies)
+    vectorizer = TfidfVectorizer(vocabulary={term: index for index, term in enumerate(terms)})
+    df = np.array([document_frequencies[term] for term in terms], dtype=np.float64)
+    # Same smoothed IDF as TfidfVectorizer.fit
+    vectorizer.idf_ = np.log((1 + n_documents) / (1 + df)) + 1
+    return vectorizer
+
+
+def iter_spilled_chunks(spill_file, vectorizer, batch_size=STREAM_BATCH_SIZE):
+    """ Second pass of the streaming build, yield (tfidf_matrix, wikipedia_movie_ids) chunks """
+    spill_file.seek(0)
+    while lines := list(islice(spill_file, batch_size)):
+        wikipedia_movie_ids = []
+        documents = []
+        for line in lines:
+            wikipedia_movie_id, _, document = line.rstrip('\n').split('\t', 2)
+            wikipedia_movie_ids.append(int(wikipedia_movie_id))
+            documents.append(document)
+        with timed('index.vectorize'):
+            tfidf_matrix = vectorizer.transform(documents)
+        yield tfidf_matrix, wikipedia_movie_ids
+
+
+def iter_spilled_hashes(spill_file):
+    """ Yield the (wikipedia_movie_id, content_hash) pairs of the spilled documents """
+    spill_file.seek(0)
+    for line in spill_file:
+        wikipedia_movie_id, plot_hash, _ = line.split('\t', 2)
+        yield int(wikipedia_movie_id), plot_hash
+
+
+def process_and_save_documents(conn, workers=1, chunk_size=PREPROCESS_CHUNK_SIZE, batch_size=STREAM_BATCH_SIZE):
+    """
+    Process and save the documents to the database.
+    The corpus is streamed in two passes of batch_size documents: the first
+    counts document frequencies and spills the preprocessed text to a temporary
+    file, the second vectorizes and saves it chunk by chunk. Only one batch and
+    the vocabulary are held in memory, and the vectors equal those of
+    TfidfVectorizer().fit_transform on the whole corpus.
+    """
+    with timed('index.build'), tempfile.TemporaryFile('w+', encoding='utf-8') as spill_file:
+        document_frequencies, n_documents = count_document_frequencies(conn, spill_file, workers,
+                                                                       chunk_size, batch_size)
+        vectorizer = build_vectorizer(document_frequencies, n_documents)
+        del document_frequencies
+        # The plot hashes are read back once every chunk is saved, in the same transaction
+        save_tfidf_chunks(conn, iter_spilled_chunks(spill_file, vectorizer, batch_size),
+                          plot_hashes=iter_spilled_hashes(spill_file))
+        with timed('index.vocabulary'):
+            save_vectorizer(conn, vectorizer)
+        save_drift(conn, {'documents': n_documents, 'changed': 0})
+        record_build(conn)
+
+
+def content_hash(text):
+    """ Hash a plot summary to detect changes between builds """
+    return hashlib.sha1((text or '').encode('utf-8')).hexdigest()
 
+
+def create_plot_hashes_table(cur):
+    """ Create the table of plot summary hashes the stored vectors were built from """
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS plot_hashes (
+            wikipedia_movie_id INTEGER PRIMARY KEY,
+            content_hash TEXT NOT NULL
+        )
+    """)
+
+
+def save_drift(conn, drift):
+    """ Store how many documents changed since the vectorizer was last fitted """
+    cur = conn.cursor()
+    create_vocabulary_tables(cur)
+    cur.execute("INSERT OR REPLACE INTO tfidf_settings (name, value) VALUES ('drift', ?)",
+                (json.dumps(drift),))
+    conn.commit()
+
+
+def find_changed_documents(conn):
+    """
+    Compare plot_summaries with the hashes the stored vectors were built from.
+
+    Returns:
+        tuple: (dict of new or modified movie ID -> (plot summary, hash), list of deleted movie IDs),
+            or None if the vectors were never built with hashes.
+    """
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT wikipedia_movie_id, content_hash FROM plot_hashes")
+    except sqlite3.OperationalError:
+        return None
+    stored_hashes = dict(cur.fetchall())
+    if not stored_hashes:
+        return None
+
+    changed = {}
+    cur.execute("SELECT wikipedia_movie_id, plot_summary FROM plot_summaries")
+    for wikipedia_movie_id, plot_summary in cur:
+        new_hash = content_hash(plot_summary)
+        if stored_hashes.pop(wikipedia_movie_id, None) != new_hash:
+            changed[wikipedia_movie_id] = (plot_summary, new_hash)
+    # Whatever is left has no plot summary any more
+    return changed, list(stored_hashes)
+
+
+def replace_tfidf_vectors(conn, tfidf_matrix, wikipedia_movie_ids, deleted_ids, plot_hashes, drift):
+    """
+    Replace the vectors of a few movies in place, keeping the table indexes.
+    The plot hashes and the drift are updated in the same transaction, with the
+    drift's document count taken from plot_hashes once movies were added or deleted.
+
+    Parameters:
+        conn (Connection): A connection object to the SQLite database.
+        tfidf_matrix (sparse matrix): New vectors, one row per wikipedia_movie_ids entry.
+        wikipedia_movie_ids (list): Movies whose vectors are replaced or added.
+        deleted_ids (list): Movies whose vectors and hashes are removed.
+        plot_hashes (dict): Movie ID -> content hash of the replaced or added movies.
+        drift (dict): Drift settings to store, its 'documents' count is refreshed.
+    """
+    tfidf_matrix = csr_matrix(tfidf_matrix)
+    cur = conn.cursor()
+    table = 'tfidf_vectors' if uses_blob_storage(cur) else 'sparse_tfidf'
+    try:
+        cur.execute("BEGIN")
+        write_tfidf_replacements(cur, table, tfidf_matrix, wikipedia_movie_ids, deleted_ids)
+        cur.executemany("DELETE FROM plot_hashes WHERE wikipedia_movie_id=?",
+                        [(int(movie_id),) for movie_id in deleted_ids])
+        cur.executemany("INSERT OR REPLACE INTO plot_hashes (wikipedia_movie_id, content_hash) VALUES (?, ?)",
+                        plot_hashes.items())
+        cur.execute("SELECT COUNT(*) FROM plot_hashes")
+        drift['documents'] = cur.fetchone()[0]
+        cur.execute("INSERT OR REPLACE INTO tfidf_settings (name, value) VALUES ('drift', ?)",
+                    (json.dumps(drift),))
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+
+
+def write_tfidf_replacements(cur, table, tfidf_matrix, wikipedia_movie_ids, deleted_ids):
+    """ Delete the old vectors of the replaced and deleted movies and insert the new ones """
+    cur.executemany(f"DELETE FROM {table} WHERE wikipedia_movie_id=?",
+                    [(int(movie_id),) for movie_id in [*wikipedia_movie_ids, *deleted_ids]])
+    if table == 'tfidf_vectors':
+        cur.executemany("INSERT INTO tfidf_vectors VALUES (?, ?, ?)",
+                        iter_blob_rows(tfidf_matrix, wikipedia_movie_ids, range(len(wikipedia_movie_ids))))
+    else:
+        movie_ids = np.repeat(np.asarray(wikipedia_movie_ids, dtype=np.int64), np.diff(tfidf_matrix.indptr))
+        cur.executemany("INSERT INTO sparse_tfidf VALUES (?, ?, ?)",
+                        zip(movie_ids.tolist(), tfidf_matrix.indices.tolist(), tfidf_matrix.data.tolist()))
+
+
+def update_documents(conn, refit_threshold=REFIT_THRESHOLD, workers=1, chunk_size=PREPROCESS_CHUNK_SIZE):
+    """
+    Bring the stored vectors up to date with plot_summaries.
+    Only new or modified summaries are vectorized, against the stored vocabulary,
+    and the vectors of deleted ones are removed. Once the share of documents
+    changed since the last fit exceeds refit_threshold, the vectorizer is refitted
+    on the whole corpus instead. Terms missing from the stored vocabulary are
+    ignored until that refit.
+
+    Returns:
+        dict: Counts of 'changed' and 'deleted' documents and whether a full 'refit' ran.
+    """
+    with timed('index.find_changes'):
+        changes = find_changed_documents(conn)
+    drift_row = None
+    if changes is not None:
+        cur = conn.cursor()
+        cur.execute("SELECT value FROM tfidf_settings WHERE name='drift'")
+        drift_row = cur.fetchone()
+    if drift_row is None:
+        refit_documents(conn, workers, chunk_size)
+        return {'changed': None, 'deleted': None, 'refit': True}
+
+    changed, deleted_ids = changes
+    if not changed and not deleted_ids:
+        return {'changed': 0, 'deleted': 0, 'refit': False}
+    drift = json.loads(drift_row[0])
+    drift['changed'] += len(changed) + len(deleted_ids)
+    if drift['changed'] > refit_threshold * max(drift['documents'], 1):
+        refit_documents(conn, workers, chunk_size)
+        return {'changed': len(changed), 'deleted': len(deleted_ids), 'refit': True}
+
+    wikipedia_movie_ids = list(changed)
+    with timed('index.preprocess'):
+        documents = preprocess_documents([changed[movie_id][0] for movie_id in wikipedia_movie_ids],
+                                         workers, chunk_size)
+    with timed('index.vectorize'):
+        tfidf_matrix = load_vectorizer(conn).transform(documents)
+    with timed('index.save'):
+        replace_tfidf_vectors(conn, tfidf_matrix, wikipedia_movie_ids, deleted_ids,
+                              {movie_id: changed[movie_id][1] for movie_id in wikipedia_movie_ids}, drift)
+    increment('index.documents', len(changed))
+    record_build(conn)
+    return {'changed': len(changed), 'deleted': len(deleted_ids), 'refit': False}
+
+
+def refit_documents(conn, workers=1, chunk_size=PREPROCESS_CHUNK_SIZE):
+    """Recreate the vector tables in their current layout and rebuild them from scratch"""
+    storage = STORAGE_BLOB if uses_blob_storage(conn.cursor()) else STORAGE_ROWS
+    setup_database(conn, storage)
+    process_and_save_documents(conn, workers, chunk_size)
+
+
+def run(args):
+    """Build the vectors and the requested extras as selected on the command line"""
     conn = create_connection('movies.db')
-    #setup_database(conn)  # Ensure the database is setup
-    process_and_save_documents(conn)  # Process and save documents
+    if args.storage:
+        setup_database(conn, args.storage)  # Ensure the database is setup
+    if args.incremental:
+        summary = update_documents(conn, args.refit_threshold, args.workers, args.chunk_size)
+        print(f"Updated vectors: {summary}")
+    else:
+        process_and_save_documents(conn, args.workers, args.chunk_size)  # Process and save documents
+    if args.snapshot:
+        export_snapshot(conn, args.snapshot)
+    if args.neighbours:
+        save_neighbours(conn, args.neighbours, workers=args.workers)
+    if args.dense:
+        save_dense_vectors(conn, args.dense)
     conn.close()
 
+
+def main():
+    """main function to execute the script"""
+    parser = argparse.ArgumentParser(description="Build the TF-IDF vectors of the plot summaries.")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="number of preprocessing processes (default: 1)")
+    parser.add_argument('--chunk-size', type=int, default=PREPROCESS_CHUNK_SIZE,
+                        help=f"documents per worker task (default: {PREPROCESS_CHUNK_SIZE})")
+    parser.add_argument('--storage', choices=(STORAGE_ROWS, STORAGE_BLOB),
+                        help="recreate the vector tables with this layout before processing")
+    parser.add_argument('--incremental', action='store_true',
+                        help="only vectorize plot summaries added or changed since the last build")
+    parser.add_argument('--refit-threshold', type=float, default=REFIT_THRESHOLD,
+                        help=f"share of changed documents that triggers a full refit (default: {REFIT_THRESHOLD})")
+    parser.add_argument('--snapshot', metavar='DIR', nargs='?', const=SNAPSHOT_DIR,
+                        help=f"also export a memory-mapped matrix snapshot (default: {SNAPSHOT_DIR})")
+    parser.add_argument('--dense', metavar='DIMS', type=int, nargs='?', const=EMBEDDING_DIMENSIONS,
+                        help=f"also build the dense SVD embeddings and their ANN index (default: {EMBEDDING_DIMENSIONS})")
+    parser.add_argument('--neighbours', metavar='K', type=int, nargs='?', const=NEIGHBOUR_COUNT,
+                        help=f"also precompute the top K similar movies (default: {NEIGHBOUR_COUNT})")
+    parser.add_argument('--metrics', metavar='FILE',
+                        help="append stage timings to FILE as JSON lines instead of logging them")
+    parser.add_argument('--profile', metavar='FILE',
+                        help="profile the run with cProfile and write the statistics to FILE")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    sink = JsonLinesSink(args.metrics) if args.metrics else LoggingSink()
+    add_sink(sink)
+
+    start_time = time.time()
+    try:
+        with profiled(args.profile) if args.profile else contextlib.nullcontext():
+            run(args)
+    finally:
+        remove_sink(sink)
+        if isinstance(sink, JsonLinesSink):
+            sink.close()
+
     end_time = time.time()
     print(f"Execution completed in {end_time - start_time:.2f} seconds.")
 